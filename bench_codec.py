@@ -0,0 +1,122 @@
+"""
+Load and dump throughput of each JSON codec on a synthetic result file.
+
+Builds a million result items shaped like the runners' output (id, types,
+reason), then times every installed codec writing and reading them as an
+indented JSON file (results/) and as JSONL (prepared prompts, ledger
+shards). Files go to a temporary folder and are removed afterwards.
+
+    python bench_codec.py
+    python bench_codec.py --items 200000 --codecs json,orjson --output codec.json
+"""
+
+import argparse
+import json
+import random
+import tempfile
+import time
+from pathlib import Path
+
+import codec as codec_module
+from codec import CODECS, get_codec
+
+DEFAULT_ITEMS = 1_000_000
+WORDS = ["unit", "process", "material", "property", "phenomenon", "instrument", "region", "substance",
+         "measurement", "the", "term", "is", "a", "kind", "of", "because", "describes", "used", "in"]
+
+
+def synthetic_results(items, seed=0):
+    """Result dicts shaped like the runners' output."""
+    rng = random.Random(seed)
+    labels = [f"{rng.choice(WORDS)} {rng.choice(WORDS)}" for _ in range(200)]
+    return [
+        {
+            "id": f"TT_{index:08x}",
+            "types": [rng.choice(labels)],
+            "reason": " ".join(rng.choice(WORDS) for _ in range(rng.randint(8, 30))).capitalize() + ".",
+        }
+        for index in range(items)
+    ]
+
+
+def timed(function):
+    started = time.perf_counter()
+    result = function()
+    return time.perf_counter() - started, result
+
+
+def bench_codec(name, results, folder):
+    """
+    Time one codec on every operation.
+
+    Returns:
+        Dict of operation -> {"seconds", "items_per_second", "mb_per_second"}
+    """
+    # The read/write helpers use the module-level codec
+    codec_module.codec = get_codec(name)
+    json_file = folder / f"{name}.json"
+    jsonl_file = folder / f"{name}.jsonl"
+    operations = [
+        ("dump json", lambda: codec_module.write_json(json_file, results), json_file),
+        ("load json", lambda: codec_module.read_json(json_file), json_file),
+        ("dump jsonl", lambda: codec_module.write_jsonl(jsonl_file, results), jsonl_file),
+        ("load jsonl", lambda: codec_module.read_jsonl(jsonl_file), jsonl_file),
+    ]
+    timings = {}
+    for operation, function, path in operations:
+        seconds, loaded = timed(function)
+        if operation.startswith("load") and len(loaded) != len(results):
+            raise RuntimeError(f"{name} {operation} read {len(loaded)} of {len(results)} items")
+        megabytes = path.stat().st_size / 1_000_000
+        timings[operation] = {
+            "seconds": round(seconds, 3),
+            "items_per_second": round(len(results) / seconds),
+            "mb_per_second": round(megabytes / seconds, 1),
+        }
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the JSON codecs on a synthetic result file.")
+    parser.add_argument("--items", type=int, default=DEFAULT_ITEMS, help="Number of synthetic result items")
+    parser.add_argument("--codecs", default=",".join(CODECS), help="Comma-separated codecs to compare")
+    parser.add_argument("--output", default=None, help="Also save the timings as JSON to this file")
+    args = parser.parse_args()
+
+    print(f"Building {args.items} synthetic results...")
+    results = synthetic_results(args.items)
+
+    report = {}
+    with tempfile.TemporaryDirectory() as folder:
+        for name in [c.strip() for c in args.codecs.split(",")]:
+            try:
+                get_codec(name)
+            except ImportError:
+                print(f"{name}: not installed, skipped")
+                continue
+            report[name] = bench_codec(name, results, Path(folder))
+
+    if not report:
+        return
+    operations = list(next(iter(report.values())))
+    print(f"\n{'codec':<10}" + "".join(f"{operation:>22}" for operation in operations))
+    for name, timings in report.items():
+        cells = [f"{t['seconds']:>7.2f}s {t['mb_per_second']:>7.1f} MB/s" for t in timings.values()]
+        print(f"{name:<10}" + "".join(f"{cell:>22}" for cell in cells))
+
+    if "json" in report:
+        print()
+        for name, timings in report.items():
+            if name == "json":
+                continue
+            speedups = [report["json"][operation]["seconds"] / timings[operation]["seconds"] for operation in operations]
+            print(f"{name} vs json: " + ", ".join(f"{op} {s:.1f}x" for op, s in zip(operations, speedups)))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"items": args.items, "codecs": report}, f, indent=2)
+        print(f"\nTimings saved to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+"""
+Measure the startup time of every cli.py command against a budget.
+
+Each command is started with --help in a fresh interpreter, which loads
+its script and parses arguments but sends nothing, so the time is what
+any run of the command pays before its first request. The median of
+several runs is compared with the command's budget, and the script exits
+with status 1 if any command is over it.
+
+    python bench_startup.py
+    python bench_startup.py --repeat 10 --budget 0.2 --output startup.json
+"""
+
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+from cli import COMMANDS, MODEL_SCRIPTS, MODEL_STAGES
+
+ROOT = Path(__file__).resolve().parent
+# Seconds from interpreter start to parsed arguments
+DEFAULT_BUDGET = 0.3
+# Commands whose real work needs a heavy library at import
+BUDGETS = {"join": 1.0}
+DEFAULT_REPEAT = 5
+
+
+def command_lines():
+    """Every command line to time, as lists of arguments after cli.py."""
+    lines = [[]]
+    for stage in MODEL_STAGES:
+        for model in MODEL_SCRIPTS:
+            lines.append([stage, model])
+    for command in COMMANDS:
+        lines.append([command])
+    return lines
+
+
+def time_command(args, repeat):
+    """
+    Median wall time of `python cli.py <args> --help`.
+
+    Returns:
+        Seconds, or None if the command failed
+    """
+    times = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        completed = subprocess.run([sys.executable, str(ROOT / "cli.py"), *args, "--help"],
+                                   capture_output=True, text=True)
+        times.append(time.perf_counter() - started)
+        if completed.returncode != 0:
+            print(completed.stderr.strip().splitlines()[-1] if completed.stderr.strip() else "failed")
+            return None
+    return statistics.median(times)
+
+
+def interpreter_time(repeat):
+    """Median wall time of an empty interpreter, for reference."""
+    times = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        subprocess.run([sys.executable, "-c", "pass"])
+        times.append(time.perf_counter() - started)
+    return statistics.median(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time the startup of every cli.py command against a budget.")
+    parser.add_argument("--repeat", type=int, default=DEFAULT_REPEAT, help="Runs per command; the median counts")
+    parser.add_argument("--budget", type=float, default=None,
+                        help=f"Seconds allowed for every command (default {DEFAULT_BUDGET}, more for a few)")
+    parser.add_argument("--output", default=None, help="Also save the timings as JSON to this file")
+    args = parser.parse_args()
+
+    baseline = interpreter_time(args.repeat)
+    print(f"Empty interpreter: {baseline:.3f}s\n")
+    print(f"{'command':<42} {'median':>8} {'budget':>8}")
+
+    timings = {}
+    failed = []
+    for command in command_lines():
+        name = " ".join(command) or "(list commands)"
+        budget = args.budget if args.budget is not None else BUDGETS.get(command[0] if command else "", DEFAULT_BUDGET)
+        seconds = time_command(command, args.repeat)
+        over = seconds is None or seconds > budget
+        if over:
+            failed.append(name)
+        shown = "failed" if seconds is None else f"{seconds:.3f}s"
+        print(f"{name:<42} {shown:>8} {budget:>7.2f}s{'  OVER' if over else ''}")
+        timings[name] = {"seconds": seconds, "budget": budget}
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"interpreter": baseline, "commands": timings}, f, indent=2)
+        print(f"\nTimings saved to {args.output}")
+
+    if failed:
+        print(f"\n{len(failed)} commands over budget: {', '.join(failed)}")
+        sys.exit(1)
+    print(f"\nAll {len(timings)} commands within budget")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,379 @@
+"""
+Confidence-gated model cascade for term typing.
+
+Terms go to the cheapest model first. An answer is accepted when its
+confidence reaches the threshold calibrated for that model on held-out
+train items; otherwise the term escalates to the next model. Terms no
+model is confident about are left for the judge.
+
+Confidence is the model's self-reported confidence, or the vote margin of
+self-consistency sampling when --samples is above 1.
+"""
+
+import argparse
+import asyncio
+import os
+import random
+from pathlib import Path
+
+from tqdm.asyncio import tqdm as tqdm_asyncio
+
+from codec import read_json, read_jsonl, write_json
+from consistency import check_sample_arguments, sample_until_agreed
+from engine import item_id_of
+from providers import PROVIDERS, add_engine_arguments, engine_from_args
+from registry import AVAILABLE_DATASETS, load_dataset
+from schemas import build_response_model
+
+OUTPUT_DIR = Path("processed_datasets")
+RESULT_DIR = Path("results_cascade")
+# Cheapest first by output price, the faster of equally priced models first
+CASCADE_MODELS = sorted(PROVIDERS, key=lambda m: (PROVIDERS[m]["price_per_million"]["output"],
+                                                  PROVIDERS[m]["typical_latency"]))
+MAX_CONCURRENT = 4
+DEFAULT_TARGET_ACCURACY = 0.9
+DEFAULT_CALIBRATION_SIZE = 100
+# Target accuracies shown in the accuracy vs calls report
+TRADE_OFF_TARGETS = [0.7, 0.8, 0.85, 0.9, 0.95, 0.99]
+CONFIDENCE_INSTRUCTION = (
+    " Also give 'confidence': your probability, between 0 and 1, that the first type you predict is correct."
+)
+
+
+def load_prompts(model_name, dataset_name, no_reason=False):
+    """Term-typing prompts of a model by the item id quoted in each, with the confidence request added."""
+    test_suffix = "_no_reason_test" if no_reason else "_test"
+    filename = OUTPUT_DIR.joinpath(model_name).joinpath(f"{dataset_name.lower()}{test_suffix}.jsonl")
+    prompts = {}
+    for messages in read_jsonl(filename):
+        messages[0]["content"] += CONFIDENCE_INSTRUCTION
+        prompts[item_id_of(messages)] = messages
+    return prompts
+
+
+def load_split(dataset_name, split):
+    """Load the train or test items of a dataset."""
+    dataset = load_dataset(dataset_name)
+    # A copy, so callers never reorder the registry's cached list
+    return list(dataset.train if split == "train" else dataset.test)
+
+
+def calibration_items(dataset_name, size, seed):
+    """
+    Sample train items for calibration.
+
+    The first five train items are the few-shot examples of the prompt, so
+    they are never used.
+
+    Returns:
+        List of train items with id, term and types
+    """
+    train_data = load_split(dataset_name, "train")[5:]
+    return random.Random(seed).sample(train_data, min(size, len(train_data)))
+
+
+def with_user_item(messages, item):
+    """Reuse the system prompt of a test prompt for another item."""
+    return [messages[0], {"role": "user", "content": f"{ {'id': item['id'], 'term': item['term']} }"}]
+
+
+async def run_stage(engine, prompts, response_model, samples, agree, desc):
+    """
+    Ask one model about a set of items.
+
+    Args:
+        engine: Engine of the model
+        prompts: Mapping from item id to chat messages
+        response_model: Model the responses are parsed into
+        samples: Maximum samples per item, 1 to use the self-reported confidence
+        agree: Votes that settle an item early
+        desc: Progress bar label
+
+    Returns:
+        Mapping from item id to a result dict with types, reason and confidence
+    """
+    tasks = [sample_until_agreed(engine, messages, response_model, samples, agree) for messages in prompts.values()]
+    answers = {}
+    for fut in tqdm_asyncio.as_completed(tasks, desc=desc, total=len(tasks)):
+        try:
+            result, votes = await fut
+        except Exception as e:
+            print(f"Error processing item: {e}")
+            continue
+        answer = result.model_dump()
+        if samples > 1:
+            answer.update(votes)
+            answer["confidence"] = votes["vote_margin"]
+        answers[answer["id"]] = answer
+    return answers
+
+
+def calibrate_threshold(scored, target_accuracy):
+    """
+    Find the lowest confidence threshold whose accepted answers reach the target accuracy.
+
+    Args:
+        scored: List of (confidence, correct) pairs on calibration items
+        target_accuracy: Accuracy required of the accepted answers
+
+    Returns:
+        Threshold, above 1 when no threshold reaches the target
+    """
+    threshold = float("inf")
+    correct = 0
+    ranked = sorted(scored, key=lambda pair: -pair[0])
+    for position, (confidence, is_correct) in enumerate(ranked, 1):
+        correct += is_correct
+        # Only cut between distinct confidences
+        if position < len(ranked) and ranked[position][0] == confidence:
+            continue
+        if correct / position >= target_accuracy:
+            threshold = confidence
+    return threshold
+
+
+def simulate(answers_by_model, gold, thresholds):
+    """
+    Replay the cascade on calibration answers.
+
+    Terms that no model accepts take the most confident answer, standing in
+    for the judge.
+
+    Returns:
+        Dict with accuracy, model calls per term and share of terms left for the judge
+    """
+    correct = calls = unresolved = 0
+    for item_id, types in gold.items():
+        chosen = None
+        candidates = []
+        for model, answers in answers_by_model.items():
+            calls += 1
+            answer = answers.get(item_id)
+            if answer is None:
+                continue
+            candidates.append(answer)
+            if answer["confidence"] >= thresholds[model]:
+                chosen = answer
+                break
+        if chosen is None:
+            unresolved += 1
+            chosen = max(candidates, key=lambda a: a["confidence"], default=None)
+        correct += chosen is not None and bool(chosen["types"]) and chosen["types"][0] in types
+    return {
+        "accuracy": round(correct / len(gold), 4),
+        "calls_per_term": round(calls / len(gold), 3),
+        "judge_share": round(unresolved / len(gold), 4),
+    }
+
+
+async def calibrate(dataset_name, models, engines, args):
+    """
+    Calibrate a threshold per model on held-out train items and report the accuracy vs calls trade-off.
+
+    Returns:
+        Mapping from model to threshold
+    """
+    items = calibration_items(dataset_name, args.calibration_size, args.seed)
+    gold = {item["id"]: item["types"] for item in items}
+    response_model = build_response_model(dataset_name, with_reason=not args.no_reason, with_confidence=True)
+
+    answers_by_model = {}
+    for model in models:
+        system_prompt = next(iter(load_prompts(model, dataset_name, args.no_reason).values()))[0]
+        prompts = {item["id"]: with_user_item(system_prompt, item) for item in items}
+        answers_by_model[model] = await run_stage(engines[model], prompts, response_model, args.samples,
+                                                  args.agree, f"Calibrating {model}")
+
+    def thresholds_for(target):
+        return {
+            model: calibrate_threshold(
+                [(a["confidence"], bool(a["types"]) and a["types"][0] in gold[item_id]) for item_id, a in answers.items() if item_id in gold],
+                target,
+            )
+            for model, answers in answers_by_model.items()
+        }
+
+    report = {"single_model": {}, "cascade": {}}
+    for model in models:
+        report["single_model"][model] = simulate({model: answers_by_model[model]}, gold, {model: float("-inf")})
+    print(f"\n{dataset_name}: accuracy vs calls on {len(gold)} calibration terms")
+    print(f"{'setting':<32} {'accuracy':>9} {'calls/term':>11} {'to judge':>9}")
+    for model, row in report["single_model"].items():
+        print(f"{model:<32} {row['accuracy']:>9.3f} {row['calls_per_term']:>11.2f} {row['judge_share']:>9.1%}")
+    for target in sorted(set(TRADE_OFF_TARGETS + [args.target_accuracy])):
+        row = simulate(answers_by_model, gold, thresholds_for(target))
+        report["cascade"][str(target)] = row
+        print(f"{f'cascade @ {target}':<32} {row['accuracy']:>9.3f} {row['calls_per_term']:>11.2f} {row['judge_share']:>9.1%}")
+
+    thresholds = thresholds_for(args.target_accuracy)
+    calibration_file = RESULT_DIR.joinpath(f"{dataset_name.lower()}_calibration.json")
+    os.makedirs(calibration_file.parent, exist_ok=True)
+    write_json(calibration_file, {
+        "models": models,
+        "target_accuracy": args.target_accuracy,
+        "settings": calibration_settings(args),
+        # JSON has no infinity: null means the model's answers are never accepted
+        "thresholds": {m: (t if t != float("inf") else None) for m, t in thresholds.items()},
+        "trade_off": report,
+    })
+    print(f"Saved calibration to {calibration_file}")
+    return thresholds
+
+
+def calibration_settings(args):
+    """Options that change the calibration answers, saved with the thresholds."""
+    return {
+        "calibration_size": args.calibration_size,
+        "seed": args.seed,
+        "samples": args.samples,
+        "agree": args.agree,
+        "no_reason": args.no_reason,
+    }
+
+
+def load_thresholds(dataset_name, models, args):
+    """Return thresholds saved by an earlier calibration with the same models, target and settings, if any."""
+    calibration_file = RESULT_DIR.joinpath(f"{dataset_name.lower()}_calibration.json")
+    if not calibration_file.exists():
+        return None
+    calibration = read_json(calibration_file)
+    if (calibration["models"] != models or calibration["target_accuracy"] != args.target_accuracy
+            or calibration.get("settings") != calibration_settings(args)):
+        return None
+    return {m: (t if t is not None else float("inf")) for m, t in calibration["thresholds"].items()}
+
+
+async def process_dataset(dataset_name, models, engines, args):
+    thresholds = None if args.recalibrate else load_thresholds(dataset_name, models, args)
+    if thresholds is None:
+        thresholds = await calibrate(dataset_name, models, engines, args)
+    if args.calibrate_only:
+        return
+
+    test_data = load_split(dataset_name, "test")
+    response_model = build_response_model(dataset_name, with_reason=not args.no_reason, with_confidence=True)
+    pending = [item["id"] for item in test_data]
+    accepted = {}
+    candidates = {}
+    calls = 0
+
+    for model in models:
+        if not pending:
+            break
+        prompts = load_prompts(model, dataset_name, args.no_reason)
+        missing = [item_id for item_id in pending if item_id not in prompts]
+        if missing:
+            print(f"{model}: no prompt for {len(missing)} terms, e.g. {missing[0]}; they go to the next model")
+        to_send = {item_id: prompts[item_id] for item_id in pending if item_id in prompts}
+        answers = await run_stage(engines[model], to_send, response_model, args.samples, args.agree,
+                                  f"{dataset_name} with {model}")
+        calls += len(to_send)
+
+        # Every stage keeps the standard layout so the judge can read escalated items
+        result_filename = RESULT_DIR.joinpath(model).joinpath(f"{dataset_name.lower()}_results.json")
+        os.makedirs(result_filename.parent, exist_ok=True)
+        write_json(result_filename, list(answers.values()))
+
+        still_pending = []
+        for item_id in pending:
+            answer = answers.get(item_id)
+            if answer is not None and answer["confidence"] >= thresholds[model]:
+                accepted[item_id] = {**answer, "answered_by": model}
+                continue
+            if answer is not None and answer["confidence"] > candidates.get(item_id, {}).get("confidence", -1):
+                candidates[item_id] = {**answer, "answered_by": model}
+            still_pending.append(item_id)
+        print(f"{model}: accepted {len(pending) - len(still_pending)} of {len(pending)} terms")
+        pending = still_pending
+
+    # Unresolved terms keep their most confident answer until the judge has ruled
+    final = list(accepted.values())
+    final.extend({**candidates[item_id], "escalated": True} for item_id in pending if item_id in candidates)
+    result_filename = RESULT_DIR.joinpath(f"{dataset_name.lower()}_results.json")
+    write_json(result_filename, final)
+    print(f"{dataset_name}: {calls / len(test_data):.2f} calls per term, {len(pending)} terms left for the judge")
+    print(f"Saved results to {result_filename}")
+
+
+async def main_async(datasets_to_process, models, engines, args):
+    for dataset_name in datasets_to_process:
+        await process_dataset(dataset_name, models, engines, args)
+    for engine in engines.values():
+        engine.report()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Type terms with the cheapest confident model, escalating only uncertain terms."
+    )
+    parser.add_argument(
+        "dataset",
+        choices=AVAILABLE_DATASETS + ["all"],
+        help="Dataset to process or 'all' to process all datasets",
+    )
+    parser.add_argument(
+        "--models",
+        default=",".join(CASCADE_MODELS),
+        help="Comma-separated cascade order, cheapest first",
+    )
+    parser.add_argument(
+        "--target-accuracy",
+        type=float,
+        default=DEFAULT_TARGET_ACCURACY,
+        help="Accuracy the accepted answers of each model must reach on calibration terms",
+    )
+    parser.add_argument(
+        "--calibration-size",
+        type=int,
+        default=DEFAULT_CALIBRATION_SIZE,
+        help="Number of held-out train terms used to calibrate the thresholds",
+    )
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the calibration sample")
+    parser.add_argument(
+        "--recalibrate",
+        action="store_true",
+        help="Calibrate again even if thresholds for these models, target and settings are saved",
+    )
+    parser.add_argument(
+        "--calibrate-only",
+        action="store_true",
+        help="Only calibrate and report the accuracy vs calls trade-off",
+    )
+    parser.add_argument(
+        "--no-reason",
+        action="store_true",
+        help="Use the no-reason prompts (create_jsonl_dataset.py --no-reason)",
+    )
+    parser.add_argument(
+        "--samples",
+        type=int,
+        default=1,
+        help="Samples per term; above 1 the vote margin is used as confidence",
+    )
+    parser.add_argument(
+        "--agree",
+        type=int,
+        default=None,
+        help="Matching samples that settle a term early (default: a majority of --samples)",
+    )
+    parser.add_argument(
+        "--max-concurrent",
+        type=int,
+        default=MAX_CONCURRENT,
+        help="Maximum requests in flight per model",
+    )
+    add_engine_arguments(parser, None)
+    args = parser.parse_args()
+    check_sample_arguments(parser, args)
+
+    models = [m.strip() for m in args.models.split(",")]
+    for model in models:
+        if model not in PROVIDERS:
+            parser.error(f"Invalid model: {model}. Available models are: {', '.join(PROVIDERS)}")
+    datasets_to_process = AVAILABLE_DATASETS if args.dataset == "all" else [args.dataset]
+    engines = {model: engine_from_args(model, args.max_concurrent, args) for model in models}
+    asyncio.run(main_async(datasets_to_process, models, engines, args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,236 @@
+"""
+Record provider calls to a cassette and replay them offline.
+
+Every runner that builds its engine with providers.engine_from_args takes
+the options:
+
+    --record calls.jsonl.gz      call the provider and append every call to the cassette
+    --replay calls.jsonl.gz      answer from the cassette, with no network and no API keys
+                                 (comma-separate several, e.g. one per sharded worker)
+    --replay-speed 0.5           replayed calls take half their recorded time (0: none)
+
+A cassette is a JSONL file, gzipped when its name ends in .gz. Each line
+holds one call: the request key (model, response model, call arguments
+and messages, as the engine hashes them), the parsed response or the
+error, and how long the call took. Calls are appended as they finish, so
+the engines of several models in one process can record into one
+cassette; give each worker process of a sharded run its own. A cassette
+stays open while it is recorded and every call is flushed to it, so the
+calls of a killed run can still be replayed.
+
+Replay sleeps for the recorded time in the engine's call thread, so a
+replayed run has the concurrency, latency distribution, failures and
+response shapes of the recorded one. Requests recorded several times
+(self-consistency samples, hedges) are answered with their recordings in
+turn. A request that was never recorded fails like a provider error.
+
+    python cassette.py info calls.jsonl.gz
+"""
+
+import argparse
+import atexit
+import gzip
+import threading
+import time
+from collections import defaultdict
+from functools import lru_cache
+from pathlib import Path
+from typing import Any, Callable, Dict, List
+
+from codec import codec as json_codec
+from codec import dumps_line, gc_paused
+from engine import request_key
+
+# Locks of the cassettes being recorded, by path; engines of one process share them
+RECORD_LOCKS: Dict[str, threading.Lock] = defaultdict(threading.Lock)
+# Open writers of the cassettes being recorded, by path, closed at exit
+RECORD_FILES: Dict[str, Any] = {}
+
+
+class CassetteMiss(KeyError):
+    """A replayed request that the cassette has no recording of."""
+
+
+class RecordedError(RuntimeError):
+    """A provider error replayed from the cassette."""
+
+
+def call_key(model, response_model, messages, kwargs) -> str:
+    """Key of one provider call: everything that decides its response."""
+    return request_key(messages, response_model, {"model": model, **kwargs})
+
+
+def open_cassette(path, mode: str):
+    """Open a cassette as bytes, through gzip when its name ends in .gz."""
+    return gzip.open(path, mode) if str(path).endswith(".gz") else open(path, mode)
+
+
+def read_cassette(path) -> List[Dict[str, Any]]:
+    """Every call recorded in a cassette, in recording order, up to the last flushed call of an unfinished one."""
+    entries = []
+    with open_cassette(path, "rb") as f, gc_paused():
+        try:
+            for line in f:
+                if line.endswith(b"\n"):
+                    entries.append(json_codec.loads(line))
+        except EOFError:
+            # Recording still running or killed: the gzip stream has no end marker yet
+            pass
+    return entries
+
+
+def record_writer(path: str):
+    """Writer of a cassette, opened once per process; call with RECORD_LOCKS[path] held."""
+    if path not in RECORD_FILES:
+        RECORD_FILES[path] = open_cassette(path, "ab")
+    return RECORD_FILES[path]
+
+
+@atexit.register
+def close_recordings():
+    """Close the cassettes being recorded, ending their gzip members."""
+    for path, f in list(RECORD_FILES.items()):
+        with RECORD_LOCKS[path]:
+            f.close()
+            del RECORD_FILES[path]
+
+
+def recording_create(create: Callable[..., Any], path) -> Callable[..., Any]:
+    """
+    Wrap a provider's create call so that every call is appended to a cassette.
+
+    Args:
+        create: Blocking create(model, response_model, messages, **kwargs)
+        path: Cassette to append to
+
+    Returns:
+        Create call with the same signature and results
+    """
+    path = str(path)
+
+    def record(entry):
+        with RECORD_LOCKS[path]:
+            f = record_writer(path)
+            f.write(dumps_line(entry))
+            f.flush()
+
+    def call(model, response_model, messages, **kwargs):
+        entry = {"key": call_key(model, response_model, messages, kwargs), "model": model,
+                 "response_model": response_model.__name__}
+        started = time.monotonic()
+        try:
+            result = create(model=model, response_model=response_model, messages=messages, **kwargs)
+        except Exception as e:
+            record({**entry, "seconds": round(time.monotonic() - started, 4),
+                    "error": f"{type(e).__name__}: {e}"})
+            raise
+        record({**entry, "seconds": round(time.monotonic() - started, 4),
+                "response": result.model_dump(mode="json")})
+        return result
+
+    return call
+
+
+class Replay:
+    """Recorded calls of cassettes, handed out in recording order per request."""
+
+    def __init__(self, paths: str):
+        """
+        Load the cassettes.
+
+        Args:
+            paths: Comma-separated cassette paths
+        """
+        self.path = paths
+        self.calls: Dict[str, List[Dict[str, Any]]] = defaultdict(list)
+        for path in paths.split(","):
+            for entry in read_cassette(path.strip()):
+                self.calls[entry["key"]].append(entry)
+        self.next_call: Dict[str, int] = defaultdict(int)
+        self.lock = threading.Lock()
+        self.misses = 0
+
+    def take(self, key: str) -> Dict[str, Any]:
+        """Next recording of a request, starting over once all have been used."""
+        with self.lock:
+            recorded = self.calls.get(key)
+            if not recorded:
+                self.misses += 1
+                raise CassetteMiss(f"No recorded call for this request in {self.path}")
+            position = self.next_call[key]
+            self.next_call[key] = position + 1
+            return recorded[position % len(recorded)]
+
+
+@lru_cache(maxsize=None)
+def load_replay(paths: str) -> Replay:
+    """Load cassettes once per process, however many engines replay them."""
+    return Replay(paths)
+
+
+def replay_create(paths: str, speed: float = 1.0) -> Callable[..., Any]:
+    """
+    Create call that answers from cassettes.
+
+    Args:
+        paths: Comma-separated cassettes to replay
+        speed: Factor on the recorded call times, 0 to answer at once
+
+    Returns:
+        Blocking create(model, response_model, messages, **kwargs)
+    """
+    replay = load_replay(str(paths))
+
+    def call(model, response_model, messages, **kwargs):
+        entry = replay.take(call_key(model, response_model, messages, kwargs))
+        if speed > 0:
+            time.sleep(entry["seconds"] * speed)
+        if "error" in entry:
+            raise RecordedError(entry["error"])
+        return response_model.model_validate(entry["response"])
+
+    return call
+
+
+def summarize(entries: List[Dict[str, Any]]) -> Dict[str, Dict[str, Any]]:
+    """
+    Calls, distinct requests, errors and latency percentiles per model.
+
+    Returns:
+        Model -> summary
+    """
+    by_model = defaultdict(list)
+    for entry in entries:
+        by_model[entry["model"]].append(entry)
+    summary = {}
+    for model, calls in sorted(by_model.items()):
+        seconds = sorted(call["seconds"] for call in calls)
+        summary[model] = {
+            "calls": len(calls),
+            "requests": len({call["key"] for call in calls}),
+            "errors": sum("error" in call for call in calls),
+            "p50_seconds": seconds[len(seconds) // 2],
+            "p95_seconds": seconds[min(len(seconds) - 1, int(len(seconds) * 0.95))],
+            "max_seconds": seconds[-1],
+            "total_seconds": round(sum(seconds), 1),
+        }
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Inspect a cassette of recorded provider calls.")
+    parser.add_argument("action", choices=["info"])
+    parser.add_argument("cassette", help="Cassette written with --record")
+    args = parser.parse_args()
+
+    entries = read_cassette(args.cassette)
+    size = Path(args.cassette).stat().st_size
+    print(f"{args.cassette}: {len(entries)} calls, {size / 1_000_000:.2f} MB")
+    print(f"{'model':<28} {'calls':>7} {'requests':>9} {'errors':>7} {'p50 s':>7} {'p95 s':>7} {'max s':>7}")
+    for model, row in summarize(entries).items():
+        print(f"{model:<28} {row['calls']:>7} {row['requests']:>9} {row['errors']:>7} "
+              f"{row['p50_seconds']:>7.2f} {row['p95_seconds']:>7.2f} {row['max_seconds']:>7.2f}")
+
+
+if __name__ == "__main__":
+    main()
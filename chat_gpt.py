@@ -1,27 +1,68 @@
 import argparse
-from dotenv import load_dotenv
 from pathlib import Path
-from openai import OpenAI
 import os
-import instructor
-from pydantic import BaseModel
-import json
-from tqdm import tqdm
+from tqdm.asyncio import tqdm as tqdm_asyncio
+import asyncio
 
-load_dotenv()
-api_key = os.environ["OPEN_AI_API_KEY"] 
+from codec import read_jsonl, write_json
+from consistency import check_sample_arguments, sample_until_agreed
+from ledger import ShardLedger, add_shard_arguments, input_hash, run_sharded
+from providers import add_engine_arguments, engine_from_args
+from registry import AVAILABLE_DATASETS
+from runstore import RunStore, add_store_arguments
+from schemas import build_response_model
 
-AVAILABLE_DATASETS = ["MatOnto", "OBI", "SWEET"]
 OUTPUT_DIR = Path("processed_datasets")
 RESULT_DIR = Path("results")
 MODEL_NAME = "gpt-4o"
+# Adjust max_concurrent to match your rate limit
+MAX_CONCURRENT = 1
 
-client = instructor.from_openai(OpenAI(api_key=api_key))
+async def type_item(engine, item, response_model, samples, agree):
+    result, votes = await sample_until_agreed(engine, item, response_model, samples, agree)
+    # Vote records are only kept when self-consistency sampling is on
+    return {**result.model_dump(), **votes} if samples > 1 else result.model_dump()
 
-class TermTyping(BaseModel):
-    id: str
-    types: list[str]
-    reason: str
+async def process_dataset(dataset_name, engine, args):
+    response_model = build_response_model(dataset_name, with_reason=not args.no_reason)
+    test_suffix = "_no_reason_test" if args.no_reason else "_test"
+    filename = OUTPUT_DIR.joinpath(MODEL_NAME).joinpath(f"{dataset_name.lower()}{test_suffix}.jsonl")
+    data = read_jsonl(filename)
+
+    print(f"Processing {dataset_name} with {MODEL_NAME}...")
+
+    def run_item(item):
+        return type_item(engine, item, response_model, args.samples, args.agree)
+
+    if args.shards:
+        ledger = ShardLedger(args.ledger, f"{MODEL_NAME}/{filename.stem}", args.shards, args.stale_after,
+                             source=input_hash(filename))
+        formatted_results = await run_sharded(ledger, data, run_item, f"Processing {dataset_name}")
+        if formatted_results is None:
+            print(f"Other workers are still on {dataset_name}; the last one to finish saves the results")
+            return
+    else:
+        tasks = [run_item(item) for item in data]
+        formatted_results = []
+
+        for fut in tqdm_asyncio.as_completed(tasks, desc=f"Processing {dataset_name}", total=len(tasks)):
+            result = await fut
+            formatted_results.append(result)
+
+    result_filename = RESULT_DIR.joinpath(MODEL_NAME).joinpath(f"{dataset_name.lower()}_results.json")
+    os.makedirs(result_filename.parent, exist_ok=True)
+    if args.samples > 1 and formatted_results:
+        print(f"Average calls per term: {sum(r['samples'] for r in formatted_results) / len(formatted_results):.2f}")
+    write_json(result_filename, formatted_results)
+    if args.store:
+        with RunStore(args.store) as store:
+            store.record_requests(dataset_name, MODEL_NAME, "typing", data)
+            store.record_predictions(dataset_name, MODEL_NAME, formatted_results)
+
+async def main_async(datasets_to_process, engine, args):
+    for dataset_name in datasets_to_process:
+        await process_dataset(dataset_name, engine, args)
+    engine.report()
 
 def main():
     parser = argparse.ArgumentParser()
@@ -31,35 +72,33 @@ def main():
         choices=AVAILABLE_DATASETS + ["all"],
         help="Dataset to process or 'all' to process all datasets",
     )
+    parser.add_argument(
+        "--no-reason",
+        action="store_true",
+        help="Request only id and types (prompts built with create_jsonl_dataset.py --no-reason)",
+    )
+    parser.add_argument(
+        "--samples",
+        type=int,
+        default=1,
+        help="Maximum samples per term for self-consistency voting",
+    )
+    parser.add_argument(
+        "--agree",
+        type=int,
+        default=None,
+        help="Matching samples that settle a term early (default: a majority of --samples)",
+    )
+    add_engine_arguments(parser, MODEL_NAME)
+    add_shard_arguments(parser)
+    add_store_arguments(parser)
 
     args = parser.parse_args()
+    check_sample_arguments(parser, args)
 
     datasets_to_process = AVAILABLE_DATASETS if args.dataset == "all" else [args.dataset]
-
-    for dataset_name in datasets_to_process:
-        filename = OUTPUT_DIR.joinpath(MODEL_NAME).joinpath(f"{dataset_name.lower()}_test.jsonl")
-        data = []
-        with open(filename) as f:
-            for line in f:
-                data.append(json.loads(line))
-        
-        print(f"Processing {dataset_name} with {MODEL_NAME}...")
-
-        results = []
-        for item in tqdm(data, desc=f"Processing {dataset_name}"):
-            # Process each item here
-            result = client.chat.completions.create(
-                model=MODEL_NAME,
-                response_model=TermTyping,
-                messages=item,
-            )
-            results.append(result)
-
-        result_filename = RESULT_DIR.joinpath(MODEL_NAME).joinpath(f"{dataset_name.lower()}_results.json")
-        os.makedirs(result_filename.parent, exist_ok=True)
-        formatted_results = [{"id": result.id, "types": result.types, "reason": result.reason} for result in results]
-        with open(result_filename, 'w') as f:
-            json.dump(formatted_results, f, indent=2)
+    engine = engine_from_args(MODEL_NAME, MAX_CONCURRENT, args)
+    asyncio.run(main_async(datasets_to_process, engine, args))
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
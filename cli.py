@@ -0,0 +1,102 @@
+"""
+One entry point for every stage of the pipeline.
+
+    python cli.py typing gpt-4o OBI --samples 3
+    python cli.py judge gemini-2.5-pro all
+    python cli.py reason claude-sonnet-4-20250514 SWEET
+    python cli.py plan all --stage judge
+    python cli.py store export results --output results
+
+The command's script is only loaded once it has been chosen, so listing
+the commands imports nothing beyond the standard library. Each script
+keeps its own arguments; everything after the command (and the model, for
+per-model stages) is passed on to it unchanged.
+"""
+
+import os
+import runpy
+import sys
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent
+
+# Per-model stages: one script per model, in the folder the script expects to run from
+MODEL_SCRIPTS = {
+    "gpt-4o": "chat_gpt.py",
+    "deepseek-chat": "deepseek.py",
+    "claude-sonnet-4-20250514": "claude.py",
+    "gemini-2.5-pro": "gemini.py",
+}
+MODEL_STAGES = {
+    "typing": (ROOT, "Type the terms of a dataset with one model"),
+    "judge": (ROOT / "judge", "Judge the prepared reasoner opinions with one model"),
+    "reason": (ROOT / "get_reason", "Regenerate missing reasons with one model"),
+}
+COMMANDS = {
+    "prepare": ("create_jsonl_dataset.py", "Build the first-pass prompts"),
+    "prepare-judge": ("create_jsonl_dataset_judge.py", "Build the judge inputs from the reasoner results"),
+    "pipeline": ("pipeline.py", "Run reasoners and judge item by item"),
+    "cascade": ("cascade.py", "Run the confidence-gated model cascade"),
+    "service": ("service.py", "Serve term typing over HTTP with micro-batching"),
+    "sample": ("sample_eval.py", "Score the current prompts on a stratified train sample"),
+    "sweep": ("sweep.py", "Compare prompt variants across models and datasets"),
+    "plan": ("plan.py", "Estimate tokens, time and spend of a run"),
+    "join": ("join_results_with_datasets.py", "Write need_reason_data from the results"),
+    "store": ("runstore.py", "Import, query and export the SQLite run store"),
+    "ledger": ("ledger.py", "Inspect or merge a sharded run"),
+    "cassette": ("cassette.py", "Inspect a cassette of recorded provider calls"),
+    "normalize": ("normalize_labels.py", "Snap predicted types to valid labels"),
+}
+
+
+def usage():
+    """Text listing every command."""
+    lines = ["usage: python cli.py <command> [<model>] [arguments]", "", "per-model commands:"]
+    for stage, (_, help_text) in MODEL_STAGES.items():
+        lines.append(f"  {stage:<15}{help_text}")
+    lines.append(f"  {'':<15}models: {', '.join(MODEL_SCRIPTS)}")
+    lines.append("")
+    lines.append("commands:")
+    for command, (_, help_text) in COMMANDS.items():
+        lines.append(f"  {command:<15}{help_text}")
+    lines.append("")
+    lines.append("Run 'python cli.py <command> [<model>] --help' for the arguments of a command.")
+    return "\n".join(lines)
+
+
+def resolve(argv):
+    """
+    Find the script of a command line.
+
+    Args:
+        argv: Arguments after cli.py
+
+    Returns:
+        Tuple of (script path, directory to run it from, arguments for the script)
+    """
+    command, rest = argv[0], argv[1:]
+    if command in MODEL_STAGES:
+        if not rest or rest[0] not in MODEL_SCRIPTS:
+            raise SystemExit(f"cli.py {command}: choose a model: {', '.join(MODEL_SCRIPTS)}")
+        folder = MODEL_STAGES[command][0]
+        return folder / MODEL_SCRIPTS[rest[0]], folder, rest[1:]
+    if command in COMMANDS:
+        return ROOT / COMMANDS[command][0], ROOT, rest
+    raise SystemExit(f"cli.py: unknown command '{command}'\n\n{usage()}")
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if not argv or argv[0] in ("-h", "--help"):
+        print(usage())
+        return
+    script, folder, args = resolve(argv)
+    # judge/ and get_reason/ use paths relative to their own folder
+    os.chdir(folder)
+    sys.path.insert(0, str(script.parent))
+    sys.argv = [str(script)] + args
+    runpy.run_path(str(script), run_name="__main__")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+"""
+Self-consistency voting over repeated samples of the same prompt.
+
+Samples are drawn in small rounds and voting stops as soon as the result
+is settled: once one answer has the required number of votes, or once no
+answer can reach it any more. With agreeing samples a term costs only as
+many calls as the majority needs, e.g. 2 of 3.
+
+Repeated samples are sent with coalesce=False, since the engine would
+otherwise merge the identical requests of one round into a single call. A
+single sample is an ordinary request and is coalesced like any other, so
+duplicate terms still share one call.
+"""
+
+import asyncio
+from collections import Counter
+from typing import Any, Dict, Optional, Tuple
+
+
+def majority(samples: int) -> int:
+    """Smallest number of votes that is a strict majority of samples."""
+    return samples // 2 + 1
+
+
+def check_sample_arguments(parser, args):
+    """Exit with a usage error unless --samples and --agree describe a possible vote."""
+    if args.samples < 1:
+        parser.error(f"--samples must be at least 1, got {args.samples}")
+    if args.agree is not None and not 1 <= args.agree <= args.samples:
+        parser.error(f"--agree must be between 1 and --samples ({args.samples}), got {args.agree}")
+
+
+def vote_key(result) -> Tuple[str, ...]:
+    """Answer a sample votes for: its set of predicted types."""
+    return tuple(sorted(result.types))
+
+
+async def sample_until_agreed(engine, messages, response_model, samples: int,
+                              agree: Optional[int] = None, **kwargs) -> Tuple[Any, Dict[str, Any]]:
+    """
+    Sample a prompt until enough answers agree.
+
+    Each round draws just the number of samples the leading answer still
+    needs, so no call is spent once the vote is decided.
+
+    Args:
+        engine: Engine the samples are sent through
+        messages: Chat messages of the item
+        response_model: Model the response is parsed into
+        samples: Maximum number of samples
+        agree: Votes needed to stop early, a majority of samples by default
+        **kwargs: Extra arguments for each call
+
+    Returns:
+        Tuple of (first sample of the winning answer, vote record with the
+        number of samples drawn, votes of the winner and the vote margin)
+    """
+    agree = min(agree or majority(samples), samples)
+    votes = Counter()
+    first = {}
+    drawn = 0
+    error = None
+
+    while True:
+        top = votes.most_common(1)[0][1] if votes else 0
+        remaining = samples - drawn
+        if top >= agree or top + remaining < agree:
+            break
+        batch = min(agree - top, remaining)
+        outcomes = await asyncio.gather(
+            *[engine.submit(messages, response_model, coalesce=samples == 1, **kwargs) for _ in range(batch)],
+            return_exceptions=True,
+        )
+        drawn += batch
+        for outcome in outcomes:
+            if isinstance(outcome, Exception):
+                # A failed sample is spent but casts no vote
+                error = outcome
+                continue
+            key = vote_key(outcome)
+            votes[key] += 1
+            first.setdefault(key, outcome)
+
+    if not votes:
+        raise error
+
+    ranked = votes.most_common(2)
+    winner, top = ranked[0]
+    runner_up = ranked[1][1] if len(ranked) > 1 else 0
+    return first[winner], {
+        "samples": drawn,
+        "votes": top,
+        # Share of the samples by which the winner leads, used as confidence
+        "vote_margin": round((top - runner_up) / drawn, 3),
+    }
@@ -1,11 +1,14 @@
-import jsonlines
 import json
 import argparse
 import os
+import re
 import logging
 from pathlib import Path
 from typing import Dict, List, Any, Optional, Union, Tuple
 
+from codec import write_jsonl
+from registry import AVAILABLE_DATASETS, load_dataset
+
 # Configure logging
 logging.basicConfig(
     level=logging.INFO,
@@ -16,24 +19,40 @@ logger = logging.getLogger(__name__)
 
 # Constants
 DATASETS_DIR = Path("datasets")
-AVAILABLE_DATASETS = ["MatOnto", "OBI", "SWEET"]
 OUTPUT_DIR = Path("processed_datasets")
 MODELS = ["gpt-4o", "claude-sonnet-4-20250514", "gemini-2.5-pro", "deepseek-chat"]
+# Trailing sentence of prompt.json asking for a free-text reason; dropped in no-reason mode
+REASON_INSTRUCTION_PATTERN = re.compile(r"\s*Additionally, provide a brief reason[^\n]*")
+
+
+def strip_reason_instruction(prompt: str) -> str:
+    """
+    Remove the request for a free-text reason from a prompt.
+
+    Args:
+        prompt: Prompt template loaded from prompt.json
+
+    Returns:
+        Prompt that only asks for the predicted types
+    """
+    return REASON_INSTRUCTION_PATTERN.sub("", prompt)
 
 
 class DatasetProcessor:
     """Process ontology datasets and convert them to JSONL format."""
 
-    def __init__(self, dataset_name: str, model_name: str, output_dir: Path = OUTPUT_DIR):
+    def __init__(self, dataset_name: str, model_name: str, output_dir: Path = OUTPUT_DIR, no_reason: bool = False):
         """
         Initialize the dataset processor.
 
         Args:
             dataset_name: Name of the dataset to process
             output_dir: Directory to save processed files
+            no_reason: Build prompts that ask for types only, without a reason
         """
         self.dataset_name = dataset_name
         self.model_name = model_name
+        self.no_reason = no_reason
         self.output_dir = output_dir.joinpath(model_name)
         self.dataset_path = DATASETS_DIR / dataset_name
 
@@ -75,8 +94,7 @@ class DatasetProcessor:
             output_path: Path where to save the JSONL file
         """
         try:
-            with jsonlines.open(output_path, mode="w") as writer:
-                writer.write_all(data)
+            write_jsonl(output_path, data)
             logger.info(f"Successfully saved {len(data)} records to {output_path}")
         except Exception as e:
             logger.error(f"Error saving to {output_path}: {e}")
@@ -130,12 +148,12 @@ class DatasetProcessor:
             data: Raw data from the JSON file
 
         Returns:
-            List of unique labels
+            Sorted list of unique labels, so prompts are the same on every run
         """
         labels = set()
         for item in data:
             labels.add(item["types"][0])
-        return list(labels)
+        return sorted(labels)
 
     def process_dataset(self) -> Tuple[Path, Path]:
         """
@@ -144,24 +162,23 @@ class DatasetProcessor:
         Returns:
             Tuple containing paths to the processed train and test JSONL files
         """
-        # Load prompt data
-        prompt_file = self.dataset_path / "prompt.json"
-        prompt = self.load_json_file(prompt_file)["prompt"]
-
-        # Process train data
-        train_file = self.dataset_path / "train" / "term_typing_train_data.json"
-        train_data = self.load_json_file(train_file)
-        labels = self.get_labels(train_data)
+        # Parsed train and test data, sorted labels and prompt templates, cached by the registry
+        dataset = load_dataset(self.dataset_name)
+        prompt = dataset.templates["typing"]
+        if self.no_reason:
+            prompt = strip_reason_instruction(prompt)
 
-        # Process test data
-        test_file_name = f"{self.dataset_name.lower()}_term_typing_test_data.json"
-        test_file = self.dataset_path / "test" / test_file_name
-        test_data = self.load_json_file(test_file)
+        train_data = dataset.train
+        labels = list(dataset.labels)
+        test_data = dataset.test
 
         processed_test_data = self.prepare_dataset(train_data, test_data, labels, prompt)
 
         # train_output = self.output_dir / f"{self.dataset_name.lower()}_train.jsonl"
-        test_output = self.output_dir / f"{self.dataset_name.lower()}_test.jsonl"
+        if self.no_reason:
+            test_output = self.output_dir / f"{self.dataset_name.lower()}_no_reason_test.jsonl"
+        else:
+            test_output = self.output_dir / f"{self.dataset_name.lower()}_test.jsonl"
         # self.save_jsonl(train_data, train_output)
         self.save_jsonl(processed_test_data, test_output)
 
@@ -189,6 +206,11 @@ def main():
         "--model",
         default=MODELS + ["all"]
     )
+    parser.add_argument(
+        "--no-reason",
+        action="store_true",
+        help="Ask only for types; reasons are generated later for contested items via get_reason/",
+    )
 
     args = parser.parse_args()
     output_dir = Path(args.output)
@@ -200,7 +222,7 @@ def main():
     for dataset_name in datasets_to_process:
         for model_name in models_to_process:
             try:
-                processor = DatasetProcessor(dataset_name, model_name, output_dir)
+                processor = DatasetProcessor(dataset_name, model_name, output_dir, args.no_reason)
                 test_path = processor.process_dataset()
                 logger.info(
                     f"Processed {dataset_name}: Test data saved to {test_path}, For {model_name}"
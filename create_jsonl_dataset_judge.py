@@ -1,11 +1,18 @@
-import jsonlines
 import json
+import itertools
 import argparse
 import os
 import logging
 from pathlib import Path
 from typing import Dict, List, Any, Optional, Union, Tuple
 
+from codec import JsonlWriter, write_jsonl
+from providers import PROVIDERS
+from reason_utils import is_usable_reason
+from registry import AVAILABLE_DATASETS, load_dataset
+from runstore import RunStore
+from tokens import CHARS_PER_TOKEN, estimate_tokens, trim_to_tokens
+
 # Configure logging
 logging.basicConfig(
     level=logging.INFO,
@@ -17,28 +24,45 @@ logger = logging.getLogger(__name__)
 # Constants
 DATASETS_DIR = Path("datasets")
 RESULT_DIR = Path("results")
-AVAILABLE_DATASETS = ["MatOnto", "OBI", "SWEET"]
+# Reasons regenerated by get_reason/ for results produced in no-reason mode
+REASON_DIR = Path("result_with_reason")
 OUTPUT_DIR = Path("processed_datasets_judge")
 MODELS = ["gpt-4o", "claude-sonnet-4-20250514", "gemini-2.5-pro", "deepseek-chat"]
+# Estimated tokens allowed for the reasoner opinions in one judge item
+DEFAULT_TOKEN_BUDGET = 300
+# Opinion group of a reasoner that returned no types
+NO_TYPE = "(none)"
 
 
 class DatasetProcessor:
     """Process ontology datasets and convert them to JSONL format."""
 
-    def __init__(self, dataset_name: str, model_name: str, reasoners, output_dir: Path = OUTPUT_DIR):
+    def __init__(self, dataset_name: str, model_name: str, reasoners, output_dir: Path = OUTPUT_DIR,
+                 skip_consensus: bool = False, token_budget: Optional[int] = DEFAULT_TOKEN_BUDGET,
+                 result_dir: Path = RESULT_DIR, store: Optional[RunStore] = None):
         """
         Initialize the dataset processor.
 
         Args:
             dataset_name: Name of the dataset to process
             output_dir: Directory to save processed files
+            skip_consensus: Keep items where all reasoners agree out of the judge input
+            token_budget: Estimated tokens allowed for the opinions of one item, None for no limit
+            result_dir: Directory with the reasoner results, e.g. results_cascade for escalated items
+            store: Run store to read the reasoner results from instead of result_dir
         """
         self.dataset_name = dataset_name
         self.model_name = model_name
         self.output_dir = output_dir.joinpath(dataset_name.lower()).joinpath(model_name)
         self.dataset_path = DATASETS_DIR / dataset_name
-        self.result_path = RESULT_DIR
+        self.result_path = result_dir
+        self.store = store
         self.reasoners = reasoners
+        self.skip_consensus = skip_consensus
+        self.token_budget = token_budget
+        # The budget is counted with the judge's own tokenizer approximation
+        self.chars_per_token = PROVIDERS.get(model_name, {}).get("chars_per_token", CHARS_PER_TOKEN)
+        self.consensus_data = []
 
         # Ensure output directory exists
         os.makedirs(self.output_dir, exist_ok=True)
@@ -78,8 +102,7 @@ class DatasetProcessor:
             output_path: Path where to save the JSONL file
         """
         try:
-            with jsonlines.open(output_path, mode="w") as writer:
-                writer.write_all(data)
+            write_jsonl(output_path, data)
             logger.info(f"Successfully saved {len(data)} records to {output_path}")
         except Exception as e:
             logger.error(f"Error saving to {output_path}: {e}")
@@ -95,9 +118,7 @@ class DatasetProcessor:
         Returns:
             List of dictionaries ready for batch processing with JSONL format
         """
-        num_labels = len(labels)
-        system_prompt = prompt.replace("[NUM_LABELS]", str(num_labels))
-        system_prompt = system_prompt.replace("[LABELS]", "- " + ("\n- ".join(labels)))
+        system_prompt = self.build_system_prompt(labels, prompt)
 
         prepared_data = []
         for item in test_data:
@@ -107,32 +128,156 @@ class DatasetProcessor:
             if any(item_id not in result_data[model] for model in models):
                 logger.warning(f"Skipping item {item_id} as it's missing predictions from some models")
                 continue
-                
-            model_predictions = []
-            for model in models:
-                prediction = result_data[model][item_id]
-                model_predictions.append(f"{model} prediction:\nType: {prediction['types'][0]}\nReason: {prediction['reason']}")
-            
-            # Format the user prompt with the term from the test data
-            user_content = f"id: {item['id']}\nterm: {item['term']}\n"
-            user_content += "\n\n".join(model_predictions)
-                
-            batch_item = [
-                {
-                    "role": "system",
-                    "content": system_prompt
-                },
-                {
-                    "role": "user",
-                    "content": user_content
-                }
-            ]
-            
-            
-            prepared_data.append(batch_item)
+
+            batch_item = self.build_item(item, result_data, models, system_prompt)
+            if batch_item is not None:
+                prepared_data.append(batch_item)
 
         return prepared_data
+
+    def build_system_prompt(self, labels, prompt) -> str:
+        """
+        Fill the judge prompt template with the dataset labels.
+
+        Args:
+            labels: Labels of the dataset
+            prompt: Template loaded from prompt_judge.json
+
+        Returns:
+            System prompt shared by all judge items
+        """
+        num_labels = len(labels)
+        system_prompt = prompt.replace("[NUM_LABELS]", str(num_labels))
+        return system_prompt.replace("[LABELS]", "- " + ("\n- ".join(labels)))
+
+    def build_item(self, item, result_data, models, system_prompt,
+                   consensus_data: Optional[list] = None) -> Optional[List[Dict[str, str]]]:
+        """
+        Build the judge messages of one item from the reasoner predictions.
+
+        Args:
+            item: Test item with id and term
+            result_data: Predictions per model, keyed by item id, with every model present
+            models: Reasoners to include
+            system_prompt: Output of build_system_prompt
+            consensus_data: List that collects consensus items, self.consensus_data by default
+
+        Returns:
+            Chat messages, or None if the item was settled by consensus
+            (then it is added to consensus_data)
+        """
+        if consensus_data is None:
+            consensus_data = self.consensus_data
+        item_id = item["id"]
+        predicted_types = {tuple(result_data[model][item_id]["types"]) for model in models}
+        if self.skip_consensus and len(predicted_types) == 1:
+            # Nothing to judge: every reasoner gave the same answer
+            consensus_data.append({
+                "id": item_id,
+                "types": result_data[models[0]][item_id]["types"],
+                "reason": f"Consensus of {', '.join(models)}"
+            })
+            return None
+
+        for model in models:
+            if not result_data[model][item_id]["reason"]:
+                logger.warning(f"No reason from {model} for contested item {item_id}; run get_reason/ for it")
+
+        # Format the user prompt with the term from the test data
+        user_content = f"id: {item['id']}\nterm: {item['term']}\n"
+        user_content += self.format_opinions(result_data, item_id, models)
+
+        return [
+            {
+                "role": "system",
+                "content": system_prompt
+            },
+            {
+                "role": "user",
+                "content": user_content
+            }
+        ]
     
+    def format_opinions(self, result_data, item_id, models) -> str:
+        """
+        Render the reasoner predictions for one item, grouped by predicted type.
+
+        Reasoners that predict the same type share one block, and identical
+        reasons are only listed once. Reasons are trimmed so that the whole
+        block stays within the token budget.
+
+        Args:
+            result_data: Predictions per model, keyed by item id
+            item_id: Item to render
+            models: Reasoners to include
+
+        Returns:
+            Opinions text for the user prompt
+        """
+        # type -> {"models": [...], "reasons": {normalised reason: (models, reason)}}
+        groups: Dict[str, Dict[str, Any]] = {}
+        for model in models:
+            prediction = result_data[model][item_id]
+            predicted_type = prediction["types"][0] if prediction["types"] else NO_TYPE
+            group = groups.setdefault(predicted_type, {"models": [], "reasons": {}})
+            group["models"].append(model)
+            reason = prediction["reason"].strip()
+            if reason:
+                key = " ".join(reason.lower().split())
+                group["reasons"].setdefault(key, ([], reason))[0].append(model)
+
+        headers = [
+            f"Type: {predicted_type}\nPredicted by: {', '.join(group['models'])}"
+            for predicted_type, group in groups.items()
+        ]
+        reasons = [list(group["reasons"].values()) for group in groups.values()]
+
+        if self.token_budget is not None:
+            header_tokens = sum(estimate_tokens(header, self.chars_per_token) for header in headers)
+            reason_texts = [reason for group_reasons in reasons for _, reason in group_reasons]
+            limits = iter(self.allocate_budget(reason_texts, self.token_budget - header_tokens))
+            reasons = [
+                [(reason_models, trim_to_tokens(reason, next(limits), self.chars_per_token))
+                 for reason_models, reason in group_reasons]
+                for group_reasons in reasons
+            ]
+
+        blocks = []
+        for header, group_reasons in zip(headers, reasons):
+            lines = [header]
+            for reason_models, reason in group_reasons:
+                if not reason:
+                    # Trimmed away entirely by the budget
+                    continue
+                if len(group_reasons) == 1:
+                    lines.append(f"Reason: {reason}")
+                else:
+                    lines.append(f"Reason ({', '.join(reason_models)}): {reason}")
+            blocks.append("\n".join(lines))
+        return "\n\n".join(blocks)
+
+    def allocate_budget(self, texts: List[str], budget: int) -> List[int]:
+        """
+        Split a token budget across texts so short texts keep their full length.
+
+        Args:
+            texts: Texts sharing the budget
+            budget: Total number of tokens available
+
+        Returns:
+            Token limit for each text, in the same order
+        """
+        costs = [estimate_tokens(text, self.chars_per_token) for text in texts]
+        limits = [0] * len(texts)
+        remaining = max(budget, 0)
+        # Hand out the smallest texts first; the rest split what is left evenly
+        order = sorted(range(len(texts)), key=lambda i: costs[i])
+        for position, index in enumerate(order):
+            share = remaining // (len(order) - position)
+            limits[index] = min(costs[index], share)
+            remaining -= limits[index]
+        return limits
+
     def get_labels(self, data):
         """
         Extract unique labels from the dataset.
@@ -141,48 +286,83 @@ class DatasetProcessor:
             data: Raw data from the JSON file
 
         Returns:
-            List of unique labels
+            Sorted list of unique labels, so prompts are the same on every run
         """
         labels = set()
         for item in data:
             labels.add(item["types"][0])
-        return list(labels)
+        return sorted(labels)
 
-    def process_dataset(self) -> Tuple[Path, Path]:
+    def load_reasons(self, model: str) -> Dict[str, str]:
         """
-        Process train and test files for the selected dataset.
+        Load reasons regenerated by get_reason/ for a reasoner.
+
+        Args:
+            model: Reasoner whose reasons should be loaded
 
         Returns:
-            Tuple containing paths to the processed train and test JSONL files
+            Mapping from item id to reason, empty if nothing was regenerated
         """
-        # Load prompt data
-        prompt_file = self.dataset_path / "prompt_judge.json"
-        prompt = self.load_json_file(prompt_file)["prompt"]
+        reason_file = REASON_DIR / model / f"{self.dataset_name.lower()}_results.json"
+        if not reason_file.exists():
+            return {}
+        return {result["id"]: result["reason"] for result in self.load_json_file(reason_file)}
 
-        # Process train data
-        train_file = self.dataset_path / "train" / "term_typing_train_data.json"
-        train_data = self.load_json_file(train_file)
-        labels = self.get_labels(train_data)
+    def load_inputs(self) -> Tuple[List[str], str, List[Dict[str, Any]]]:
+        """
+        Load the labels, judge prompt template and test items of the dataset.
+
+        Returns:
+            Tuple of (labels, prompt template, test items)
+        """
+        # Cached by the registry, with the labels already sorted
+        dataset = load_dataset(self.dataset_name)
+        return list(dataset.labels), dataset.templates["judge"], dataset.test
 
-        test_file_name = f"{self.dataset_name.lower()}_term_typing_test_data.json"
-        test_file = self.dataset_path / "test" / test_file_name
-        test_data = self.load_json_file(test_file)
+    def load_result_data(self, models) -> Dict[str, Dict[str, Dict[str, str]]]:
+        """
+        Load the predictions of the reasoners, indexed by item id.
 
-        # Process result data
+        Args:
+            models: Reasoners to load
+
+        Returns:
+            Mapping from model to {item id: {"types", "reason"}}
+        """
         result_file_name = f"{self.dataset_name.lower()}_results.json"
 
         result_data = dict()
 
-        for model in self.reasoners:
+        for model in models:
+            if self.store is not None:
+                # Reasons from get_reason/ are already joined in by the query
+                result_data[model] = self.store.results_by_id(self.dataset_name, model)
+                continue
             result_file = self.result_path / model / result_file_name
             model_results = self.load_json_file(result_file)
+            reasons = self.load_reasons(model)
             model_results_dict = dict()
             for result in model_results:
+                reason = result.get("reason")
+                if not is_usable_reason(reason):
+                    # Missing or truncated: prefer the one regenerated by get_reason/
+                    reason = reasons.get(result["id"]) or reason or ""
                 model_results_dict[result["id"]] = {
                     "types": result["types"],
-                    "reason": result["reason"]
+                    "reason": reason
                 }
             result_data[model] = model_results_dict
+        return result_data
+
+    def process_dataset(self) -> Path:
+        """
+        Process train and test files for the selected dataset.
+
+        Returns:
+            Path to the processed test JSONL file
+        """
+        labels, prompt, test_data = self.load_inputs()
+        result_data = self.load_result_data(self.reasoners)
         
         processed_test_data = self.prepare_dataset(result_data, test_data, labels, prompt, self.reasoners)
         
@@ -192,8 +372,66 @@ class DatasetProcessor:
         # self.save_jsonl(train_data, train_output)
         self.save_jsonl(processed_test_data, test_output)
 
+        if self.skip_consensus:
+            self.save_consensus(self.consensus_data, str_reasonsers)
+
         return test_output
 
+    def save_consensus(self, consensus_data, str_reasonsers) -> None:
+        """Save the items settled by consensus; judge runners merge them back into their result file."""
+        consensus_output = self.output_dir / f"{self.dataset_name.lower()}_{str_reasonsers}_consensus.json"
+        with open(consensus_output, "w", encoding="utf-8") as f:
+            json.dump(consensus_data, f, indent=2)
+        logger.info(f"Skipped {len(consensus_data)} consensus items, saved to {consensus_output}")
+
+    def process_combinations(self, size: int) -> List[Path]:
+        """
+        Build the judge inputs of every combination of `size` reasoners in one pass.
+
+        Inputs and every reasoner's results are loaded once, the system
+        prompt is rendered once and shared by all items, and each test item
+        is written to the file of every combination while it is at hand.
+        The files are the same as running process_dataset once per combination.
+
+        Args:
+            size: Number of reasoners per combination, e.g. 3 for C(4,3)
+
+        Returns:
+            Paths of the processed test JSONL files, one per combination
+        """
+        labels, prompt, test_data = self.load_inputs()
+        result_data = self.load_result_data(self.reasoners)
+        system_prompt = self.build_system_prompt(labels, prompt)
+
+        combinations = [list(models) for models in itertools.combinations(self.reasoners, size)]
+        names = ['_'.join(models) for models in combinations]
+        outputs = [self.output_dir / f"{self.dataset_name.lower()}_{name}_test.jsonl" for name in names]
+        consensus = {name: [] for name in names}
+        written = dict.fromkeys(names, 0)
+
+        writers = [JsonlWriter(output) for output in outputs]
+        try:
+            for item in test_data:
+                item_id = item["id"]
+                answered = {model for model in self.reasoners if item_id in result_data[model]}
+                for models, name, writer in zip(combinations, names, writers):
+                    if not answered.issuperset(models):
+                        logger.warning(f"Skipping item {item_id} for {name} as it's missing predictions from some models")
+                        continue
+                    batch_item = self.build_item(item, result_data, models, system_prompt, consensus[name])
+                    if batch_item is not None:
+                        writer.write(batch_item)
+                        written[name] += 1
+        finally:
+            for writer in writers:
+                writer.close()
+
+        for name, output in zip(names, outputs):
+            logger.info(f"Successfully saved {written[name]} records to {output}")
+            if self.skip_consensus:
+                self.save_consensus(consensus[name], name)
+        return outputs
+
 def parse_models(model_list):
     """Parse comma-separated model list and validate against available models"""
     if not model_list:
@@ -235,18 +473,60 @@ def main():
         type=str,
         required=True
     )
+    parser.add_argument(
+        "--token-budget",
+        type=int,
+        default=DEFAULT_TOKEN_BUDGET,
+        help="Estimated tokens allowed for the reasoner opinions of one item, 0 for no limit",
+    )
+    parser.add_argument(
+        "--skip-consensus",
+        action="store_true",
+        help="Do not send items to the judge when all reasoners agree",
+    )
+
+    parser.add_argument(
+        "--results-dir",
+        default=str(RESULT_DIR),
+        help="Directory with the reasoner results (results_cascade to judge only escalated terms)",
+    )
+
+    parser.add_argument(
+        "--store",
+        default=None,
+        help="Read the reasoner results from this SQLite run store instead of --results-dir",
+    )
+
+    parser.add_argument(
+        "--combinations",
+        type=int,
+        default=None,
+        help="Build one judge input per combination of this many --reasoner models, in a single pass",
+    )
 
     args = parser.parse_args()
     output_dir = Path(args.output)
+    store = RunStore(args.store) if args.store else None
 
     # Process selected dataset(s)
     datasets_to_process = AVAILABLE_DATASETS if args.dataset == "all" else [args.dataset]
     models_to_process = args.judge
     reasoners = parse_models(args.reasoner)
+    if args.combinations is not None and not 1 <= args.combinations <= len(reasoners):
+        parser.error(f"--combinations must be between 1 and the number of reasoners ({len(reasoners)})")
 
     for dataset_name in datasets_to_process:
         try:
-            processor = DatasetProcessor(dataset_name, models_to_process, reasoners, output_dir)
+            processor = DatasetProcessor(dataset_name, models_to_process, reasoners, output_dir,
+                                         args.skip_consensus, args.token_budget or None, Path(args.results_dir),
+                                         store)
+            if args.combinations:
+                test_paths = processor.process_combinations(args.combinations)
+                logger.info(
+                    f"Processed {dataset_name}: {len(test_paths)} combinations saved to {processor.output_dir}, "
+                    f"For {models_to_process}"
+                )
+                continue
             test_path = processor.process_dataset()
             logger.info(
                 f"Processed {dataset_name}: Test data saved to {test_path}, For {models_to_process}"
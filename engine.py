@@ -0,0 +1,619 @@
+"""
+Shared request engine for the provider runners.
+
+Runners hand every prepared item to Engine.submit instead of calling the
+blocking instructor client from asyncio.to_thread themselves. The engine
+bounds concurrency and hedges stragglers: once a call has been running
+longer than the configured latency percentile of this provider, a
+duplicate is sent and whichever answers first is used.
+
+Each engine also tracks the health of its provider with a circuit
+breaker. While the breaker is open, requests either wait for it to
+half-open or, if a fallback engine is configured, go to that model.
+Without a fallback, once the half-open probe has failed too the provider
+is taken to be down: waiting and new requests fail at once with
+ProviderUnavailable instead of each waiting out its own cooldown, until
+a later probe succeeds.
+
+Requests are spread over a pool of API keys. Every key has its own
+requests-per-minute and tokens-per-minute buckets and breaker, and each call goes to the
+least-loaded (or next round-robin) key that is healthy and has budget.
+
+Waiting requests are started by priority class (re-queued failures,
+then contested items, then the rest) and, within a class, longest
+estimated prompt first, which shortens the tail of a run at the same
+concurrency.
+
+Identical requests in flight at the same time share one provider call.
+Items are compared with their id masked, so two items for the same term
+coalesce and each caller gets the answer under its own id.
+"""
+
+import asyncio
+import hashlib
+import heapq
+import itertools
+import json
+import re
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from functools import partial
+from typing import Any, Callable, Dict, List, Optional
+
+from tokens import CHARS_PER_TOKEN, DEFAULT_OUTPUT_TOKENS, estimate_messages_tokens
+
+# Latencies kept for the online percentile estimate
+LATENCY_WINDOW = 200
+# No hedging until this many calls have completed
+MIN_LATENCY_SAMPLES = 20
+# At most this fraction of requests may be duplicated
+DEFAULT_MAX_HEDGE_FRACTION = 0.1
+# Circuit breaker: outcomes kept, error rate that opens it and how long it stays open
+BREAKER_WINDOW = 20
+BREAKER_MIN_CALLS = 5
+BREAKER_ERROR_RATE = 0.5
+BREAKER_COOLDOWN = 30.0
+# Failed half-open probes after which requests without a fallback stop waiting
+BREAKER_MAX_FAILED_PROBES = 1
+# Calls slower than this count as failures for the breaker
+BREAKER_SLOW_CALL = 120.0
+# Scheduling classes, lowest first
+PRIORITY_RETRY = 0
+PRIORITY_CONTESTED = 1
+PRIORITY_NORMAL = 2
+# Times a failed request is queued again before its error is raised
+MAX_REQUEUES = 1
+# Item id in a user message: "{'id': 'TT_...', ...}", "'id': '...'" or "id: ...\n"
+ITEM_ID_PATTERN = re.compile(r"""\bid['"]?\s*:\s*['"]?([^'"\s,}]+)""")
+
+
+class ProviderUnavailable(RuntimeError):
+    """The breaker is open, its probe failed and there is no fallback model."""
+
+
+def item_id_of(messages: List[Dict[str, str]]) -> Optional[str]:
+    """Return the item id quoted in the last user message, if any."""
+    for message in reversed(messages):
+        if message.get("role") == "user":
+            match = ITEM_ID_PATTERN.search(message.get("content", ""))
+            return match.group(1) if match else None
+    return None
+
+
+def request_key(messages, response_model, kwargs, item_id=None) -> str:
+    """
+    Key under which identical requests are coalesced.
+
+    Args:
+        messages: Chat messages of the item
+        response_model: Model the response is parsed into
+        kwargs: Extra arguments of the call
+        item_id: Id masked out of the messages, so duplicate terms share a key
+
+    Returns:
+        Hex digest of the response model, call arguments and messages
+    """
+    payload = json.dumps([getattr(response_model, "__name__", str(response_model)), kwargs, messages],
+                         sort_keys=True, ensure_ascii=False, default=str)
+    if item_id is not None:
+        payload = payload.replace(item_id, "\0id")
+    return hashlib.sha1(payload.encode("utf-8")).hexdigest()
+
+
+class CircuitBreaker:
+    """Closed / open / half-open breaker over a window of recent call outcomes."""
+
+    def __init__(self, window: int = BREAKER_WINDOW, min_calls: int = BREAKER_MIN_CALLS,
+                 error_rate: float = BREAKER_ERROR_RATE, cooldown: float = BREAKER_COOLDOWN,
+                 slow_call: float = BREAKER_SLOW_CALL):
+        """
+        Initialize the breaker.
+
+        Args:
+            window: Number of recent outcomes considered
+            min_calls: Outcomes needed before the breaker may open
+            error_rate: Failure fraction that opens the breaker
+            cooldown: Seconds the breaker stays open before a probe is allowed
+            slow_call: Latency in seconds above which a successful call counts as a failure
+        """
+        self.outcomes = deque(maxlen=window)
+        self.min_calls = min_calls
+        self.error_rate = error_rate
+        self.cooldown = cooldown
+        self.slow_call = slow_call
+        self.state = "closed"
+        self.opened_at = 0.0
+        self.probing = False
+        self.times_opened = 0
+        # Half-open probes that failed since the breaker last closed
+        self.failed_probes = 0
+
+    def allow(self) -> bool:
+        """Return True if a call may be sent now."""
+        if self.state == "closed":
+            return True
+        if self.state == "open" and time.monotonic() - self.opened_at >= self.cooldown:
+            self.state = "half_open"
+        if self.state == "half_open" and not self.probing:
+            # Exactly one probe goes out; everyone else keeps waiting
+            self.probing = True
+            return True
+        return False
+
+    def retry_in(self) -> float:
+        """Seconds until the breaker may let a probe through."""
+        return max(0.0, self.cooldown - (time.monotonic() - self.opened_at))
+
+    def record(self, ok: bool, latency: float = 0.0):
+        """Record the outcome of a call sent after allow()."""
+        ok = ok and latency <= self.slow_call
+        if self.state == "open":
+            # Late answers from calls sent before the breaker opened
+            return
+        if self.state == "half_open":
+            self.probing = False
+            if ok:
+                self.state = "closed"
+                self.outcomes.clear()
+                self.failed_probes = 0
+            else:
+                self.failed_probes += 1
+                self.trip()
+            return
+        self.outcomes.append(ok)
+        failures = self.outcomes.count(False)
+        if len(self.outcomes) >= self.min_calls and failures / len(self.outcomes) >= self.error_rate:
+            self.trip()
+
+    def end_probe(self):
+        """Let another probe through if the current one ended without recording an outcome."""
+        if self.state == "half_open":
+            self.probing = False
+
+    def down(self) -> bool:
+        """True while the breaker is open and its probes keep failing."""
+        return self.state != "closed" and self.failed_probes >= BREAKER_MAX_FAILED_PROBES
+
+    def trip(self):
+        """Open the breaker."""
+        self.state = "open"
+        self.opened_at = time.monotonic()
+        self.times_opened += 1
+
+
+class TokenBucket:
+    """Per-minute budget of one API key, counted in requests or in tokens."""
+
+    def __init__(self, per_minute: Optional[float]):
+        """
+        Initialize the bucket.
+
+        Args:
+            per_minute: Requests (or tokens) allowed per minute, None for no limit
+        """
+        self.per_minute = per_minute
+        self.capacity = per_minute or 0.0
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def refill(self):
+        """Add the tokens earned since the last refill."""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.capacity / 60)
+        self.updated = now
+
+    def wait_time(self, amount: float = 1.0) -> float:
+        """Seconds until the bucket holds the given amount."""
+        if self.per_minute is None:
+            return 0.0
+        self.refill()
+        # A request larger than a whole minute's budget waits for a full bucket
+        amount = min(amount, self.capacity)
+        return max(0.0, (amount - self.tokens) * 60 / self.capacity)
+
+    def take(self, amount: float = 1.0):
+        """Spend tokens; callers check wait_time first."""
+        if self.per_minute is not None:
+            self.tokens -= amount
+
+
+class ApiKey:
+    """One API key of a provider with its own rate budget and health."""
+
+    def __init__(self, name: str, create: Callable[..., Any], per_minute: Optional[float] = None,
+                 tokens_per_minute: Optional[float] = None):
+        """
+        Initialize the key.
+
+        Args:
+            name: Label used in reports, never the key itself
+            create: Blocking call of a client built with this key
+            per_minute: Requests per minute allowed for this key, None for no limit
+            tokens_per_minute: Estimated tokens per minute allowed for this key, None for no limit
+        """
+        self.name = name
+        self.create = create
+        self.bucket = TokenBucket(per_minute)
+        self.token_bucket = TokenBucket(tokens_per_minute)
+        self.breaker = CircuitBreaker()
+        self.in_flight = 0
+        self.requests = 0
+
+
+class KeyPool:
+    """Load balancer over the API keys of one provider."""
+
+    def __init__(self, keys: List[ApiKey], strategy: str = "least_loaded"):
+        """
+        Initialize the pool.
+
+        Args:
+            keys: Keys to balance over
+            strategy: "least_loaded" or "round_robin"
+        """
+        self.keys = keys
+        self.strategy = strategy
+        self.next_index = 0
+
+    def candidates(self, exclude=None) -> List[ApiKey]:
+        """Keys in the order they should be tried."""
+        count = len(self.keys)
+        rotated = [self.keys[(self.next_index + i) % count] for i in range(count)]
+        if self.strategy == "least_loaded":
+            rotated.sort(key=lambda key: key.in_flight)
+        if exclude is not None and count > 1:
+            # Prefer another key, e.g. for a hedge, but fall back to the excluded one
+            rotated.sort(key=lambda key: key is exclude)
+        return rotated
+
+    async def acquire(self, exclude: Optional[ApiKey] = None, tokens: float = 0.0) -> ApiKey:
+        """
+        Wait for a healthy key with budget and reserve it for one call.
+
+        Args:
+            exclude: Key to avoid if any other key is usable
+            tokens: Estimated input plus output tokens of the call
+
+        Returns:
+            The key to send the call with; release it when the call ends
+        """
+        while True:
+            waits = []
+            for key in self.candidates(exclude):
+                wait = max(key.bucket.wait_time(), key.token_bucket.wait_time(tokens))
+                if wait == 0 and key.breaker.allow():
+                    key.bucket.take()
+                    key.token_bucket.take(tokens)
+                    key.in_flight += 1
+                    key.requests += 1
+                    self.next_index = (self.keys.index(key) + 1) % len(self.keys)
+                    return key
+                waits.append(wait or key.breaker.retry_in())
+            await asyncio.sleep(max(min(waits), 0.05))
+
+    def release(self, key: ApiKey, ok: bool, latency: float = 0.0):
+        """Return a key after its call and record the outcome for its health."""
+        key.in_flight -= 1
+        key.breaker.record(ok, latency)
+
+    def report(self) -> Dict[str, Dict[str, Any]]:
+        """Requests and breaker trips per key."""
+        return {
+            key.name: {"requests": key.requests, "breaker_opened": key.breaker.times_opened}
+            for key in self.keys
+        }
+
+
+class CostScheduler:
+    """Concurrency slots handed out by priority class, then longest estimated request first."""
+
+    def __init__(self, slots: int):
+        """
+        Initialize the scheduler.
+
+        Args:
+            slots: Number of requests that may run at once
+        """
+        self.free = slots
+        # (priority, -cost, arrival, future) of every waiting request
+        self.waiting: List[tuple] = []
+        self.arrivals = itertools.count()
+        self.grant_scheduled = False
+
+    async def acquire(self, priority: int = PRIORITY_NORMAL, cost: int = 0):
+        """Wait for a slot; release() must follow once the request is done."""
+        loop = asyncio.get_running_loop()
+        granted = loop.create_future()
+        heapq.heappush(self.waiting, (priority, -cost, next(self.arrivals), granted))
+        if not self.grant_scheduled:
+            # Deferred so that all requests submitted in the same pass compete
+            self.grant_scheduled = True
+            loop.call_soon(self.grant)
+        try:
+            await granted
+        except asyncio.CancelledError:
+            if granted.done() and not granted.cancelled():
+                # Slot granted just before the caller was cancelled
+                self.release()
+            raise
+
+    def grant(self):
+        """Hand free slots to the most urgent waiting requests."""
+        self.grant_scheduled = False
+        while self.free and self.waiting:
+            granted = heapq.heappop(self.waiting)[-1]
+            if granted.cancelled():
+                continue
+            self.free -= 1
+            granted.set_result(None)
+
+    def release(self):
+        """Return a slot."""
+        self.free += 1
+        self.grant()
+
+
+class Engine:
+    """Run provider calls for one model with bounded concurrency and optional hedging."""
+
+    def __init__(self, create, model_name: str, max_concurrent: int,
+                 hedge_percentile: Optional[float] = None,
+                 max_hedge_fraction: float = DEFAULT_MAX_HEDGE_FRACTION,
+                 fallback: Optional["Engine"] = None, call_kwargs: Optional[Dict[str, Any]] = None,
+                 chars_per_token: float = CHARS_PER_TOKEN):
+        """
+        Initialize the engine.
+
+        Args:
+            create: Blocking call that performs one request, e.g. client.chat.completions.create,
+                or a KeyPool of such calls
+            model_name: Model passed to every call
+            max_concurrent: Maximum number of requests in flight, hedges excluded
+            hedge_percentile: Latency percentile (0-100) after which a duplicate is sent,
+                None to disable hedging
+            max_hedge_fraction: Cap on duplicated requests as a fraction of all requests
+            fallback: Engine for another model that takes requests while the breaker is open
+            call_kwargs: Extra arguments sent with every call of this model, e.g. max_tokens
+            chars_per_token: Tokenizer approximation used for scheduling and the token budget
+        """
+        self.key_pool = create if isinstance(create, KeyPool) else KeyPool([ApiKey("default", create)])
+        self.model_name = model_name
+        self.max_concurrent = max_concurrent
+        self.hedge_percentile = hedge_percentile
+        self.max_hedge_fraction = max_hedge_fraction
+        self.fallback = fallback
+        self.call_kwargs = call_kwargs or {}
+        self.chars_per_token = chars_per_token
+        self.scheduler = CostScheduler(max_concurrent)
+        self.breaker = CircuitBreaker()
+        # Response id -> model that produced it, differs from model_name after a failover
+        self.answered_by: Dict[str, str] = {}
+        self.latencies = deque(maxlen=LATENCY_WINDOW)
+        self.stats = {"requests": 0, "hedges": 0, "hedge_wins": 0, "failovers": 0, "coalesced": 0, "requeued": 0,
+                      "unavailable": 0}
+        # Request key -> task of the call currently running for it
+        self.in_flight: Dict[str, asyncio.Future] = {}
+        # (time the hedge answered, [time the abandoned primary finished]) per hedge win
+        self.abandoned: List[tuple] = []
+
+    def hedge_delay(self) -> Optional[float]:
+        """Return how long to wait before hedging, or None if no hedge may be sent now."""
+        if self.hedge_percentile is None or len(self.latencies) < MIN_LATENCY_SAMPLES:
+            return None
+        if self.stats["hedges"] >= self.max_hedge_fraction * self.stats["requests"]:
+            return None
+        ordered = sorted(self.latencies)
+        position = min(len(ordered) - 1, int(len(ordered) * self.hedge_percentile / 100))
+        return ordered[position]
+
+    async def start_call(self, messages, response_model, kwargs, exclude=None) -> Future:
+        """
+        Start one blocking call in its own daemon thread, on a key from the pool.
+
+        A daemon thread is used rather than a pool so that an abandoned
+        straggler does not keep the process alive once results are written.
+        """
+        call_args = {**self.call_kwargs, **kwargs}
+        # Providers reserve max_tokens of output against the limit, so the budget does too
+        tokens = estimate_messages_tokens(messages, self.chars_per_token) + call_args.get("max_tokens", DEFAULT_OUTPUT_TOKENS)
+        key = await self.key_pool.acquire(exclude, tokens)
+        call = partial(key.create, model=self.model_name, response_model=response_model,
+                       messages=messages, **call_args)
+        future = Future()
+        future.key = key
+        loop = asyncio.get_running_loop()
+
+        def release(ok, latency=0.0):
+            # Key bookkeeping belongs to the event loop thread
+            try:
+                loop.call_soon_threadsafe(self.key_pool.release, key, ok, latency)
+            except RuntimeError:
+                # Loop already closed: an abandoned straggler finished after the run
+                pass
+
+        def run():
+            future.set_running_or_notify_cancel()
+            started = time.monotonic()
+            try:
+                result = call()
+            except BaseException as e:
+                release(False)
+                future.set_exception(e)
+            else:
+                release(True, time.monotonic() - started)
+                future.set_result(result)
+
+        threading.Thread(target=run, daemon=True).start()
+        return future
+
+    async def submit(self, messages: List[Dict[str, str]], response_model, coalesce: bool = True,
+                     priority: int = PRIORITY_NORMAL, **kwargs):
+        """
+        Send one request and return the parsed response.
+
+        Args:
+            messages: Chat messages of the item
+            response_model: Pydantic model the response is parsed into
+            coalesce: Share the call with an identical request already in flight;
+                off for deliberate repeats such as self-consistency samples
+            priority: Scheduling class, e.g. PRIORITY_CONTESTED
+            **kwargs: Extra arguments for the provider call, e.g. max_tokens
+
+        Returns:
+            Parsed response from whichever call answered first
+        """
+        if not coalesce:
+            return await self.dispatch(messages, response_model, kwargs, priority)
+
+        item_id = item_id_of(messages)
+        key = request_key(messages, response_model, kwargs, item_id)
+        shared = self.in_flight.get(key)
+        if shared is None:
+            shared = asyncio.ensure_future(self.dispatch(messages, response_model, kwargs, priority))
+            self.in_flight[key] = shared
+            shared.add_done_callback(lambda _: self.in_flight.pop(key, None))
+        else:
+            self.stats["coalesced"] += 1
+        # Shielded so one cancelled caller does not cancel the call the others wait on
+        result = await asyncio.shield(shared)
+        return self.for_item(result, item_id)
+
+    def for_item(self, result, item_id):
+        """Return a shared response under the id of the caller's item."""
+        if item_id is None or getattr(result, "id", item_id) == item_id:
+            return result
+        self.answered_by[item_id] = self.answered_by.get(result.id, self.model_name)
+        return result.model_copy(update={"id": item_id})
+
+    def record_answer(self, result, model_name):
+        """Note which model answered an item; a multi-term response has no single id."""
+        answered_id = getattr(result, "id", None)
+        if answered_id is not None:
+            self.answered_by[answered_id] = model_name
+
+    async def dispatch(self, messages, response_model, kwargs, priority=PRIORITY_NORMAL):
+        """Send one request through the breaker, or to the fallback while it is open or once retries are spent."""
+        cost = estimate_messages_tokens(messages, self.chars_per_token)
+        requeues = 0
+        holding = False
+        while True:
+            if not holding:
+                await self.scheduler.acquire(priority, cost)
+            holding = False
+            probe = False
+            try:
+                # Checked once a slot is free, so queued requests see the current state
+                if self.breaker.allow():
+                    probe = self.breaker.state == "half_open"
+                    result = await self.send(messages, response_model, kwargs)
+                    self.record_answer(result, self.model_name)
+                    return result
+                if self.fallback is None and self.breaker.down():
+                    self.stats["unavailable"] += 1
+                    raise ProviderUnavailable(f"{self.model_name} is failing and no --failover model is set")
+            except ProviderUnavailable:
+                raise
+            except Exception:
+                if requeues < MAX_REQUEUES:
+                    requeues += 1
+                    self.stats["requeued"] += 1
+                    # A failed request keeps its slot, so it goes ahead of everything still waiting
+                    holding = True
+                    continue
+                if self.fallback is None:
+                    raise
+                # Out of retries on this model: the fallback answers instead, like with an open breaker
+            finally:
+                if probe:
+                    # A cancelled probe records nothing; do not leave the breaker waiting on it
+                    self.breaker.end_probe()
+                if not holding:
+                    self.scheduler.release()
+            # Requests that waited out an open breaker also go first
+            priority = PRIORITY_RETRY
+            if self.fallback is not None:
+                self.stats["failovers"] += 1
+                result = await self.fallback.dispatch(messages, response_model, kwargs, priority)
+                answered_id = getattr(result, "id", None)
+                self.record_answer(result, self.fallback.answered_by.get(answered_id, self.fallback.model_name))
+                return result
+            await asyncio.sleep(max(self.breaker.retry_in(), 1.0))
+
+    async def send(self, messages, response_model, kwargs):
+        """Send one request to this engine's model, hedging it if it straggles."""
+        self.stats["requests"] += 1
+        started = time.monotonic()
+        primary = await self.start_call(messages, response_model, kwargs)
+        primary_fut = asyncio.wrap_future(primary)
+        pending = {primary_fut}
+        hedge_fut = None
+
+        delay = self.hedge_delay()
+        if delay is not None:
+            done, _ = await asyncio.wait(pending, timeout=delay)
+            if not done:
+                self.stats["hedges"] += 1
+                hedge = await self.start_call(messages, response_model, kwargs, exclude=primary.key)
+                hedge_fut = asyncio.wrap_future(hedge)
+                pending.add(hedge_fut)
+
+        error = None
+        retried = False
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for fut in done:
+                if fut.exception() is None:
+                    return self.finish(fut, primary, hedge_fut, pending, started)
+                error = fut.exception()
+            if not pending and not retried and len(self.key_pool.keys) > 1:
+                # A failure may be specific to one key (quota, revoked); try another once
+                retried = True
+                retry = await self.start_call(messages, response_model, kwargs, exclude=primary.key)
+                pending.add(asyncio.wrap_future(retry))
+        self.breaker.record(False)
+        raise error
+
+    def finish(self, winner, primary, hedge_fut, pending, started):
+        """Record telemetry for a successful call and drop the losing duplicate."""
+        finished = time.monotonic()
+        self.latencies.append(finished - started)
+        self.breaker.record(True, finished - started)
+        if winner is hedge_fut:
+            self.stats["hedge_wins"] += 1
+            if not primary.done():
+                primary_finished = []
+                primary.add_done_callback(lambda _: primary_finished.append(time.monotonic()))
+                self.abandoned.append((finished, primary_finished))
+        for fut in pending:
+            # The blocking call cannot be interrupted; its result is simply ignored
+            fut.cancel()
+        return winner.result()
+
+    def report(self) -> Dict[str, Any]:
+        """
+        Summarise the requests sent so far.
+
+        Returns:
+            Request, hedge and latency statistics
+        """
+        ordered = sorted(self.latencies)
+        summary = dict(self.stats)
+        summary["breaker_opened"] = self.breaker.times_opened
+        if len(self.key_pool.keys) > 1:
+            summary["keys"] = self.key_pool.report()
+        summary["hedge_rate"] = round(self.stats["hedges"] / max(self.stats["requests"], 1), 3)
+        if ordered:
+            summary["p50_latency"] = round(ordered[len(ordered) // 2], 2)
+            summary["p95_latency"] = round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))], 2)
+        # Primaries still running count up to now, so this is a lower bound
+        now = time.monotonic()
+        summary["wall_time_saved"] = round(sum(
+            (primary_finished[0] if primary_finished else now) - finished
+            for finished, primary_finished in self.abandoned
+        ), 2)
+        print(f"{self.model_name} engine: {summary}")
+        if self.fallback is not None and self.stats["failovers"]:
+            self.fallback.report()
+        return summary
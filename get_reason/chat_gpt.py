@@ -1,84 +1,106 @@
 import argparse
-from dotenv import load_dotenv
 from pathlib import Path
-from openai import OpenAI
 import os
-import instructor
-from pydantic import BaseModel
+import sys
 import json
-from tqdm import tqdm
+from tqdm.asyncio import tqdm as tqdm_asyncio
+import asyncio
 import csv
 
-load_dotenv()
-api_key = os.environ["OPEN_AI_API_KEY"] 
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+from label_index import LabelIndex
+from reason_utils import load_usable_reasons, snap_types
+from providers import add_engine_arguments, engine_from_args
+from schemas import build_response_model, load_labels
+from registry import AVAILABLE_DATASETS
 
-AVAILABLE_DATASETS = ["MatOnto", "OBI", "SWEET"]
 OUTPUT_DIR = Path("../need_reason_data")
 RESULT_DIR = Path("../result_with_reason")
 MODEL_NAME = "gpt-4o"
+MAX_CONCURRENT = 1
 
-client = instructor.from_openai(OpenAI(api_key=api_key))
+async def process_dataset(dataset_name, engine):
+    filename = OUTPUT_DIR.joinpath(MODEL_NAME).joinpath(f"{dataset_name.lower()}.csv")
+    prompt_filename = OUTPUT_DIR.joinpath(MODEL_NAME).joinpath(f"{dataset_name.lower()}_prompt.json")
 
-class TermTypingWithReason(BaseModel):
-    id: str
-    types: list[str]
-    reason: str
+    with open(prompt_filename, encoding="utf-8") as f:
+        data = json.load(f)
+        prompt_text = data["prompt"]
+
+    result_filename = RESULT_DIR.joinpath(MODEL_NAME).joinpath(f"{dataset_name.lower()}_results.json")
+    # Reasons from earlier runs are kept; only rows without one are queried
+    done_ids = set(load_usable_reasons(result_filename))
+
+    # The CSV holds types as predicted; the response model only accepts dataset labels
+    index = LabelIndex(load_labels(dataset_name))
+    unresolved = 0
+    data = []
+    with open(filename, 'r', encoding="utf-8") as file:
+        csv_reader = csv.reader(file)
+        header = next(csv_reader)
+        for row in csv_reader:
+            if row[0] in done_ids:
+                continue
+            types = snap_types(row[2], index)
+            if not types:
+                unresolved += 1
+                continue
+            data.append([
+                {
+                    "role": "system",
+                    "content": prompt_text
+                },
+                {
+                    "role": "user",
+                    "content": f"'id': '{row[0]}', 'term': '{row[1]}'\nYour prediction: 'types': '{'; '.join(types)}'"
+                }
+            ])
+    
+    print(f"Processing {dataset_name} with {MODEL_NAME}: {len(data)} rows need a reason, {len(done_ids)} already done")
+    if unresolved:
+        print(f"Skipping {unresolved} rows whose types match no {dataset_name} label")
+
+    response_model = build_response_model(dataset_name)
+    tasks = [engine.submit(item, response_model) for item in data]
+    
+    results = []
+    for f in tqdm_asyncio.as_completed(tasks, desc=f"Processing {dataset_name}", total=len(tasks)):
+        try:
+            result = await f
+            results.append(result)
+        except Exception as e:
+            print(f"Error processing item: {e}")
+
+    formatted_results = [{"id": r.id, "types": r.types, "reason": r.reason} for r in results]
+    if engine.fallback is not None:
+        for r in formatted_results:
+            r["answered_by"] = engine.answered_by.get(r["id"], MODEL_NAME)
+    if result_filename.exists():
+        new_ids = {r["id"] for r in formatted_results}
+        with open(result_filename, encoding="utf-8") as f:
+            formatted_results = [r for r in json.load(f) if r["id"] not in new_ids] + formatted_results
+
+    os.makedirs(result_filename.parent, exist_ok=True)
+    with open(result_filename, 'w') as f:
+        json.dump(formatted_results, f, indent=2)
+
+async def main_async(datasets_to_process, engine):
+    for dataset_name in datasets_to_process:
+        await process_dataset(dataset_name, engine)
+    engine.report()
 
 def main():
     parser = argparse.ArgumentParser()
-
     parser.add_argument(
         "dataset",
         choices=AVAILABLE_DATASETS + ["all"],
         help="Dataset to process or 'all' to process all datasets",
     )
-
+    add_engine_arguments(parser, MODEL_NAME, failover=True)
     args = parser.parse_args()
-
     datasets_to_process = AVAILABLE_DATASETS if args.dataset == "all" else [args.dataset]
-
-    for dataset_name in datasets_to_process:
-        filename = OUTPUT_DIR.joinpath(MODEL_NAME).joinpath(f"{dataset_name.lower()}.csv")
-        prompt_filename = OUTPUT_DIR.joinpath(MODEL_NAME).joinpath(f"{dataset_name.lower()}_prompt.json")
-
-        with open(prompt_filename, encoding="utf-8") as f:
-            data = json.load(f)
-            prompt_text = data["prompt"]
-
-        data = []
-        with open(filename, 'r', encoding="utf-8") as file:
-            csv_reader = csv.reader(file)
-            header = next(csv_reader)
-            for row in csv_reader:
-                # print(row)
-                data.append([
-                    {
-                        "role": "system",
-                        "content": prompt_text
-                    },
-                    {
-                        "role": "user",
-                        "content": f"'id': '{row[0]}', 'term': '{row[1]}'\nYour prediction: 'types': '{row[2]}'"
-                    }
-                ])
-        
-        print(f"Processing {dataset_name} with {MODEL_NAME}...")
-
-        results = []
-        for item in tqdm(data, desc=f"Processing {dataset_name}"):
-            # Process each item here
-            result = client.chat.completions.create(
-                model=MODEL_NAME,
-                response_model=TermTypingWithReason,
-                messages=item,
-            )
-            results.append(result)
-
-        result_filename = RESULT_DIR.joinpath(MODEL_NAME).joinpath(f"{dataset_name.lower()}_results.json")
-        os.makedirs(result_filename.parent, exist_ok=True)
-        formatted_results = [{"id": result.id, "types": result.types, "reason": result.reason} for result in results]
-        with open(result_filename, 'w') as f:
-            json.dump(formatted_results, f, indent=2)
+    engine = engine_from_args(MODEL_NAME, MAX_CONCURRENT, args)
+    asyncio.run(main_async(datasets_to_process, engine))
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
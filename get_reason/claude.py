@@ -1,74 +1,93 @@
-from anthropic import Anthropic
 import argparse
-from dotenv import load_dotenv
 from pathlib import Path
 import os
-import instructor
-from pydantic import BaseModel
+import sys
 import json
 from tqdm.asyncio import tqdm as tqdm_asyncio
 import asyncio
+import csv
 
-load_dotenv()
-api_key = os.environ["CLAUDE_API_KEY"]
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+from label_index import LabelIndex
+from reason_utils import load_usable_reasons, snap_types
+from providers import add_engine_arguments, engine_from_args
+from schemas import build_response_model, load_labels
+from registry import AVAILABLE_DATASETS
 
-AVAILABLE_DATASETS = ["MatOnto", "OBI", "SWEET"]
-OUTPUT_DIR = Path("processed_datasets")
-RESULT_DIR = Path("results")
+OUTPUT_DIR = Path("../need_reason_data")
+RESULT_DIR = Path("../result_with_reason")
 MODEL_NAME = "claude-sonnet-4-20250514"
-
-client = Anthropic(api_key=api_key)
-client = instructor.from_anthropic(client)
-
-class TermTyping(BaseModel):
-    id: str
-    types: list[str]
-    reason: str
-
-# Adjust max_concurrent to match your rate limit
 MAX_CONCURRENT = 2
 
-async def process_item(item, semaphore):
-    async with semaphore:
-        result = await asyncio.to_thread(
-            client.chat.completions.create,
-            model=MODEL_NAME,
-            response_model=TermTyping,
-            messages=item,
-            max_tokens=300,
-        )
-        return result
+async def process_dataset(dataset_name, engine):
+    filename = OUTPUT_DIR.joinpath(MODEL_NAME).joinpath(f"{dataset_name.lower()}.csv")
+    prompt_filename = OUTPUT_DIR.joinpath(MODEL_NAME).joinpath(f"{dataset_name.lower()}_prompt.json")
 
-async def process_dataset(dataset_name):
-    filename = OUTPUT_DIR.joinpath(MODEL_NAME).joinpath(f"{dataset_name.lower()}_test.jsonl")
-    data = []
-    with open(filename) as f:
-        for line in f:
-            data.append(json.loads(line))
+    with open(prompt_filename, encoding="utf-8") as f:
+        data = json.load(f)
+        prompt_text = data["prompt"]
 
-    print(f"Processing {dataset_name} with {MODEL_NAME}...")
+    result_filename = RESULT_DIR.joinpath(MODEL_NAME).joinpath(f"{dataset_name.lower()}_results.json")
+    # Reasons from earlier runs are kept; only rows without one are queried
+    done_ids = set(load_usable_reasons(result_filename))
 
-    semaphore = asyncio.Semaphore(MAX_CONCURRENT)
+    # The CSV holds types as predicted; the response model only accepts dataset labels
+    index = LabelIndex(load_labels(dataset_name))
+    unresolved = 0
+    data = []
+    with open(filename, 'r', encoding="utf-8") as file:
+        csv_reader = csv.reader(file)
+        header = next(csv_reader)
+        for row in csv_reader:
+            if row[0] in done_ids:
+                continue
+            types = snap_types(row[2], index)
+            if not types:
+                unresolved += 1
+                continue
+            data.append([
+                {
+                    "role": "system",
+                    "content": prompt_text
+                },
+                {
+                    "role": "user",
+                    "content": f"'id': '{row[0]}', 'term': '{row[1]}'\nYour prediction: 'types': '{'; '.join(types)}'"
+                }
+            ])
+    
+    print(f"Processing {dataset_name} with {MODEL_NAME}: {len(data)} rows need a reason, {len(done_ids)} already done")
+    if unresolved:
+        print(f"Skipping {unresolved} rows whose types match no {dataset_name} label")
 
-    tasks = [process_item(item, semaphore) for item in data]
+    response_model = build_response_model(dataset_name)
+    tasks = [engine.submit(item, response_model, max_tokens=300) for item in data]
+    
     results = []
-
-    for fut in tqdm_asyncio.as_completed(tasks, desc=f"Processing {dataset_name}", total=len(tasks)):
+    for f in tqdm_asyncio.as_completed(tasks, desc=f"Processing {dataset_name}", total=len(tasks)):
         try:
-            result = await fut
+            result = await f
             results.append(result)
         except Exception as e:
             print(f"Error processing item: {e}")
 
-    result_filename = RESULT_DIR.joinpath(MODEL_NAME).joinpath(f"{dataset_name.lower()}_results.json")
-    os.makedirs(result_filename.parent, exist_ok=True)
     formatted_results = [{"id": r.id, "types": r.types, "reason": r.reason} for r in results]
+    if engine.fallback is not None:
+        for r in formatted_results:
+            r["answered_by"] = engine.answered_by.get(r["id"], MODEL_NAME)
+    if result_filename.exists():
+        new_ids = {r["id"] for r in formatted_results}
+        with open(result_filename, encoding="utf-8") as f:
+            formatted_results = [r for r in json.load(f) if r["id"] not in new_ids] + formatted_results
+
+    os.makedirs(result_filename.parent, exist_ok=True)
     with open(result_filename, 'w') as f:
         json.dump(formatted_results, f, indent=2)
 
-async def main_async(datasets_to_process):
+async def main_async(datasets_to_process, engine):
     for dataset_name in datasets_to_process:
-        await process_dataset(dataset_name)
+        await process_dataset(dataset_name, engine)
+    engine.report()
 
 def main():
     parser = argparse.ArgumentParser()
@@ -77,9 +96,11 @@ def main():
         choices=AVAILABLE_DATASETS + ["all"],
         help="Dataset to process or 'all' to process all datasets",
     )
+    add_engine_arguments(parser, MODEL_NAME, failover=True)
     args = parser.parse_args()
     datasets_to_process = AVAILABLE_DATASETS if args.dataset == "all" else [args.dataset]
-    asyncio.run(main_async(datasets_to_process))
+    engine = engine_from_args(MODEL_NAME, MAX_CONCURRENT, args)
+    asyncio.run(main_async(datasets_to_process, engine))
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -1,45 +1,25 @@
 import argparse
-from dotenv import load_dotenv
 from pathlib import Path
 import os
-import instructor
-from pydantic import BaseModel
+import sys
 import json
 from tqdm.asyncio import tqdm as tqdm_asyncio
 import asyncio
-from google import genai
 import csv
 
-load_dotenv()
-api_key = os.environ["GEMINI_API_KEY"]
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+from label_index import LabelIndex
+from reason_utils import load_usable_reasons, snap_types
+from providers import add_engine_arguments, engine_from_args
+from schemas import build_response_model, load_labels
+from registry import AVAILABLE_DATASETS
 
-AVAILABLE_DATASETS = ["MatOnto", "OBI", "SWEET"]
 OUTPUT_DIR = Path("../need_reason_data")
 RESULT_DIR = Path("../result_with_reason")
 MODEL_NAME = "gemini-2.5-pro"
 MAX_CONCURRENT = 1
 
-client = genai.Client(api_key=api_key)
-client = instructor.from_genai(client)
-
-class TermTyping(BaseModel):
-    id: str
-    types: list[str]
-    reason: str
-
-async def process_item(item, semaphore):
-    # Wrap blocking call into a thread
-    async with semaphore:
-        result = await asyncio.to_thread(
-            client.chat.completions.create,
-            model=MODEL_NAME,
-            response_model=TermTyping,
-            messages=item,
-        )
-        return result
-
-
-async def process_dataset(dataset_name):
+async def process_dataset(dataset_name, engine):
     filename = OUTPUT_DIR.joinpath(MODEL_NAME).joinpath(f"{dataset_name.lower()}.csv")
     prompt_filename = OUTPUT_DIR.joinpath(MODEL_NAME).joinpath(f"{dataset_name.lower()}_prompt.json")
 
@@ -47,11 +27,24 @@ async def process_dataset(dataset_name):
         data = json.load(f)
         prompt_text = data["prompt"]
 
+    result_filename = RESULT_DIR.joinpath(MODEL_NAME).joinpath(f"{dataset_name.lower()}_results.json")
+    # Reasons from earlier runs are kept; only rows without one are queried
+    done_ids = set(load_usable_reasons(result_filename))
+
+    # The CSV holds types as predicted; the response model only accepts dataset labels
+    index = LabelIndex(load_labels(dataset_name))
+    unresolved = 0
     data = []
     with open(filename, 'r', encoding="utf-8") as file:
         csv_reader = csv.reader(file)
         header = next(csv_reader)
         for row in csv_reader:
+            if row[0] in done_ids:
+                continue
+            types = snap_types(row[2], index)
+            if not types:
+                unresolved += 1
+                continue
             data.append([
                 {
                     "role": "system",
@@ -59,30 +52,42 @@ async def process_dataset(dataset_name):
                 },
                 {
                     "role": "user",
-                    "content": f"'id': '{row[0]}', 'term': '{row[1]}'\nYour prediction: 'types': '{row[2]}'"
+                    "content": f"'id': '{row[0]}', 'term': '{row[1]}'\nYour prediction: 'types': '{'; '.join(types)}'"
                 }
             ])
     
-    print(f"Processing {dataset_name} with {MODEL_NAME}...")
+    print(f"Processing {dataset_name} with {MODEL_NAME}: {len(data)} rows need a reason, {len(done_ids)} already done")
+    if unresolved:
+        print(f"Skipping {unresolved} rows whose types match no {dataset_name} label")
 
-    semaphore = asyncio.Semaphore(MAX_CONCURRENT)
-        
-    tasks = [process_item(item, semaphore) for item in data]
+    response_model = build_response_model(dataset_name)
+    tasks = [engine.submit(item, response_model) for item in data]
     
     results = []
     for f in tqdm_asyncio.as_completed(tasks, desc=f"Processing {dataset_name}", total=len(tasks)):
-        result = await f
-        results.append(result)
+        try:
+            result = await f
+            results.append(result)
+        except Exception as e:
+            print(f"Error processing item: {e}")
 
-    result_filename = RESULT_DIR.joinpath(MODEL_NAME).joinpath(f"{dataset_name.lower()}_results.json")
-    os.makedirs(result_filename.parent, exist_ok=True)
     formatted_results = [{"id": r.id, "types": r.types, "reason": r.reason} for r in results]
+    if engine.fallback is not None:
+        for r in formatted_results:
+            r["answered_by"] = engine.answered_by.get(r["id"], MODEL_NAME)
+    if result_filename.exists():
+        new_ids = {r["id"] for r in formatted_results}
+        with open(result_filename, encoding="utf-8") as f:
+            formatted_results = [r for r in json.load(f) if r["id"] not in new_ids] + formatted_results
+
+    os.makedirs(result_filename.parent, exist_ok=True)
     with open(result_filename, 'w') as f:
         json.dump(formatted_results, f, indent=2)
 
-async def main_async(datasets_to_process):
+async def main_async(datasets_to_process, engine):
     for dataset_name in datasets_to_process:
-        await process_dataset(dataset_name)
+        await process_dataset(dataset_name, engine)
+    engine.report()
 
 def main():
     parser = argparse.ArgumentParser()
@@ -91,9 +96,11 @@ def main():
         choices=AVAILABLE_DATASETS + ["all"],
         help="Dataset to process or 'all' to process all datasets",
     )
+    add_engine_arguments(parser, MODEL_NAME, failover=True)
     args = parser.parse_args()
     datasets_to_process = AVAILABLE_DATASETS if args.dataset == "all" else [args.dataset]
-    asyncio.run(main_async(datasets_to_process))
+    engine = engine_from_args(MODEL_NAME, MAX_CONCURRENT, args)
+    asyncio.run(main_async(datasets_to_process, engine))
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
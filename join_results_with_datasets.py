@@ -1,13 +1,25 @@
 #!/usr/bin/env python3
 """
 Script to join results from results_best with test datasets and create CSV files.
+
+Test terms and predictions are loaded into two tables once, and a single
+merge across all models and datasets produces every need_reason_data CSV.
+Only items the models disagree on (the ones the judge will see) and that
+still lack a usable reason are written, so get_reason/ calls scale with
+the disagreement; --all-items writes every item still missing a reason.
+With --save-tables the tables are kept as Parquet, and --from-tables reads
+them back memory-mapped without touching the JSON files again.
 """
 
+import argparse
 import json
 import pandas as pd
 import os
 from pathlib import Path
 
+from reason_utils import RESULT_WITH_REASON_DIR, is_usable_reason, load_usable_reasons
+from runstore import RunStore
+
 
 def load_json(file_path):
     """Load JSON data from file."""
@@ -37,15 +49,16 @@ def get_dataset_test_files():
     return dataset_mapping
 
 
-def get_result_files():
+def get_result_files(results_dir=Path("results_best")):
     """Get all result files from results_best folder."""
-    results_dir = Path("results_best")
+    results_dir = Path(results_dir)
     result_files = []
     
     for model_folder in results_dir.iterdir():
         if model_folder.is_dir():
             for result_file in model_folder.glob("*.json"):
-                dataset_name = result_file.stem  # filename without extension
+                # filename without extension; results/ files carry a "_results" suffix
+                dataset_name = result_file.stem.removesuffix("_results")
                 model_name = model_folder.name
                 result_files.append({
                     'model': model_name,
@@ -57,117 +70,216 @@ def get_result_files():
     return result_files
 
 
-def join_data(test_data, result_data):
-    """Join test data with result data on 'id' field."""
-    # Create dictionaries for faster lookup
-    test_dict = {item['id']: item for item in test_data}
-    result_dict = {item['id']: item for item in result_data}
-    
-    joined_data = []
-    
-    # Join on common IDs
-    for test_id, test_item in test_dict.items():
-        if test_id in result_dict:
-            result_item = result_dict[test_id]
-            
-            # Create joined record
-            types_data = result_item.get('types', [])
-            
-            # Convert types list to string for CSV
-            if isinstance(types_data, list):
-                types_str = '; '.join(types_data)
+def types_to_str(types_data):
+    """Render predicted types as the CSV column: '; '-joined if a list."""
+    if isinstance(types_data, list):
+        return '; '.join(types_data)
+    return str(types_data)
+
+
+def build_test_table(dataset_mapping):
+    """One row per test item of every dataset, with columns dataset, id and term."""
+    frames = []
+    for dataset_name, test_file_path in dataset_mapping.items():
+        test_data = load_json(test_file_path)
+        if test_data is None:
+            print(f"Skipping {dataset_name} due to loading errors")
+            continue
+        frame = pd.DataFrame(test_data, columns=['id', 'term'])
+        frame.insert(0, 'dataset', dataset_name)
+        frames.append(frame)
+    return pd.concat(frames, ignore_index=True)
+
+
+def find_reasoned_ids(result_data, model_name, dataset_name):
+    """Return IDs that already have a usable reason, in the results or from get_reason/."""
+    reasoned_ids = {item['id'] for item in result_data if is_usable_reason(item.get('reason'))}
+    reason_file = RESULT_WITH_REASON_DIR / model_name / f"{dataset_name}_results.json"
+    reasoned_ids.update(load_usable_reasons(reason_file))
+    return reasoned_ids
+
+
+def build_prediction_table(results_by_dataset, store=None):
+    """
+    One row per prediction of every model and dataset.
+
+    Columns are dataset, model, id, types (as written to the CSV) and
+    reasoned, True when the item already has a usable reason.
+    """
+    rows = []
+    for dataset_name, results_by_model in results_by_dataset.items():
+        for model_name, result_data in results_by_model.items():
+            if store is not None:
+                reasoned_ids = store.reasoned_ids(dataset_name, model_name)
             else:
-                types_str = str(types_data)
-            
-            joined_record = {
-                'id': test_id,
-                'term': test_item.get('term', ''),
-                'types': types_str
-            }
-            
-            joined_data.append(joined_record)
-    
-    return joined_data
+                reasoned_ids = find_reasoned_ids(result_data, model_name, dataset_name)
+            for item in result_data:
+                rows.append((dataset_name, model_name, item['id'], types_to_str(item.get('types', [])),
+                             item['id'] in reasoned_ids))
+    table = pd.DataFrame(rows, columns=['dataset', 'model', 'id', 'types', 'reasoned'])
+    # A repeated id in one result file counts once, the last answer wins
+    return table.drop_duplicates(['dataset', 'model', 'id'], keep='last')
+
+
+def save_tables(tables_dir, tests, predictions):
+    """Write the test and prediction tables as Parquet files."""
+    tables_dir.mkdir(parents=True, exist_ok=True)
+    tests.to_parquet(tables_dir / "tests.parquet", index=False)
+    predictions.to_parquet(tables_dir / "predictions.parquet", index=False)
+    print(f"Saved {len(tests)} test rows and {len(predictions)} predictions to {tables_dir}")
+
+
+def load_tables(tables_dir):
+    """Read the tables written by save_tables, memory-mapped."""
+    tests = pd.read_parquet(tables_dir / "tests.parquet", memory_map=True)
+    predictions = pd.read_parquet(tables_dir / "predictions.parquet", memory_map=True)
+    return tests, predictions
+
+
+def contested_keys(predictions):
+    """(dataset, id) rows whose predicted types differ between at least two models."""
+    distinct = predictions.groupby(['dataset', 'id'], sort=False)['types'].nunique()
+    return distinct[distinct > 1].reset_index()[['dataset', 'id']]
+
+
+def join_tables(tests, predictions, contested_only=True, regenerate_all=False):
+    """
+    Join every model's predictions with the test terms in one merge.
+
+    Args:
+        tests: Test table from build_test_table
+        predictions: Prediction table from build_prediction_table
+        contested_only: Keep only items where the models disagree
+        regenerate_all: Also keep rows that already have a usable reason
+
+    Returns:
+        Joined table with columns dataset, model, id, term and types, in test file order
+    """
+    # An inner merge keeps the order of the left table, i.e. the test files
+    joined = tests.merge(predictions, on=['dataset', 'id'], how='inner')
+    if contested_only:
+        joined = joined.merge(contested_keys(predictions), on=['dataset', 'id'], how='inner')
+    if not regenerate_all:
+        # Rows with a complete reason never go back to get_reason/
+        joined = joined[~joined['reasoned']]
+    return joined[['dataset', 'model', 'id', 'term', 'types']]
 
 
 def create_csv_output(joined_data, output_path):
     """Create CSV file from joined data."""
-    if not joined_data:
-        print(f"No data to write to {output_path}")
-        return
-    
-    # Create DataFrame
-    df = pd.DataFrame(joined_data)
-    
-    # Keep only the needed columns
-    columns_order = ['id', 'term', 'types']
-    df = df[columns_order]
+    if joined_data.empty:
+        # Still write the header so get_reason/ does not pick up stale rows
+        print(f"No rows need a reason, writing empty {output_path}")
     
     # Create output directory if it doesn't exist
     output_path.parent.mkdir(parents=True, exist_ok=True)
     
     # Save to CSV
-    df.to_csv(output_path, index=False, encoding='utf-8')
+    joined_data[['id', 'term', 'types']].to_csv(output_path, index=False, encoding='utf-8')
     print(f"Saved {len(joined_data)} records to {output_path}")
 
 
+def load_sources(args):
+    """Build the test and prediction tables from the JSON files or the run store."""
+    store = RunStore(args.store) if args.store else None
+    
+    # Load every result file up front so agreement can be computed across models
+    results_by_dataset = {}
+    if store is not None:
+        for dataset_name, model_name in store.runs():
+            results_by_dataset.setdefault(dataset_name, {})[model_name] = store.predictions(dataset_name, model_name)
+    else:
+        for result_info in get_result_files(args.results_dir):
+            result_data = load_json(result_info['file_path'])
+            if result_data is None:
+                print(f"Skipping {result_info['model']}/{result_info['dataset']} due to loading errors")
+                continue
+            results_by_dataset.setdefault(result_info['dataset'], {})[result_info['model']] = result_data
+    
+    return build_test_table(get_dataset_test_files()), build_prediction_table(results_by_dataset, store)
+
+
 def main():
     """Main function to process all datasets and models."""
-    # Get dataset test files
-    dataset_mapping = get_dataset_test_files()
+    parser = argparse.ArgumentParser(
+        description="Join model results with test datasets into need_reason_data CSV files."
+    )
+    parser.add_argument(
+        "--results-dir",
+        default="results_best",
+        help="Folder with <model>/<dataset>.json result files",
+    )
+    parser.add_argument(
+        "--all-items",
+        action="store_true",
+        help="Write every item missing a reason, not only those where the models disagree",
+    )
+    parser.add_argument(
+        "--regenerate-all",
+        action="store_true",
+        help="Also write rows that already have a complete reason",
+    )
+    parser.add_argument(
+        "--store",
+        default=None,
+        help="Read predictions, reasons and terms from this SQLite run store instead of --results-dir",
+    )
+    parser.add_argument(
+        "--save-tables",
+        default=None,
+        help="Also write the test and prediction tables as Parquet to this folder",
+    )
+    parser.add_argument(
+        "--from-tables",
+        default=None,
+        help="Read the tables written by --save-tables (memory-mapped) instead of the JSON files",
+    )
+    args = parser.parse_args()
     
-    # Get result files
-    result_files = get_result_files()
+    if args.from_tables:
+        tests, predictions = load_tables(Path(args.from_tables))
+    else:
+        tests, predictions = load_sources(args)
+        if args.save_tables:
+            save_tables(Path(args.save_tables), tests, predictions)
     
     # Create output directory
     output_dir = Path("need_reason_data")
     output_dir.mkdir(exist_ok=True)
     
-    # Process each result file
-    for result_info in result_files:
-        model_name = result_info['model']
-        dataset_name = result_info['dataset']
-        result_file_path = result_info['file_path']
-        
+    known = set(tests['dataset'])
+    for dataset_name in sorted(set(predictions['dataset']) - known):
+        print(f"Warning: No test data found for dataset '{dataset_name}'")
+    predictions = predictions[predictions['dataset'].isin(known)]
+    
+    contested_only = not args.all_items
+    if contested_only:
+        contested = contested_keys(predictions)
+        models_per_dataset = predictions.groupby('dataset')['model'].nunique()
+        for dataset_name, count in contested.groupby('dataset').size().reindex(models_per_dataset.index,
+                                                                               fill_value=0).items():
+            print(f"{dataset_name}: {count} contested items across {models_per_dataset[dataset_name]} models")
+    
+    joined = join_tables(tests, predictions, contested_only, args.regenerate_all)
+    
+    # Every model/dataset pair gets a file, even when no row is left
+    groups = dict(tuple(joined.groupby(['model', 'dataset'], sort=False)))
+    test_counts = tests.groupby('dataset').size()
+    for (model_name, dataset_name), model_predictions in predictions.groupby(['model', 'dataset'], sort=False):
         print(f"\nProcessing {model_name}/{dataset_name}...")
+        joined_data = groups.get((model_name, dataset_name), joined.iloc[0:0])
         
-        # Find corresponding test data file
-        test_file_path = None
-        for ds_name, test_path in dataset_mapping.items():
-            if ds_name == dataset_name:
-                test_file_path = test_path
-                break
-        
-        if not test_file_path:
-            print(f"Warning: No test data found for dataset '{dataset_name}'")
-            continue
-        
-        # Load data
-        test_data = load_json(test_file_path)
-        result_data = load_json(result_file_path)
-        
-        if test_data is None or result_data is None:
-            print(f"Skipping {model_name}/{dataset_name} due to loading errors")
-            continue
-        
-        # Join data
-        joined_data = join_data(test_data, result_data)
-        
-        # Create output file path in model folder structure
-        model_output_dir = output_dir / model_name
-        output_filename = f"{dataset_name}.csv"
-        output_path = model_output_dir / output_filename
-        
-        # Save to CSV
+        output_path = output_dir / model_name / f"{dataset_name}.csv"
         create_csv_output(joined_data, output_path)
         
-        # Print summary
-        print(f"  Test data records: {len(test_data)}")
-        print(f"  Result data records: {len(result_data)}")
+        print(f"  Test data records: {test_counts[dataset_name]}")
+        print(f"  Result data records: {len(model_predictions)}")
+        if not args.regenerate_all:
+            print(f"  Already reasoned: {int(model_predictions['reasoned'].sum())}")
         print(f"  Joined records: {len(joined_data)}")
         
-        if len(joined_data) != len(test_data):
-            print(f"  Warning: {len(test_data) - len(joined_data)} test records not found in results")
+        if len(model_predictions) < test_counts[dataset_name]:
+            print(f"  Warning: {test_counts[dataset_name] - len(model_predictions)} records not found in results")
 
 
 if __name__ == "__main__":
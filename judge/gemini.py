@@ -1,43 +1,35 @@
 import argparse
-from dotenv import load_dotenv
 from pathlib import Path
 import os
-import instructor
-from pydantic import BaseModel
-import json
+import sys
 from tqdm.asyncio import tqdm as tqdm_asyncio
 import asyncio
-from google import genai
 
-load_dotenv()
-api_key = os.environ["GEMINI_API_KEY"]
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+from codec import read_json, read_jsonl, write_json
+from engine import PRIORITY_CONTESTED, PRIORITY_NORMAL
+from ledger import ShardLedger, add_shard_arguments, run_sharded
+from providers import add_engine_arguments, engine_from_args
+from registry import AVAILABLE_DATASETS
+from runstore import RunStore, add_store_arguments
+from schemas import build_response_model
 
-AVAILABLE_DATASETS = ["MatOnto", "OBI", "SWEET"]
 OUTPUT_DIR = Path("../processed_datasets_judge")
 RESULT_DIR = Path("../results_judge")
 MODEL_NAME = "gemini-2.5-pro"
 MAX_CONCURRENT = 2
 
-client = genai.Client(api_key=api_key)
-client = instructor.from_genai(client)
+async def judge_item(engine, item, response_model):
+    # Items the reasoners disagree on (several opinion blocks) are scheduled first
+    contested = item[-1]["content"].count("Predicted by:") > 1
+    r = await engine.submit(item, response_model,
+                            priority=PRIORITY_CONTESTED if contested else PRIORITY_NORMAL)
+    formatted = {"id": r.id, "types": r.types, "reason": r.reason}
+    if engine.fallback is not None:
+        formatted["answered_by"] = engine.answered_by.get(r.id, MODEL_NAME)
+    return formatted
 
-class TermTyping(BaseModel):
-    id: str
-    types: list[str]
-    reason: str
-
-async def process_item(item, semaphore):
-    # Wrap blocking call into a thread
-    async with semaphore:
-        result = await asyncio.to_thread(
-            client.chat.completions.create,
-            model=MODEL_NAME,
-            response_model=TermTyping,
-            messages=item,
-        )
-        return result
-
-async def process_dataset(dataset_name):
+async def process_dataset(dataset_name, engine, args):
     folder_name = OUTPUT_DIR.joinpath(dataset_name.lower()).joinpath(MODEL_NAME)
 
     dataset_pattern = f"{dataset_name.lower()}*.jsonl"
@@ -47,26 +39,31 @@ async def process_dataset(dataset_name):
         print(f"No files found for {dataset_name} in {folder_name}")
         return
 
+    response_model = build_response_model(dataset_name)
+
     for filename in all_files:
         print(f"Processing file: {filename}")
-        data = []
-        with open(filename, encoding="utf-8") as f:
-            for line in f:
-                data.append(json.loads(line))
+        data = read_jsonl(filename)
         
         print(f"Processing {len(data)} items from {filename.name} with {MODEL_NAME}...")
         
-        semaphore = asyncio.Semaphore(MAX_CONCURRENT)
-        
-        tasks = [process_item(item, semaphore) for item in data]
-        file_results = []
-        
-        for fut in tqdm_asyncio.as_completed(tasks, desc=f"Processing {filename.name}", total=len(tasks)):
-            try:
-                result = await fut
-                file_results.append(result)
-            except Exception as e:
-                print(f"Error processing item: {e}")
+        if args.shards:
+            ledger = ShardLedger(args.ledger, f"{MODEL_NAME}/{filename.stem}", args.shards, args.stale_after)
+            formatted_results = await run_sharded(ledger, data, lambda item: judge_item(engine, item, response_model),
+                                                  f"Processing {filename.name}")
+            if formatted_results is None:
+                print(f"Other workers are still on {filename.name}; the last one to finish saves the results")
+                continue
+        else:
+            tasks = [judge_item(engine, item, response_model) for item in data]
+            formatted_results = []
+
+            for fut in tqdm_asyncio.as_completed(tasks, desc=f"Processing {filename.name}", total=len(tasks)):
+                try:
+                    result = await fut
+                    formatted_results.append(result)
+                except Exception as e:
+                    print(f"Error processing item: {e}")
         
         # Create result filename by replacing '_test' with '_result'
         base_name = filename.stem
@@ -78,16 +75,26 @@ async def process_dataset(dataset_name):
         result_filename = RESULT_DIR.joinpath(MODEL_NAME).joinpath(f"{result_file_stem}.json")
         
         os.makedirs(result_filename.parent, exist_ok=True)
-        formatted_results = [{"id": r.id, "types": r.types, "reason": r.reason} for r in file_results]
+
+        # Items all reasoners agreed on were not sent to the judge (--skip-consensus)
+        consensus_filename = filename.with_name(f"{base_name.replace('_test', '_consensus')}.json")
+        if consensus_filename.exists():
+            formatted_results.extend(read_json(consensus_filename))
         
-        with open(result_filename, 'w') as f:
-            json.dump(formatted_results, f, indent=2)
+        write_json(result_filename, formatted_results)
+        if args.store:
+            # The run is the reasoner combination between the dataset prefix and "_test"
+            run = result_file_stem.removesuffix("_result").removeprefix(dataset_name.lower()).lstrip("_")
+            with RunStore(args.store) as store:
+                store.record_requests(dataset_name, MODEL_NAME, "judge", data)
+                store.record_verdicts(dataset_name, MODEL_NAME, run, formatted_results)
         
         print(f"Saved results to {result_filename}")
 
-async def main_async(datasets_to_process):
+async def main_async(datasets_to_process, engine, args):
     for dataset_name in datasets_to_process:
-        await process_dataset(dataset_name)
+        await process_dataset(dataset_name, engine, args)
+    engine.report()
 
 def main():
     parser = argparse.ArgumentParser()
@@ -96,9 +103,13 @@ def main():
         choices=AVAILABLE_DATASETS + ["all"],
         help="Dataset to process or 'all' to process all datasets",
     )
+    add_engine_arguments(parser, MODEL_NAME, failover=True)
+    add_shard_arguments(parser, "../ledger")
+    add_store_arguments(parser)
     args = parser.parse_args()
     datasets_to_process = AVAILABLE_DATASETS if args.dataset == "all" else [args.dataset]
-    asyncio.run(main_async(datasets_to_process))
+    engine = engine_from_args(MODEL_NAME, MAX_CONCURRENT, args)
+    asyncio.run(main_async(datasets_to_process, engine, args))
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,134 @@
+"""
+Snap predicted types to the closest valid dataset label.
+
+Lookups first try an exact match on a normalised key (case, underscores,
+hyphens and a trailing "type" ignored), then fall back to a character
+trigram inverted index scored with the Dice coefficient. A fuzzy match
+also has to share most of its words with the prediction (plural "s"
+ignored), so "Plants" is not snapped to "planet" nor "physical property"
+to "physical role"; such predictions stay unresolved for review.
+"""
+
+import re
+from collections import Counter
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+DEFAULT_THRESHOLD = 0.75
+SEPARATOR_PATTERN = re.compile(r"[\s_\-]+")
+TRAILING_TYPE_PATTERN = re.compile(r"\s+types?$")
+
+
+def normalize_label(label: str) -> str:
+    """
+    Build the lookup key of a label.
+
+    Args:
+        label: Label as given by the dataset or a model
+
+    Returns:
+        Lowercased label with separators collapsed to single spaces
+    """
+    key = SEPARATOR_PATTERN.sub(" ", label.strip().lower()).strip()
+    return TRAILING_TYPE_PATTERN.sub("", key) or key
+
+
+def words(key: str) -> Set[str]:
+    """Words of a normalised key, without a plural "s"."""
+    return {word[:-1] if len(word) > 3 and word.endswith("s") else word for word in key.split()}
+
+
+def words_match(key: str, label_key: str) -> bool:
+    """Whether two normalised keys share more than half of the words of the longer one."""
+    predicted_words, label_words = words(key), words(label_key)
+    return 2 * len(predicted_words & label_words) > max(len(predicted_words), len(label_words))
+
+
+def trigrams(key: str) -> Set[str]:
+    """
+    Character trigrams of a normalised key, padded so short labels still have some.
+
+    Args:
+        key: Normalised label
+
+    Returns:
+        Set of trigrams
+    """
+    padded = f"  {key} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class LabelIndex:
+    """Precomputed lookup from model outputs to valid labels of one dataset."""
+
+    def __init__(self, labels: Iterable[str], threshold: float = DEFAULT_THRESHOLD):
+        """
+        Build the index.
+
+        Args:
+            labels: Valid labels of the dataset
+            threshold: Minimum similarity for a fuzzy match to be accepted
+        """
+        self.labels = sorted(set(labels))
+        self.label_set = set(self.labels)
+        self.threshold = threshold
+        self.exact: Dict[str, str] = {}
+        self.label_keys: List[str] = []
+        self.label_trigrams: List[Set[str]] = []
+        self.postings: Dict[str, List[int]] = {}
+        # Models repeat the same near-misses, so fuzzy results are memoised
+        self.cache: Dict[str, Tuple[Optional[str], float]] = {}
+        for position, label in enumerate(self.labels):
+            key = normalize_label(label)
+            self.exact.setdefault(key, label)
+            self.label_keys.append(key)
+            grams = trigrams(key)
+            self.label_trigrams.append(grams)
+            for gram in grams:
+                self.postings.setdefault(gram, []).append(position)
+
+    def lookup(self, predicted: str) -> Tuple[Optional[str], float]:
+        """
+        Find the closest valid label.
+
+        Args:
+            predicted: Type returned by a model
+
+        Returns:
+            Tuple of (label, similarity); label is None when the best
+            candidate scores below the threshold or shares too few words
+        """
+        if predicted in self.label_set:
+            return predicted, 1.0
+        if predicted not in self.cache:
+            self.cache[predicted] = self.fuzzy_lookup(predicted)
+        return self.cache[predicted]
+
+    def fuzzy_lookup(self, predicted: str) -> Tuple[Optional[str], float]:
+        """
+        Uncached lookup by normalised key, then by trigram similarity.
+
+        Args:
+            predicted: Type returned by a model
+
+        Returns:
+            Tuple of (label, similarity) as for lookup
+        """
+        key = normalize_label(predicted)
+        if key in self.exact:
+            return self.exact[key], 1.0
+
+        grams = trigrams(key)
+        shared = Counter()
+        for gram in grams:
+            shared.update(self.postings.get(gram, ()))
+        if not shared:
+            return None, 0.0
+
+        best_score, best_position = max(
+            (2 * count / (len(grams) + len(self.label_trigrams[position])), -position)
+            for position, count in shared.items()
+        )
+        label = self.labels[-best_position]
+        if best_score < self.threshold or not words_match(key, self.label_keys[-best_position]):
+            return None, best_score
+        return label, best_score
@@ -0,0 +1,289 @@
+"""
+Sharded execution of one run across processes or hosts.
+
+The items of a run are split into a fixed number of shards by a hash of
+their id. Worker processes pointed at the same ledger directory (local or
+on shared storage) claim shards by renaming marker files, which is atomic,
+so no shard is worked on twice and no lock server is needed:
+
+    <ledger>/<run>/pending/0007            waiting to be claimed
+    <ledger>/<run>/claimed/0007.<worker>   being worked on
+    <ledger>/<run>/done/0007               finished
+    <ledger>/<run>/results/0007.jsonl      one result per line
+
+Results are appended as they arrive, so a shard taken over from a dead
+worker (no progress for --stale-after seconds) skips the items already
+answered. A shard with items that still fail after a retry is left claimed;
+a worker started once it is stale takes it over and retries only those.
+The ledger records a hash of the input file, so a ledger left from an
+earlier version of the input is refused rather than merged again. The worker that completes the last shard merges the shard files
+into the standard result JSON; `python ledger.py merge` does the same by hand.
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import socket
+import time
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional
+
+from tqdm.asyncio import tqdm as tqdm_asyncio
+
+from codec import dumps_line, iter_jsonl, write_json
+from engine import item_id_of
+
+DEFAULT_LEDGER_DIR = Path("ledger")
+# A claim without progress for this long is taken to belong to a dead worker
+DEFAULT_STALE_AFTER = 600.0
+# Seconds to wait for another worker to finish creating a ledger
+LEDGER_WAIT = 30.0
+# Passes over the unanswered items of a shard before it is left for a takeover
+SHARD_ATTEMPTS = 2
+
+
+def input_hash(path) -> str:
+    """SHA-1 of an input file, stored in the ledger to tell runs on different inputs apart."""
+    with open(path, "rb") as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+def shard_of(item_id: str, shards: int) -> int:
+    """Deterministic shard of an item, the same on every host."""
+    return int(hashlib.sha1(item_id.encode("utf-8")).hexdigest(), 16) % shards
+
+
+class ShardLedger:
+    """File-based record of which shards of a run are pending, claimed and done."""
+
+    def __init__(self, root, run_name: str, shards: int, stale_after: float = DEFAULT_STALE_AFTER,
+                 worker: Optional[str] = None, source: Optional[str] = None):
+        """
+        Open (or create) the ledger of a run.
+
+        Args:
+            root: Ledger directory shared by all workers
+            run_name: Name of the run, e.g. "<model>/<input file stem>"
+            shards: Number of shards; must match across workers
+            stale_after: Seconds without progress after which a claim may be taken over
+            worker: Name of this worker, host and process id by default
+            source: input_hash of the file the run reads; must match across workers and reruns
+        """
+        self.dir = Path(root) / run_name
+        self.shards = shards
+        self.stale_after = stale_after
+        self.worker = worker or f"{socket.gethostname()}-{os.getpid()}"
+        os.makedirs(self.dir, exist_ok=True)
+
+        meta_file = self.dir / "ledger.json"
+        try:
+            # mkdir is atomic: exactly one worker creates the shard markers
+            os.mkdir(self.dir / "pending")
+            created = True
+        except FileExistsError:
+            created = False
+        for state in ("claimed", "done", "results"):
+            os.makedirs(self.dir / state, exist_ok=True)
+
+        if created:
+            for shard in range(shards):
+                (self.dir / "pending" / f"{shard:04d}").touch()
+            temporary = self.dir / f"ledger.json.{self.worker}"
+            with open(temporary, "w") as f:
+                json.dump({"shards": shards, "source": source}, f)
+            os.replace(temporary, meta_file)
+            return
+
+        # Written last by the creator, so its presence means every marker exists
+        deadline = time.time() + LEDGER_WAIT
+        while not meta_file.exists():
+            if time.time() > deadline:
+                raise TimeoutError(f"Ledger {self.dir} was never initialised; remove it and start again")
+            time.sleep(0.1)
+        with open(meta_file) as f:
+            meta = json.load(f)
+        if meta["shards"] != shards:
+            raise ValueError(f"Ledger {self.dir} was created with {meta['shards']} shards, not {shards}")
+        if source is not None and meta.get("source") != source:
+            raise ValueError(f"Ledger {self.dir} was created for another version of the input file; "
+                             "remove it to run again on the current one")
+
+    @staticmethod
+    def shard_name(path: Path) -> str:
+        """Shard number of a marker file, without the worker suffix."""
+        return path.name.split(".")[0]
+
+    def claim_path(self, shard: int) -> Path:
+        """Marker of a shard claimed by this worker."""
+        return self.dir / "claimed" / f"{shard:04d}.{self.worker}"
+
+    def claim(self) -> Optional[int]:
+        """
+        Claim a pending shard, or take over a stale one.
+
+        Returns:
+            Shard number, or None when every shard is done or claimed by a live worker
+        """
+        pending = sorted((self.dir / "pending").iterdir())
+        # Start at a worker-specific offset so workers rarely race for the same marker
+        offset = int(hashlib.sha1(self.worker.encode()).hexdigest(), 16) % max(len(pending), 1)
+        for path in pending[offset:] + pending[:offset]:
+            shard = int(path.name)
+            try:
+                os.rename(path, self.claim_path(shard))
+                return shard
+            except FileNotFoundError:
+                continue
+
+        now = time.time()
+        for path in sorted((self.dir / "claimed").iterdir()):
+            try:
+                if now - path.stat().st_mtime < self.stale_after:
+                    continue
+                shard = int(self.shard_name(path))
+                os.rename(path, self.claim_path(shard))
+            except FileNotFoundError:
+                continue
+            print(f"Took over stale shard {shard} from {path.name.split('.', 1)[1]}")
+            return shard
+        return None
+
+    def results_path(self, shard: int) -> Path:
+        """Result lines of a shard."""
+        return self.dir / "results" / f"{shard:04d}.jsonl"
+
+    def done_ids(self, shard: int) -> set:
+        """Ids already answered in a shard, e.g. by a worker that died."""
+        path = self.results_path(shard)
+        if not path.exists():
+            return set()
+        return {result["id"] for result in iter_jsonl(path)}
+
+    def append(self, shard: int, result: Dict[str, Any]):
+        """Record one result and mark the claim as alive."""
+        with open(self.results_path(shard), "ab") as f:
+            f.write(dumps_line(result))
+        try:
+            os.utime(self.claim_path(shard))
+        except FileNotFoundError:
+            # Taken over after all; the merge drops duplicate ids
+            pass
+
+    def complete(self, shard: int):
+        """Mark a claimed shard as done."""
+        try:
+            os.rename(self.claim_path(shard), self.dir / "done" / f"{shard:04d}")
+        except FileNotFoundError:
+            pass
+
+    def finished(self) -> bool:
+        """True once every shard is done."""
+        return len(list((self.dir / "done").iterdir())) == self.shards
+
+    def status(self) -> Dict[str, int]:
+        """Number of shards in each state."""
+        return {state: len(list((self.dir / state).iterdir())) for state in ("pending", "claimed", "done")}
+
+    def merge(self) -> List[Dict[str, Any]]:
+        """Results of all shards, one per id, in shard order."""
+        merged = {}
+        for shard in range(self.shards):
+            path = self.results_path(shard)
+            if not path.exists():
+                continue
+            for result in iter_jsonl(path):
+                merged[result["id"]] = result
+        return list(merged.values())
+
+
+async def run_sharded(ledger: ShardLedger, data: List[list], run_item: Callable, desc: str):
+    """
+    Work through every shard this worker can claim.
+
+    Args:
+        ledger: Ledger of the run
+        data: Chat messages of all items of the run
+        run_item: Coroutine function from an item's messages to its result dict
+        desc: Progress bar label
+
+    Returns:
+        Merged results if all shards are done, None while other workers are still busy
+    """
+    by_shard: Dict[int, List[list]] = {}
+    for messages in data:
+        by_shard.setdefault(shard_of(item_id_of(messages) or "", ledger.shards), []).append(messages)
+
+    while True:
+        shard = ledger.claim()
+        if shard is None:
+            break
+        failed = 0
+        for attempt in range(SHARD_ATTEMPTS):
+            done = ledger.done_ids(shard)
+            items = [messages for messages in by_shard.get(shard, []) if item_id_of(messages) not in done]
+            if not items:
+                break
+            tasks = [run_item(messages) for messages in items]
+            label = f"{desc} [shard {shard}]" if attempt == 0 else f"{desc} [shard {shard}, retry]"
+            failed = 0
+            for fut in tqdm_asyncio.as_completed(tasks, desc=label, total=len(tasks)):
+                try:
+                    ledger.append(shard, await fut)
+                except Exception as e:
+                    failed += 1
+                    print(f"Error processing item: {e}")
+        if failed:
+            # Left claimed: once stale, a worker takes it over and retries only the failed items
+            print(f"Shard {shard}: {failed} items failed and the shard is left claimed; run a worker again "
+                  f"once it has been idle for --stale-after ({ledger.stale_after:g}) seconds to retry them")
+            continue
+        ledger.complete(shard)
+
+    return ledger.merge() if ledger.finished() else None
+
+
+def add_shard_arguments(parser, default_ledger_dir=DEFAULT_LEDGER_DIR):
+    """Add the sharding options shared by the runners."""
+    parser.add_argument(
+        "--shards",
+        type=int,
+        default=None,
+        help="Split each input file into this many shards claimed through --ledger; run one copy per worker",
+    )
+    parser.add_argument(
+        "--ledger",
+        default=str(default_ledger_dir),
+        help="Ledger directory shared by the workers, e.g. on a network drive",
+    )
+    parser.add_argument(
+        "--stale-after",
+        type=float,
+        default=DEFAULT_STALE_AFTER,
+        help="Seconds without progress after which another worker takes over a shard",
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Inspect or merge a sharded run.")
+    parser.add_argument("action", choices=["status", "merge"])
+    parser.add_argument("run", help="Run name, e.g. gpt-4o/obi_test")
+    parser.add_argument("--ledger", default=str(DEFAULT_LEDGER_DIR), help="Ledger directory")
+    parser.add_argument("--output", help="Result JSON to write (merge)")
+    args = parser.parse_args()
+
+    meta_file = Path(args.ledger) / args.run / "ledger.json"
+    with open(meta_file) as f:
+        shards = json.load(f)["shards"]
+    ledger = ShardLedger(args.ledger, args.run, shards)
+    print(f"{args.run}: {ledger.status()} of {shards} shards")
+    if args.action == "merge":
+        if not args.output:
+            parser.error("merge needs --output")
+        results = ledger.merge()
+        write_json(args.output, results)
+        print(f"Saved {len(results)} results to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+import json
+import argparse
+from pathlib import Path
+
+from label_index import DEFAULT_THRESHOLD, LabelIndex
+from registry import AVAILABLE_DATASETS
+from schemas import load_labels
+
+RESULT_DIRS = [Path("results"), Path("results_judge"), Path("result_with_reason")]
+REPORT_FILE = Path("label_normalization_report.json")
+
+
+def find_dataset(result_file):
+    """Return the dataset a result file belongs to, from its filename prefix."""
+    for dataset_name in AVAILABLE_DATASETS:
+        if result_file.stem.startswith(dataset_name.lower() + "_") or result_file.stem == dataset_name.lower():
+            return dataset_name
+    return None
+
+
+def normalize_results(results, index):
+    """
+    Snap the types of every result to valid labels.
+
+    Returns:
+        Tuple of (number of changed types, list of unresolved predictions)
+    """
+    changed = 0
+    unresolved = []
+    for result in results:
+        types = []
+        for predicted in result.get("types", []):
+            label, score = index.lookup(predicted)
+            if label is None:
+                # Keep the raw output so the item can be inspected or re-run
+                unresolved.append({"id": result["id"], "type": predicted, "score": round(score, 3)})
+                types.append(predicted)
+            else:
+                types.append(label)
+        if types != result.get("types", []):
+            # A re-run keeps the model's original output
+            result.setdefault("raw_types", result["types"])
+            result["types"] = types
+            changed += 1
+    return changed, unresolved
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Snap predicted types in result files to the closest valid dataset label."
+    )
+    parser.add_argument(
+        "--dirs",
+        nargs="+",
+        default=[str(d) for d in RESULT_DIRS],
+        help="Result directories to normalise",
+    )
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=DEFAULT_THRESHOLD,
+        help="Minimum trigram similarity for a fuzzy match; lower scores are left unresolved",
+    )
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="Only report, do not rewrite result files",
+    )
+    args = parser.parse_args()
+
+    indexes = {}
+    report = {}
+
+    for result_dir in map(Path, args.dirs):
+        if not result_dir.exists():
+            print(f"Directory {result_dir} does not exist. Skipping...")
+            continue
+
+        for result_file in sorted(result_dir.glob("*/*.json")):
+            dataset_name = find_dataset(result_file)
+            if dataset_name is None:
+                print(f"Cannot tell the dataset of {result_file}. Skipping...")
+                continue
+            if dataset_name not in indexes:
+                indexes[dataset_name] = LabelIndex(load_labels(dataset_name), args.threshold)
+
+            with open(result_file, "r", encoding="utf-8") as f:
+                results = json.load(f)
+
+            changed, unresolved = normalize_results(results, indexes[dataset_name])
+            print(f"{result_file}: {changed} predictions snapped, {len(unresolved)} unresolved")
+            report[str(result_file)] = {"changed": changed, "unresolved": unresolved}
+
+            if changed and not args.dry_run:
+                with open(result_file, "w", encoding="utf-8") as f:
+                    json.dump(results, f, indent=2)
+
+    with open(REPORT_FILE, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    print(f"Report saved to {REPORT_FILE}")
+
+
+if __name__ == "__main__":
+    main()
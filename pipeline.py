@@ -0,0 +1,197 @@
+"""
+Stream items from the reasoners straight into the judge.
+
+Normally the judge starts only after every reasoner has finished the whole
+dataset, create_jsonl_dataset_judge.py has been run and a judge/ script has
+been started by hand. Here each item moves on as soon as it is ready: once
+all selected reasoners have answered it, its judge prompt is built and
+queued (or, with --skip-consensus, settled right away when they agree). The
+reasoners and the judge overlap, so a run takes about as long as its
+slowest stage rather than the sum of the stages.
+
+Outputs keep the usual layout: results/<reasoner>/<dataset>_results.json
+and results_judge/<judge>/<dataset>_<reasoners>_result.json. Answers are
+merged by id into files that already exist, so a run never drops results
+of items it did not process.
+"""
+
+import argparse
+import asyncio
+import os
+import time
+from pathlib import Path
+
+from tqdm.asyncio import tqdm as tqdm_asyncio
+
+from codec import read_json, read_jsonl, write_json
+from create_jsonl_dataset_judge import DEFAULT_TOKEN_BUDGET, DatasetProcessor
+from engine import PRIORITY_CONTESTED, item_id_of
+from providers import PROVIDERS, add_engine_arguments, engine_from_args
+from registry import AVAILABLE_DATASETS
+from schemas import build_response_model
+
+PROMPT_DIR = Path("processed_datasets")
+RESULT_DIR = Path("results")
+JUDGE_RESULT_DIR = Path("results_judge")
+MAX_CONCURRENT = 4
+
+
+def load_prompts(model_name, dataset_name):
+    """First-pass prompts of a reasoner, by the item id quoted in each prompt."""
+    filename = PROMPT_DIR.joinpath(model_name).joinpath(f"{dataset_name.lower()}_test.jsonl")
+    return {item_id_of(messages): messages for messages in read_jsonl(filename)}
+
+
+class ItemPipeline:
+    """Runs one dataset through the reasoners and the judge, item by item."""
+
+    def __init__(self, dataset_name, reasoners, judge, engines, judge_engine, skip_consensus, token_budget):
+        """
+        Prepare prompts and the judge prompt builder.
+
+        Args:
+            dataset_name: Dataset to process
+            reasoners: First-pass models whose opinions the judge sees
+            judge: Judge model
+            engines: Engine per reasoner
+            judge_engine: Engine of the judge
+            skip_consensus: Settle items without the judge when all reasoners agree
+            token_budget: Estimated tokens allowed for the opinions of one item, None for no limit
+        """
+        self.dataset_name = dataset_name
+        self.reasoners = reasoners
+        self.judge = judge
+        self.engines = engines
+        self.judge_engine = judge_engine
+        self.response_model = build_response_model(dataset_name)
+        self.processor = DatasetProcessor(dataset_name, judge, reasoners, skip_consensus=skip_consensus,
+                                          token_budget=token_budget)
+
+        labels, prompt, self.test_data = self.processor.load_inputs()
+        self.system_prompt = self.processor.build_system_prompt(labels, prompt)
+        self.prompts = {model: load_prompts(model, dataset_name) for model in reasoners}
+
+        self.result_data = {model: {} for model in reasoners}
+        self.reasoner_results = {model: [] for model in reasoners}
+        self.judge_results = []
+        self.latencies = []
+
+    async def ask_reasoner(self, model, item):
+        """First-pass answer of one reasoner, recorded under the item's own id."""
+        result = await self.engines[model].submit(self.prompts[model][item["id"]], self.response_model)
+        formatted = {"id": item["id"], "types": result.types, "reason": result.reason}
+        self.reasoner_results[model].append(formatted)
+        self.result_data[model][item["id"]] = {"types": result.types, "reason": result.reason}
+
+    async def process_item(self, item):
+        """Take one item through every reasoner and then the judge."""
+        started = time.monotonic()
+        outcomes = await asyncio.gather(*[self.ask_reasoner(model, item) for model in self.reasoners],
+                                        return_exceptions=True)
+        failed = [model for model, outcome in zip(self.reasoners, outcomes) if isinstance(outcome, Exception)]
+        if failed:
+            print(f"Skipping judge for {item['id']}: no answer from {', '.join(failed)}")
+            return
+
+        messages = self.processor.build_item(item, self.result_data, self.reasoners, self.system_prompt)
+        if messages is None:
+            self.judge_results.append(self.processor.consensus_data[-1])
+        else:
+            result = await self.judge_engine.submit(messages, self.response_model, priority=PRIORITY_CONTESTED)
+            judged = {"id": item["id"], "types": result.types, "reason": result.reason}
+            if self.judge_engine.fallback is not None:
+                judged["answered_by"] = self.judge_engine.answered_by.get(result.id, self.judge)
+            self.judge_results.append(judged)
+        self.latencies.append(time.monotonic() - started)
+
+    async def run(self):
+        """Process every test item and save the reasoner and judge results."""
+        started = time.monotonic()
+        tasks = [self.process_item(item) for item in self.test_data]
+        for fut in tqdm_asyncio.as_completed(tasks, desc=f"Pipeline {self.dataset_name}", total=len(tasks)):
+            try:
+                await fut
+            except Exception as e:
+                print(f"Error processing item: {e}")
+        elapsed = time.monotonic() - started
+
+        for model, results in self.reasoner_results.items():
+            self.save(RESULT_DIR / model / f"{self.dataset_name.lower()}_results.json", results)
+        reasoners = "_".join(self.reasoners)
+        self.save(JUDGE_RESULT_DIR / self.judge / f"{self.dataset_name.lower()}_{reasoners}_result.json",
+                  self.judge_results)
+
+        if self.latencies:
+            ordered = sorted(self.latencies)
+            print(f"{self.dataset_name}: {len(self.judge_results)} items judged in {elapsed:.0f}s, "
+                  f"{len(self.processor.consensus_data)} by consensus; per item "
+                  f"p50 {ordered[len(ordered) // 2]:.1f}s, max {ordered[-1]:.1f}s")
+
+    @staticmethod
+    def save(path, results):
+        """Merge results by id into a result file in the standard layout."""
+        os.makedirs(path.parent, exist_ok=True)
+        merged = {result["id"]: result for result in read_json(path)} if path.exists() else {}
+        merged.update((result["id"], result) for result in results)
+        write_json(path, list(merged.values()))
+        print(f"Saved {len(results)} results to {path} ({len(merged)} in the file)")
+
+
+async def main_async(datasets_to_process, args, reasoners, engines, judge_engine):
+    for dataset_name in datasets_to_process:
+        pipeline = ItemPipeline(dataset_name, reasoners, args.judge, engines, judge_engine,
+                                args.skip_consensus, args.token_budget or None)
+        await pipeline.run()
+    for engine in engines.values():
+        engine.report()
+    judge_engine.report()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Run reasoners and judge as one pipeline, judging each item as soon as its reasoners answer."
+    )
+    parser.add_argument(
+        "dataset",
+        choices=AVAILABLE_DATASETS + ["all"],
+        help="Dataset to process or 'all' to process all datasets",
+    )
+    parser.add_argument(
+        "--reasoner",
+        required=True,
+        help="Comma-separated first-pass models, e.g. gpt-4o,deepseek-chat,gemini-2.5-pro",
+    )
+    parser.add_argument("--judge", required=True, choices=list(PROVIDERS), help="Judge model")
+    parser.add_argument(
+        "--skip-consensus",
+        action="store_true",
+        help="Do not send items to the judge when all reasoners agree",
+    )
+    parser.add_argument(
+        "--token-budget",
+        type=int,
+        default=DEFAULT_TOKEN_BUDGET,
+        help="Estimated tokens allowed for the reasoner opinions of one item, 0 for no limit",
+    )
+    parser.add_argument(
+        "--max-concurrent",
+        type=int,
+        default=MAX_CONCURRENT,
+        help="Requests in flight per model",
+    )
+    add_engine_arguments(parser, None)
+    args = parser.parse_args()
+
+    reasoners = [m.strip() for m in args.reasoner.split(",")]
+    for model in reasoners:
+        if model not in PROVIDERS:
+            parser.error(f"Invalid model: {model}. Available models are: {', '.join(PROVIDERS)}")
+    datasets_to_process = AVAILABLE_DATASETS if args.dataset == "all" else [args.dataset]
+    engines = {model: engine_from_args(model, args.max_concurrent, args) for model in reasoners}
+    # The judge may also be a reasoner; it still gets its own engine and concurrency
+    judge_engine = engine_from_args(args.judge, args.max_concurrent, args)
+    asyncio.run(main_async(datasets_to_process, args, reasoners, engines, judge_engine))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,225 @@
+"""
+Preview the cost of a run before sending anything.
+
+Reads prepared items from processed_datasets/ (term typing) and
+processed_datasets_judge/ (judge), estimates input and output tokens per
+item with each provider's offline tokenizer approximation, and predicts
+wall time and spend under the given concurrency and rate limits. Output
+tokens are measured on earlier results of the same file where they exist.
+
+The estimates come from tokens.py, the same functions the engine uses for
+its --tpm-per-key budget, so a plan and a run count tokens alike.
+"""
+
+import argparse
+import json
+from pathlib import Path
+
+from providers import PROVIDERS, call_kwargs
+from registry import AVAILABLE_DATASETS
+from tokens import DEFAULT_OUTPUT_TOKENS, estimate_messages_tokens, estimate_tokens
+
+TYPING_DIR = Path("processed_datasets")
+TYPING_RESULT_DIR = Path("results")
+JUDGE_DIR = Path("processed_datasets_judge")
+JUDGE_RESULT_DIR = Path("results_judge")
+# Expected output of one call without a reason: id and types
+NO_REASON_OUTPUT_TOKENS = 40
+DEFAULT_MAX_CONCURRENT = 4
+
+
+def find_jobs(stage, datasets, models, no_reason=False):
+    """
+    List the prepared files of a stage.
+
+    Args:
+        stage: "typing", "judge" or "all"
+        datasets: Datasets to plan
+        models: Models to plan
+        no_reason: Plan the typing run on the no-reason prompts instead of the default ones
+
+    Returns:
+        List of (model, prepared file, result file of an earlier run) tuples
+    """
+    jobs = []
+    for model in models:
+        for dataset_name in datasets:
+            if stage in ("typing", "all"):
+                # The runners read exactly one of the two prepared files
+                test_suffix = "_no_reason_test" if no_reason else "_test"
+                path = TYPING_DIR / model / f"{dataset_name.lower()}{test_suffix}.jsonl"
+                if path.exists():
+                    result_file = TYPING_RESULT_DIR / model / f"{dataset_name.lower()}_results.json"
+                    jobs.append((model, path, result_file))
+            if stage in ("judge", "all"):
+                folder = JUDGE_DIR / dataset_name.lower() / model
+                for path in sorted(folder.glob(f"{dataset_name.lower()}*_test.jsonl")):
+                    result_file = JUDGE_RESULT_DIR / model / f"{path.stem.replace('_test', '_result')}.json"
+                    jobs.append((model, path, result_file))
+    return jobs
+
+
+def measured_output_tokens(result_file, chars_per_token):
+    """Mean estimated tokens of the answers in an earlier result file, None if there is none."""
+    if not result_file.exists():
+        return None
+    with open(result_file, encoding="utf-8") as f:
+        results = json.load(f)
+    if not results:
+        return None
+    return sum(estimate_tokens(json.dumps(r, ensure_ascii=False), chars_per_token) for r in results) / len(results)
+
+
+def plan_file(model, path, result_file):
+    """
+    Estimate the tokens and spend of one prepared file.
+
+    Returns:
+        Dict with requests, input and output tokens and cost in USD
+    """
+    provider = PROVIDERS[model]
+    chars_per_token = provider["chars_per_token"]
+    input_tokens = 0
+    requests = 0
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            input_tokens += estimate_messages_tokens(json.loads(line), chars_per_token)
+            requests += 1
+
+    per_item = measured_output_tokens(result_file, chars_per_token)
+    source = "measured"
+    if per_item is None:
+        per_item = NO_REASON_OUTPUT_TOKENS if "no_reason" in path.stem else DEFAULT_OUTPUT_TOKENS
+        source = "default"
+    per_item = min(per_item, call_kwargs(model).get("max_tokens", per_item))
+    output_tokens = round(per_item * requests)
+
+    price = provider["price_per_million"]
+    return {
+        "model": model,
+        "file": str(path),
+        "requests": requests,
+        "input_tokens": input_tokens,
+        "output_tokens": output_tokens,
+        "output_source": source,
+        "cost": (input_tokens * price["input"] + output_tokens * price["output"]) / 1_000_000,
+    }
+
+
+def predict_wall_time(model, requests, tokens, max_concurrent, rpm=None, tpm=None, latency=None):
+    """
+    Predict the wall time of a model's share of the run.
+
+    The run is bounded by the slowest of: concurrency times latency, the
+    requests-per-minute limit and the tokens-per-minute limit.
+
+    Returns:
+        Tuple of (seconds, name of the binding constraint)
+    """
+    latency = latency or PROVIDERS[model]["typical_latency"]
+    bounds = {"concurrency": requests * latency / max_concurrent}
+    if rpm:
+        bounds["rpm"] = requests / rpm * 60
+    if tpm:
+        bounds["tpm"] = tokens / tpm * 60
+    constraint = max(bounds, key=bounds.get)
+    return bounds[constraint], constraint
+
+
+def format_duration(seconds):
+    """Render seconds as h:mm:ss."""
+    seconds = round(seconds)
+    return f"{seconds // 3600}:{seconds % 3600 // 60:02d}:{seconds % 60:02d}"
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Estimate tokens, requests, wall time and spend of a run from the prepared items."
+    )
+    parser.add_argument(
+        "dataset",
+        choices=AVAILABLE_DATASETS + ["all"],
+        help="Dataset to plan or 'all' to plan all datasets",
+    )
+    parser.add_argument(
+        "--stage",
+        choices=["typing", "judge", "all"],
+        default="all",
+        help="Prepared items to read: processed_datasets/, processed_datasets_judge/ or both",
+    )
+    parser.add_argument(
+        "--models",
+        default=",".join(PROVIDERS),
+        help="Comma-separated models to plan",
+    )
+    parser.add_argument(
+        "--max-concurrent",
+        type=int,
+        default=DEFAULT_MAX_CONCURRENT,
+        help="Requests in flight per model",
+    )
+    parser.add_argument(
+        "--no-reason",
+        action="store_true",
+        help="Plan the typing run on the no-reason prompts (create_jsonl_dataset.py --no-reason)",
+    )
+    parser.add_argument("--rpm", type=float, default=None, help="Requests per minute allowed per model")
+    parser.add_argument("--tpm", type=float, default=None, help="Tokens per minute allowed per model")
+    parser.add_argument(
+        "--latency",
+        type=float,
+        default=None,
+        help="Seconds per call, instead of each provider's typical latency",
+    )
+    parser.add_argument("--output", default=None, help="Also save the plan as JSON to this file")
+    args = parser.parse_args()
+
+    models = [m.strip() for m in args.models.split(",")]
+    for model in models:
+        if model not in PROVIDERS:
+            parser.error(f"Invalid model: {model}. Available models are: {', '.join(PROVIDERS)}")
+    datasets = AVAILABLE_DATASETS if args.dataset == "all" else [args.dataset]
+
+    rows = [plan_file(model, path, result_file) for model, path, result_file in find_jobs(args.stage, datasets, models, args.no_reason)]
+    if not rows:
+        print("No prepared files found. Run create_jsonl_dataset.py or create_jsonl_dataset_judge.py first.")
+        return
+
+    print(f"{'file':<72} {'requests':>8} {'input':>10} {'output':>9} {'cost $':>8}")
+    for row in rows:
+        output = f"{row['output_tokens']}{'*' if row['output_source'] == 'default' else ''}"
+        print(f"{row['file']:<72} {row['requests']:>8} {row['input_tokens']:>10} {output:>9} {row['cost']:>8.2f}")
+    print("* output tokens from defaults; no earlier results to measure\n")
+
+    # Providers run side by side, so the run takes as long as its slowest model
+    summary = {}
+    for model in models:
+        model_rows = [row for row in rows if row["model"] == model]
+        if not model_rows:
+            continue
+        requests = sum(row["requests"] for row in model_rows)
+        tokens = sum(row["input_tokens"] + row["output_tokens"] for row in model_rows)
+        seconds, constraint = predict_wall_time(model, requests, tokens, args.max_concurrent,
+                                                args.rpm, args.tpm, args.latency)
+        summary[model] = {
+            "requests": requests,
+            "tokens": tokens,
+            "cost": round(sum(row["cost"] for row in model_rows), 4),
+            "wall_time": round(seconds),
+            "bound_by": constraint,
+        }
+        print(f"{model:<28} {requests:>7} requests {tokens:>11} tokens ${summary[model]['cost']:>8.2f}"
+              f"  {format_duration(seconds)} (bound by {constraint})")
+
+    total_cost = sum(s["cost"] for s in summary.values())
+    total_time = max(s["wall_time"] for s in summary.values())
+    print(f"\nTotal: ${total_cost:.2f}, about {format_duration(total_time)} with models in parallel")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"files": rows, "models": summary, "cost": round(total_cost, 4), "wall_time": total_time}, f, indent=2)
+        print(f"Plan saved to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
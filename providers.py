@@ -0,0 +1,274 @@
+"""
+Provider table used to build an instructor client for any supported model.
+
+Runners build their engine here from command-line options: one client
+per API key, balanced by a KeyPool, plus an optional failover model. SDKs
+are imported only for the provider that is actually requested.
+
+Nothing heavy happens at import: the .env file is read and the SDK client
+is built on the first request that needs it, so --help and runs that never
+reach a provider do not pay for them.
+
+A provider may have several keys: set e.g. OPEN_AI_API_KEYS to a
+comma-separated list instead of (or next to) OPEN_AI_API_KEY.
+
+--record and --replay save every provider call to a cassette and answer
+from it offline; see cassette.py.
+
+chars_per_token approximates each provider's tokenizer for offline token
+estimates (plan.py and the tokens-per-minute budget). Prices are list
+prices in USD per million tokens and typical_latency is seconds per call;
+both are rough planning figures, not billing data.
+"""
+
+import argparse
+import os
+import threading
+
+from cassette import recording_create, replay_create
+from engine import ApiKey, Engine, KeyPool
+
+PROVIDERS = {
+    "gpt-4o": {
+        "api_key_env": "OPEN_AI_API_KEY",
+        "sdk": "openai",
+        "chars_per_token": 4.2,
+        "price_per_million": {"input": 2.50, "output": 10.00},
+        "typical_latency": 3.0,
+    },
+    "deepseek-chat": {
+        "api_key_env": "DEEPSEEK_API_KEY",
+        "sdk": "openai",
+        "base_url": "https://api.deepseek.com",
+        "chars_per_token": 3.8,
+        "price_per_million": {"input": 0.27, "output": 1.10},
+        "typical_latency": 6.0,
+    },
+    "claude-sonnet-4-20250514": {
+        "api_key_env": "CLAUDE_API_KEY",
+        "sdk": "anthropic",
+        # Anthropic requires max_tokens on every call
+        "call_kwargs": {"max_tokens": 300},
+        "chars_per_token": 3.5,
+        "price_per_million": {"input": 3.00, "output": 15.00},
+        "typical_latency": 5.0,
+    },
+    "gemini-2.5-pro": {
+        "api_key_env": "GEMINI_API_KEY",
+        "sdk": "genai",
+        "chars_per_token": 4.0,
+        "price_per_million": {"input": 1.25, "output": 10.00},
+        # Thinking model: slower per call
+        "typical_latency": 15.0,
+    },
+}
+
+
+def create_client(model_name, api_key=None):
+    """
+    Build an instructor client for a model.
+
+    Args:
+        model_name: One of PROVIDERS
+        api_key: Key to use instead of the one in the environment
+
+    Returns:
+        Instructor client whose chat.completions.create parses into a response model
+    """
+    if model_name not in PROVIDERS:
+        raise ValueError(f"Unknown model: {model_name}. Available models are: {', '.join(PROVIDERS)}")
+    provider = PROVIDERS[model_name]
+    if api_key is None:
+        load_environment()
+        api_key = os.environ[provider["api_key_env"]]
+
+    import instructor
+
+    if provider["sdk"] == "openai":
+        from openai import OpenAI
+        mode = instructor.Mode.TOOLS_STRICT if "base_url" not in provider else instructor.Mode.TOOLS
+        return instructor.from_openai(OpenAI(api_key=api_key, base_url=provider.get("base_url")), mode=mode)
+    if provider["sdk"] == "anthropic":
+        from anthropic import Anthropic
+        return instructor.from_anthropic(Anthropic(api_key=api_key))
+    from google import genai
+    return instructor.from_genai(genai.Client(api_key=api_key), mode=instructor.Mode.GENAI_STRUCTURED_OUTPUTS)
+
+
+def load_environment():
+    """Read the .env file into the environment, importing python-dotenv only now."""
+    from dotenv import load_dotenv
+    load_dotenv()
+
+
+def deferred_create(model_name, api_key):
+    """
+    Return a create function that builds its client on the first call.
+
+    Args:
+        model_name: One of PROVIDERS
+        api_key: Key the client uses
+
+    Returns:
+        Function with the signature of chat.completions.create
+    """
+    client = []
+    lock = threading.Lock()
+
+    def create(*args, **kwargs):
+        if not client:
+            # Calls run in worker threads; only one of them builds the client
+            with lock:
+                if not client:
+                    client.append(create_client(model_name, api_key))
+        return client[0].chat.completions.create(*args, **kwargs)
+
+    return create
+
+
+def load_api_keys(model_name):
+    """
+    Read every API key configured for a model's provider.
+
+    Args:
+        model_name: One of PROVIDERS
+
+    Returns:
+        List of keys, from <ENV>S (comma-separated) and <ENV>, without duplicates
+    """
+    load_environment()
+    env_name = PROVIDERS[model_name]["api_key_env"]
+    keys = [key.strip() for key in os.environ.get(f"{env_name}S", "").split(",") if key.strip()]
+    if os.environ.get(env_name) and os.environ[env_name] not in keys:
+        keys.append(os.environ[env_name])
+    if not keys:
+        raise KeyError(f"Set {env_name} or {env_name}S for {model_name}")
+    return keys
+
+
+def create_key_pool(model_name, per_minute=None, strategy="least_loaded", tokens_per_minute=None):
+    """
+    Build a KeyPool with one client per configured API key.
+
+    Keys are read now, so a missing key fails before any work starts, but
+    each client is only built on its first request.
+
+    Args:
+        model_name: One of PROVIDERS
+        per_minute: Requests per minute allowed for each key, None for no limit
+        strategy: "least_loaded" or "round_robin"
+        tokens_per_minute: Estimated tokens per minute allowed for each key, None for no limit
+
+    Returns:
+        KeyPool for an Engine
+    """
+    keys = [
+        ApiKey(f"key{position + 1}", deferred_create(model_name, api_key), per_minute, tokens_per_minute)
+        for position, api_key in enumerate(load_api_keys(model_name))
+    ]
+    return KeyPool(keys, strategy)
+
+
+def positive_rate(value):
+    """Argument type of a per-minute limit: a float above zero."""
+    rate = float(value)
+    if rate <= 0:
+        raise argparse.ArgumentTypeError(f"must be above 0 (leave the option out for no limit), got {value}")
+    return rate
+
+
+def add_engine_arguments(parser, model_name, failover=False):
+    """
+    Add the engine options shared by the runners to an argument parser.
+
+    Args:
+        parser: Parser of the runner
+        model_name: Model of the runner, excluded from the failover choices
+        failover: Offer --failover, for stages where the model identity is flexible
+    """
+    parser.add_argument(
+        "--hedge-percentile",
+        type=float,
+        default=None,
+        help="Send a duplicate request once a call is slower than this latency percentile, e.g. 95",
+    )
+    parser.add_argument(
+        "--rpm-per-key",
+        type=positive_rate,
+        default=None,
+        help="Requests per minute allowed for each API key",
+    )
+    parser.add_argument(
+        "--tpm-per-key",
+        type=positive_rate,
+        default=None,
+        help="Tokens per minute allowed for each API key, counted with the offline estimate",
+    )
+    parser.add_argument(
+        "--key-strategy",
+        choices=["least_loaded", "round_robin"],
+        default="least_loaded",
+        help="How requests are spread over the API keys",
+    )
+    cassette = parser.add_mutually_exclusive_group()
+    cassette.add_argument(
+        "--record",
+        default=None,
+        help="Also append every provider call, with its response and time, to this cassette",
+    )
+    cassette.add_argument(
+        "--replay",
+        default=None,
+        help="Answer from these comma-separated cassettes instead of the provider, offline",
+    )
+    parser.add_argument(
+        "--replay-speed",
+        type=float,
+        default=1.0,
+        help="Factor on the recorded call times when replaying, e.g. 0.5; 0 answers at once",
+    )
+    if failover:
+        parser.add_argument(
+            "--failover",
+            choices=[m for m in PROVIDERS if m != model_name],
+            default=None,
+            help="Model that answers while this provider's circuit breaker is open",
+        )
+
+
+def engine_from_args(model_name, max_concurrent, args):
+    """
+    Build the engine of a runner from its parsed arguments.
+
+    Args:
+        model_name: Model of the runner
+        max_concurrent: Maximum number of requests in flight
+        args: Arguments parsed with add_engine_arguments
+
+    Returns:
+        Engine for the runner's model
+    """
+    fallback = None
+    if getattr(args, "failover", None) is not None:
+        fallback = build_engine(args.failover, max_concurrent, args)
+    return build_engine(model_name, max_concurrent, args, fallback)
+
+
+def build_engine(model_name, max_concurrent, args, fallback=None):
+    """Build one model's engine from parsed engine options."""
+    if args.replay:
+        # One stand-in key: the per-key budgets then apply to the whole replay
+        key_pool = KeyPool([ApiKey("replay", replay_create(args.replay, args.replay_speed), args.rpm_per_key,
+                                   args.tpm_per_key)], args.key_strategy)
+    else:
+        key_pool = create_key_pool(model_name, args.rpm_per_key, args.key_strategy, args.tpm_per_key)
+        if args.record:
+            for key in key_pool.keys:
+                key.create = recording_create(key.create, args.record)
+    return Engine(key_pool, model_name, max_concurrent, args.hedge_percentile, fallback=fallback,
+                  call_kwargs=call_kwargs(model_name), chars_per_token=PROVIDERS[model_name]["chars_per_token"])
+
+
+def call_kwargs(model_name):
+    """Return the extra arguments every call to this model needs."""
+    return dict(PROVIDERS[model_name].get("call_kwargs", {}))
@@ -0,0 +1,56 @@
+"""
+Helpers for deciding which predictions still need a reason from get_reason/.
+"""
+
+import json
+from pathlib import Path
+
+RESULT_WITH_REASON_DIR = Path("result_with_reason")
+# A reason cut off by max_tokens usually stops mid-sentence
+REASON_ENDINGS = ('.', '!', '?', '"', "'", ')')
+MIN_REASON_WORDS = 3
+
+
+def is_usable_reason(reason):
+    """Return True if a reason exists and does not look truncated."""
+    if not isinstance(reason, str):
+        return False
+    reason = reason.strip()
+    if len(reason.split()) < MIN_REASON_WORDS:
+        return False
+    return reason.endswith(REASON_ENDINGS)
+
+
+def load_usable_reasons(result_file):
+    """Load {id: reason} for every usable reason in a result JSON file.
+
+    Missing or unreadable files give an empty mapping.
+    """
+    result_file = Path(result_file)
+    if not result_file.exists():
+        return {}
+    try:
+        with open(result_file, 'r', encoding='utf-8') as f:
+            results = json.load(f)
+    except Exception as e:
+        print(f"Error loading {result_file}: {e}")
+        return {}
+    return {
+        item['id']: item['reason']
+        for item in results
+        if is_usable_reason(item.get('reason'))
+    }
+
+
+def snap_types(types_text, index):
+    """Split a need_reason_data types cell ("; "-joined) and snap each type to a label.
+
+    Types that match no label of the index are dropped, so the result always
+    validates against the dataset's response model; it is empty when none match.
+    """
+    snapped = []
+    for predicted in types_text.split(";"):
+        label, _ = index.lookup(predicted.strip()) if predicted.strip() else (None, 0.0)
+        if label is not None and label not in snapped:
+            snapped.append(label)
+    return snapped
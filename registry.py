@@ -0,0 +1,177 @@
+"""
+Registry of the datasets under datasets/, with a cache of their parsed form.
+
+Any folder of datasets/ with a train/ or test/ subfolder is a dataset, so
+a new one is picked up without editing the scripts. Loading a dataset
+gives its train and test records, the sorted label list, an id -> term
+map and the system prompts rendered from prompt.json and
+prompt_judge.json.
+
+The parsed dataset is pickled to .cache/datasets/<name>.pickle together
+with the size, mtime and SHA-1 of every source file. A later load only
+stats the sources; if a file changed, or only its mtime did, its hash
+decides whether the dataset is parsed again.
+"""
+
+import hashlib
+import json
+import os
+import pickle
+from functools import lru_cache
+from pathlib import Path
+from typing import Any, Dict, List, Tuple
+
+ROOT = Path(__file__).resolve().parent
+DATASETS_DIR = ROOT / "datasets"
+CACHE_DIR = ROOT / ".cache" / "datasets"
+# Bump when the cached layout changes
+CACHE_VERSION = 1
+TRAIN_FILE = "term_typing_train_data.json"
+EXAMPLES_IN_PROMPT = 5
+
+
+def discover() -> List[str]:
+    """Names of the datasets under datasets/, sorted."""
+    if not DATASETS_DIR.is_dir():
+        return []
+    return sorted(
+        path.name for path in DATASETS_DIR.iterdir()
+        if path.is_dir() and ((path / "train").is_dir() or (path / "test").is_dir())
+    )
+
+
+AVAILABLE_DATASETS = discover()
+
+
+def render_prompt(template: str, labels, train: List[Dict[str, Any]], examples: int = EXAMPLES_IN_PROMPT) -> str:
+    """
+    Fill a prompt template with the labels and first train examples of a dataset.
+
+    Args:
+        template: Text of prompt.json or prompt_judge.json
+        labels: Sorted labels of the dataset
+        train: Train records
+        examples: Number of train records shown under [FIRST_FIVE_DATASET]
+
+    Returns:
+        System prompt
+    """
+    examples = "".join(f"{example}\n" for example in train[:examples])
+    prompt = template.replace("[NUM_LABELS]", str(len(labels)))
+    prompt = prompt.replace("[FIRST_FIVE_DATASET]", examples)
+    return prompt.replace("[LABELS]", "- " + ("\n- ".join(labels)))
+
+
+class Dataset:
+    """Parsed train and test data of one dataset."""
+
+    def __init__(self, name: str, train: List[Dict[str, Any]], test: List[Dict[str, Any]],
+                 templates: Dict[str, str]):
+        """
+        Derive labels, terms and prompts from the raw records.
+
+        Args:
+            name: Dataset name, e.g. "OBI"
+            train: Train records with gold types
+            test: Test records
+            templates: Prompt templates by stage ("typing", "judge")
+        """
+        self.name = name
+        self.train = train
+        self.test = test
+        # Sorted so that prompts and response models list labels in one stable order
+        self.labels: Tuple[str, ...] = tuple(sorted({item["types"][0] for item in train}))
+        self.terms: Dict[str, str] = {item["id"]: item["term"] for item in train + test}
+        self.templates = templates
+        self.prompts = {stage: render_prompt(template, self.labels, train) for stage, template in templates.items()}
+
+
+def source_files(name: str) -> Dict[str, Path]:
+    """Files a dataset is built from, by role."""
+    folder = DATASETS_DIR / name
+    return {
+        "train": folder / "train" / TRAIN_FILE,
+        "test": folder / "test" / f"{name.lower()}_term_typing_test_data.json",
+        "typing": folder / "prompt.json",
+        "judge": folder / "prompt_judge.json",
+    }
+
+
+def file_hash(path: Path) -> str:
+    with open(path, "rb") as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+def fingerprint(path: Path, previous=None) -> Tuple[int, int, str]:
+    """
+    (size, mtime in ns, SHA-1) of a file, None if it does not exist.
+
+    The hash of `previous` is reused when size and mtime are unchanged.
+    """
+    try:
+        stat = path.stat()
+    except FileNotFoundError:
+        return None
+    if previous is not None and previous[:2] == (stat.st_size, stat.st_mtime_ns):
+        return previous
+    return stat.st_size, stat.st_mtime_ns, file_hash(path)
+
+
+def parse(name: str, files: Dict[str, Path]) -> Dataset:
+    """Read a dataset from its source files."""
+    def read(role, default):
+        if not files[role].exists():
+            return default
+        with open(files[role], encoding="utf-8") as f:
+            return json.load(f)
+
+    templates = {stage: read(stage, {}).get("prompt") for stage in ("typing", "judge")}
+    return Dataset(name, read("train", []), read("test", []),
+                   {stage: template for stage, template in templates.items() if template is not None})
+
+
+@lru_cache(maxsize=None)
+def load_dataset(name: str) -> Dataset:
+    """
+    Load a dataset, from the cache when its source files are unchanged.
+
+    Args:
+        name: One of AVAILABLE_DATASETS
+
+    Returns:
+        Parsed dataset
+    """
+    if name not in AVAILABLE_DATASETS:
+        raise ValueError(f"Dataset '{name}' not found. Available datasets: {AVAILABLE_DATASETS}")
+    files = source_files(name)
+    cache_file = CACHE_DIR / f"{name}.pickle"
+
+    cached = None
+    if cache_file.exists():
+        try:
+            with open(cache_file, "rb") as f:
+                cached = pickle.load(f)
+        except Exception:
+            cached = None
+    if cached is not None and cached.get("version") != CACHE_VERSION:
+        cached = None
+
+    previous = cached["sources"] if cached else {}
+    sources = {role: fingerprint(path, previous.get(role)) for role, path in files.items()}
+    if cached is not None and all(
+        (sources[role] and sources[role][2]) == (previous.get(role) and previous[role][2]) for role in files
+    ):
+        if sources == previous:
+            return cached["dataset"]
+        # Only mtimes moved (e.g. a fresh checkout); keep the data, refresh the stamps
+        dataset = cached["dataset"]
+    else:
+        dataset = parse(name, files)
+
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    temporary = cache_file.with_name(f"{cache_file.name}.{os.getpid()}")
+    with open(temporary, "wb") as f:
+        pickle.dump({"version": CACHE_VERSION, "sources": sources, "dataset": dataset}, f,
+                    protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(temporary, cache_file)
+    return dataset
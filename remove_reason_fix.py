@@ -3,7 +3,8 @@ import argparse
 from pathlib import Path
 import os
 
-AVAILABLE_DATASETS = ["MatOnto", "OBI", "SWEET"]
+from registry import AVAILABLE_DATASETS
+
 RESULT_DIR = Path("result_with_reason")
 RESULT_FOR_SUBMIT = Path("result_with_reason_for_submit")
 MODEL_NAME = ["gpt-4o", "gemini-2.5-pro", "claude-sonnet-4-20250514", "deepseek-chat"]
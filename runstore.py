@@ -0,0 +1,467 @@
+"""
+One SQLite store for the items, requests and answers of every run.
+
+The JSON result directories (results/, result_with_reason/, results_judge/,
+results_for_submit*/, need_reason_data/) each hold whole files that every
+consumer parses again and turns into dicts. The store keeps the same data in
+tables keyed by (dataset, model, item id):
+
+    items        test and train terms of each dataset
+    requests     chat messages sent for an item
+    predictions  types (and any vote record) of a first-pass answer
+    reasons      reasons from a first-pass answer, or get_reason/ answers
+    verdicts     judge answers, per judge and reasoner combination
+
+so "which items are missing / contested / still without a reason" are
+indexed queries. The database runs in WAL mode: several runner processes
+can write to it while others read.
+
+    python runstore.py import                    load the existing result directories
+    python runstore.py export results --output results
+    python runstore.py missing OBI gpt-4o
+    python runstore.py contested OBI --models gpt-4o,deepseek-chat
+"""
+
+import argparse
+import csv
+import json
+import sqlite3
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Optional
+
+from codec import read_json, write_json
+from engine import item_id_of
+from reason_utils import is_usable_reason
+from registry import AVAILABLE_DATASETS, load_dataset
+
+DEFAULT_STORE = Path("runs.sqlite")
+DATASETS_DIR = Path("datasets")
+# Seconds a writer waits for another process to release the database
+BUSY_TIMEOUT = 30.0
+# Reasons returned with the prediction, and reasons regenerated by get_reason/
+REASON_FROM_RESULT = "result"
+REASON_FROM_GET_REASON = "get_reason"
+EXPORT_LAYOUTS = ["results", "result_with_reason", "results_judge", "results_for_submit",
+                  "results_for_submit_judge", "need_reason_data"]
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS items (
+    dataset TEXT NOT NULL,
+    item_id TEXT NOT NULL,
+    split TEXT NOT NULL,
+    term TEXT NOT NULL,
+    types TEXT,
+    PRIMARY KEY (dataset, item_id)
+);
+CREATE TABLE IF NOT EXISTS requests (
+    dataset TEXT NOT NULL,
+    model TEXT NOT NULL,
+    stage TEXT NOT NULL,
+    item_id TEXT NOT NULL,
+    messages TEXT NOT NULL,
+    PRIMARY KEY (dataset, model, stage, item_id)
+);
+CREATE TABLE IF NOT EXISTS predictions (
+    dataset TEXT NOT NULL,
+    model TEXT NOT NULL,
+    item_id TEXT NOT NULL,
+    types TEXT NOT NULL,
+    extra TEXT,
+    PRIMARY KEY (dataset, model, item_id)
+);
+CREATE TABLE IF NOT EXISTS reasons (
+    dataset TEXT NOT NULL,
+    model TEXT NOT NULL,
+    item_id TEXT NOT NULL,
+    source TEXT NOT NULL,
+    reason TEXT,
+    types TEXT,
+    extra TEXT,
+    PRIMARY KEY (dataset, model, item_id, source)
+);
+CREATE TABLE IF NOT EXISTS verdicts (
+    dataset TEXT NOT NULL,
+    judge TEXT NOT NULL,
+    run TEXT NOT NULL,
+    item_id TEXT NOT NULL,
+    types TEXT NOT NULL,
+    reason TEXT,
+    extra TEXT,
+    PRIMARY KEY (dataset, judge, run, item_id)
+);
+"""
+
+
+def split_fields(result: Dict[str, Any]):
+    """Split a result dict into types, reason and the remaining fields as JSON (None if there are none)."""
+    extra = {key: value for key, value in result.items() if key not in ("id", "types", "reason")}
+    return json.dumps(result["types"], ensure_ascii=False), result.get("reason"), \
+        json.dumps(extra, ensure_ascii=False) if extra else None
+
+
+def join_fields(item_id: str, types: str, reason: Optional[str], extra: Optional[str],
+                with_reason: bool) -> Dict[str, Any]:
+    """Rebuild a result dict in the field order the runners write."""
+    result = {"id": item_id, "types": json.loads(types)}
+    if with_reason:
+        result["reason"] = reason
+    if extra:
+        result.update(json.loads(extra))
+    return result
+
+
+class RunStore:
+    """SQLite database of the items, requests and answers of all runs."""
+
+    def __init__(self, path=DEFAULT_STORE):
+        """
+        Open (or create) the store.
+
+        Args:
+            path: Database file, shared by every process that reads or writes runs
+        """
+        self.path = Path(path)
+        self.conn = sqlite3.connect(self.path, timeout=BUSY_TIMEOUT)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        # WAL keeps commits durable against process crashes with far fewer fsyncs
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.create_function("usable_reason", 1, is_usable_reason, deterministic=True)
+        self.conn.executescript(SCHEMA)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.conn.close()
+
+    def add_items(self, dataset: str, split: str, items: Iterable[Dict[str, Any]]):
+        """Record the terms of a dataset split; train items keep their gold types."""
+        rows = [(dataset.lower(), item["id"], split, item["term"],
+                 json.dumps(item["types"], ensure_ascii=False) if "types" in item else None) for item in items]
+        with self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO items (dataset, item_id, split, term, types) VALUES (?, ?, ?, ?, ?)", rows
+            )
+
+    def record_requests(self, dataset: str, model: str, stage: str, data: Iterable[list]):
+        """Record the chat messages of each item sent to a model in a stage ("typing" or "judge")."""
+        rows = [(dataset.lower(), model, stage, item_id_of(messages), json.dumps(messages, ensure_ascii=False))
+                for messages in data if item_id_of(messages)]
+        with self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO requests (dataset, model, stage, item_id, messages) VALUES (?, ?, ?, ?, ?)",
+                rows,
+            )
+
+    def ensure_test_items(self, dataset: str):
+        """Register the test terms of a dataset from datasets/ unless `import` already did."""
+        dataset = dataset.lower()
+        if self.conn.execute("SELECT 1 FROM items WHERE dataset = ? AND split = 'test' LIMIT 1",
+                             (dataset,)).fetchone():
+            return
+        name = next((name for name in AVAILABLE_DATASETS if name.lower() == dataset), None)
+        if name is not None:
+            self.add_items(dataset, "test", load_dataset(name).test)
+
+    def record_predictions(self, dataset: str, model: str, results: Iterable[Dict[str, Any]]):
+        """Insert or update first-pass answers, keeping their reasons; registers the test terms on first use."""
+        self.ensure_test_items(dataset)
+        dataset = dataset.lower()
+        predictions, reasons = [], []
+        for result in results:
+            types, reason, extra = split_fields(result)
+            predictions.append((dataset, model, result["id"], types, extra))
+            if "reason" in result:
+                reasons.append((dataset, model, result["id"], REASON_FROM_RESULT, reason, None, None))
+        with self.conn:
+            # An upsert keeps the rowid, so exports stay in first-seen order
+            self.conn.executemany(
+                "INSERT INTO predictions (dataset, model, item_id, types, extra) VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT (dataset, model, item_id) DO UPDATE SET types = excluded.types, extra = excluded.extra",
+                predictions,
+            )
+            self.record_reason_rows(reasons)
+
+    def record_reasons(self, dataset: str, model: str, results: Iterable[Dict[str, Any]],
+                       source: str = REASON_FROM_GET_REASON):
+        """Insert or update reasons, by default the answers regenerated by get_reason/."""
+        rows = []
+        for result in results:
+            types, reason, extra = split_fields(result)
+            rows.append((dataset.lower(), model, result["id"], source, reason, types, extra))
+        with self.conn:
+            self.record_reason_rows(rows)
+
+    def record_reason_rows(self, rows):
+        self.conn.executemany(
+            "INSERT INTO reasons (dataset, model, item_id, source, reason, types, extra) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?) ON CONFLICT (dataset, model, item_id, source) DO UPDATE SET "
+            "reason = excluded.reason, types = excluded.types, extra = excluded.extra",
+            rows,
+        )
+
+    def record_verdicts(self, dataset: str, judge: str, run: str, results: Iterable[Dict[str, Any]]):
+        """
+        Insert or update judge answers.
+
+        Args:
+            dataset: Dataset name
+            judge: Judge model
+            run: Reasoner combination, e.g. "gpt-4o_deepseek-chat"
+            results: Result dicts as saved in results_judge/
+        """
+        rows = [(dataset.lower(), judge, run, result["id"], *split_fields(result)) for result in results]
+        with self.conn:
+            self.conn.executemany(
+                "INSERT INTO verdicts (dataset, judge, run, item_id, types, reason, extra) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?) ON CONFLICT (dataset, judge, run, item_id) DO UPDATE SET "
+                "types = excluded.types, reason = excluded.reason, extra = excluded.extra",
+                rows,
+            )
+
+    def items(self, dataset: str, split: str = "test") -> List[Dict[str, Any]]:
+        """Terms of a dataset split in file order."""
+        rows = self.conn.execute(
+            "SELECT item_id, term, types FROM items WHERE dataset = ? AND split = ? ORDER BY rowid",
+            (dataset.lower(), split),
+        )
+        return [{"id": item_id, "term": term, **({"types": json.loads(types)} if types else {})}
+                for item_id, term, types in rows]
+
+    def runs(self, table: str = "predictions") -> List[tuple]:
+        """(dataset, model) pairs with predictions, or (dataset, judge, run) triples with verdicts."""
+        columns = "dataset, judge, run" if table == "verdicts" else "dataset, model"
+        return self.conn.execute(f"SELECT DISTINCT {columns} FROM {table} ORDER BY {columns}").fetchall()
+
+    def predictions(self, dataset: str, model: str) -> List[Dict[str, Any]]:
+        """First-pass answers of a model in results/ layout."""
+        rows = self.conn.execute(
+            "SELECT p.item_id, p.types, r.reason, r.item_id IS NOT NULL, p.extra FROM predictions p "
+            "LEFT JOIN reasons r ON r.dataset = p.dataset AND r.model = p.model AND r.item_id = p.item_id "
+            "AND r.source = ? WHERE p.dataset = ? AND p.model = ? ORDER BY p.rowid",
+            (REASON_FROM_RESULT, dataset.lower(), model),
+        )
+        return [join_fields(item_id, types, reason, extra, has_reason)
+                for item_id, types, reason, has_reason, extra in rows]
+
+    def results_by_id(self, dataset: str, model: str) -> Dict[str, Dict[str, str]]:
+        """
+        Types and reason of each answer, as the judge prompt builder needs them.
+
+        The reason returned with the prediction wins if it is usable; a
+        missing or truncated one is replaced by the one from get_reason/.
+        """
+        rows = self.conn.execute(
+            "SELECT p.item_id, p.types, own.reason, regenerated.reason FROM predictions p "
+            "LEFT JOIN reasons own ON own.dataset = p.dataset AND own.model = p.model "
+            "AND own.item_id = p.item_id AND own.source = ? "
+            "LEFT JOIN reasons regenerated ON regenerated.dataset = p.dataset AND regenerated.model = p.model "
+            "AND regenerated.item_id = p.item_id AND regenerated.source = ? "
+            "WHERE p.dataset = ? AND p.model = ?",
+            (REASON_FROM_RESULT, REASON_FROM_GET_REASON, dataset.lower(), model),
+        )
+        return {
+            item_id: {"types": json.loads(types),
+                      "reason": own if is_usable_reason(own) else (regenerated or own or "")}
+            for item_id, types, own, regenerated in rows
+        }
+
+    def regenerated_reasons(self, dataset: str, model: str) -> List[Dict[str, Any]]:
+        """Answers from get_reason/ in result_with_reason/ layout."""
+        rows = self.conn.execute(
+            "SELECT item_id, types, reason, extra FROM reasons WHERE dataset = ? AND model = ? AND source = ? "
+            "ORDER BY rowid",
+            (dataset.lower(), model, REASON_FROM_GET_REASON),
+        )
+        return [join_fields(item_id, types, reason, extra, True) for item_id, types, reason, extra in rows]
+
+    def verdicts(self, dataset: str, judge: str, run: str) -> List[Dict[str, Any]]:
+        """Judge answers in results_judge/ layout."""
+        rows = self.conn.execute(
+            "SELECT item_id, types, reason, extra FROM verdicts WHERE dataset = ? AND judge = ? AND run = ? "
+            "ORDER BY rowid",
+            (dataset.lower(), judge, run),
+        )
+        return [join_fields(item_id, types, reason, extra, True) for item_id, types, reason, extra in rows]
+
+    def missing(self, dataset: str, model: str) -> List[str]:
+        """Test items a model has not answered yet."""
+        rows = self.conn.execute(
+            "SELECT i.item_id FROM items i LEFT JOIN predictions p ON p.dataset = i.dataset "
+            "AND p.model = ? AND p.item_id = i.item_id "
+            "WHERE i.dataset = ? AND i.split = 'test' AND p.item_id IS NULL ORDER BY i.rowid",
+            (model, dataset.lower()),
+        )
+        return [item_id for item_id, in rows]
+
+    def contested(self, dataset: str, models: List[str]) -> set:
+        """Items on which at least two of the models predict different types."""
+        placeholders = ", ".join("?" * len(models))
+        rows = self.conn.execute(
+            f"SELECT item_id FROM predictions WHERE dataset = ? AND model IN ({placeholders}) "
+            "GROUP BY item_id HAVING COUNT(DISTINCT types) > 1",
+            (dataset.lower(), *models),
+        )
+        return {item_id for item_id, in rows}
+
+    def reasoned_ids(self, dataset: str, model: str) -> set:
+        """Items of a model that already have a usable reason, from the result or get_reason/."""
+        rows = self.conn.execute(
+            "SELECT DISTINCT item_id FROM reasons WHERE dataset = ? AND model = ? AND usable_reason(reason)",
+            (dataset.lower(), model),
+        )
+        return {item_id for item_id, in rows}
+
+    def request(self, dataset: str, model: str, stage: str, item_id: str) -> Optional[list]:
+        """Chat messages sent for an item, None if none were recorded."""
+        row = self.conn.execute(
+            "SELECT messages FROM requests WHERE dataset = ? AND model = ? AND stage = ? AND item_id = ?",
+            (dataset.lower(), model, stage, item_id),
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+
+
+def add_store_arguments(parser, default_store=None):
+    """Add the run store option shared by the runners."""
+    parser.add_argument(
+        "--store",
+        default=default_store,
+        help="Also record requests and answers in this SQLite run store (see runstore.py)",
+    )
+
+
+def import_files(store: RunStore, root: Path = Path(".")):
+    """
+    Load the datasets and existing result directories into the store.
+
+    Returns:
+        Number of files imported
+    """
+    root = Path(root)
+    imported = 0
+    datasets = []
+    for dataset_dir in sorted((root / DATASETS_DIR).iterdir()):
+        if not dataset_dir.is_dir():
+            continue
+        dataset = dataset_dir.name.lower()
+        datasets.append(dataset)
+        for split in ("train", "test"):
+            for path in sorted((dataset_dir / split).glob("*_data.json")):
+                store.add_items(dataset, split, read_json(path))
+                imported += 1
+
+    for path in sorted((root / "results").glob("*/*_results.json")):
+        store.record_predictions(path.stem.removesuffix("_results"), path.parent.name, read_json(path))
+        imported += 1
+    for path in sorted((root / "result_with_reason").glob("*/*_results.json")):
+        store.record_reasons(path.stem.removesuffix("_results"), path.parent.name, read_json(path))
+        imported += 1
+    for path in sorted((root / "results_judge").glob("*/*_result.json")):
+        stem = path.stem.removesuffix("_result")
+        dataset = next((d for d in datasets if stem == d or stem.startswith(f"{d}_")), None)
+        if dataset is None:
+            print(f"Skipping {path}: no dataset matches its name")
+            continue
+        store.record_verdicts(dataset, path.parent.name, stem[len(dataset) + 1:], read_json(path))
+        imported += 1
+    return imported
+
+
+def export_json(path: Path, data):
+    """Write one exported result file, creating its folder."""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    write_json(path, data)
+
+
+def judge_stem(dataset: str, run: str) -> str:
+    """File name stem of a judge result, e.g. "obi_gpt-4o_deepseek-chat_result"."""
+    return f"{dataset}_{run}_result" if run else f"{dataset}_result"
+
+
+def export(store: RunStore, layout: str, output: Path) -> int:
+    """
+    Write the store out in one of the file layouts the scripts read.
+
+    Args:
+        store: Run store
+        layout: One of EXPORT_LAYOUTS
+        output: Root directory of the layout, e.g. results/
+
+    Returns:
+        Number of files written
+    """
+    written = 0
+    if layout in ("results_judge", "results_for_submit_judge"):
+        for dataset, judge, run in store.runs("verdicts"):
+            verdicts = store.verdicts(dataset, judge, run)
+            if layout == "results_judge":
+                export_json(output / judge / f"{judge_stem(dataset, run)}.json", verdicts)
+            else:
+                export_json(output / judge / f"{judge_stem(dataset, run)}_{judge}.json",
+                           [{"id": v["id"], "types": v["types"]} for v in verdicts])
+            written += 1
+        return written
+
+    for dataset, model in store.runs():
+        if layout == "results":
+            export_json(output / model / f"{dataset}_results.json", store.predictions(dataset, model))
+        elif layout == "result_with_reason":
+            reasons = store.regenerated_reasons(dataset, model)
+            if not reasons:
+                continue
+            export_json(output / model / f"{dataset}_results.json", reasons)
+        elif layout == "results_for_submit":
+            export_json(output / model / f"{dataset}_results_for_submit.json",
+                       [{"id": p["id"], "types": p["types"]} for p in store.predictions(dataset, model)])
+        elif layout == "need_reason_data":
+            reasoned = store.reasoned_ids(dataset, model)
+            predicted = store.results_by_id(dataset, model)
+            path = output / model / f"{dataset}.csv"
+            path.parent.mkdir(parents=True, exist_ok=True)
+            with open(path, "w", newline="", encoding="utf-8") as f:
+                writer = csv.writer(f)
+                writer.writerow(["id", "term", "types"])
+                for item in store.items(dataset):
+                    if item["id"] in predicted and item["id"] not in reasoned:
+                        writer.writerow([item["id"], item["term"], "; ".join(predicted[item["id"]]["types"])])
+        written += 1
+    return written
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Import, query and export the SQLite run store.")
+    parser.add_argument("action", choices=["import", "export", "missing", "contested"])
+    parser.add_argument("target", nargs="*", help="export: layout; missing: dataset model; contested: dataset")
+    parser.add_argument("--store", default=str(DEFAULT_STORE), help="Database file")
+    parser.add_argument("--output", help="Root directory to export to (export)")
+    parser.add_argument("--models", help="Comma-separated models to compare (contested)")
+    args = parser.parse_args()
+
+    with RunStore(args.store) as store:
+        if args.action == "import":
+            print(f"Imported {import_files(store)} files into {args.store}")
+        elif args.action == "export":
+            if len(args.target) != 1 or args.target[0] not in EXPORT_LAYOUTS or not args.output:
+                parser.error(f"export needs a layout ({', '.join(EXPORT_LAYOUTS)}) and --output")
+            print(f"Wrote {export(store, args.target[0], Path(args.output))} files to {args.output}")
+        elif args.action == "missing":
+            if len(args.target) != 2:
+                parser.error("missing needs a dataset and a model")
+            missing = store.missing(*args.target)
+            print(f"{len(missing)} items without an answer")
+            for item_id in missing:
+                print(item_id)
+        else:
+            if len(args.target) != 1 or not args.models:
+                parser.error("contested needs a dataset and --models")
+            contested = store.contested(args.target[0], [m.strip() for m in args.models.split(",")])
+            print(f"{len(contested)} contested items")
+            for item_id in sorted(contested):
+                print(item_id)
+
+
+if __name__ == "__main__":
+    main()
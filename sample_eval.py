@@ -0,0 +1,421 @@
+"""
+Score a prompt change on a label-stratified sample of train terms.
+
+Train terms have gold types, so a small sample answers "is the new
+prompt better?" long before a full test run would. The sample takes
+terms from every label in proportion to its size in train (at least
+--min-per-label each, one by default when --size covers every label, or
+--allocation equal for the same number per label); the first five train terms are the prompt's few-shot examples
+and are never drawn. Prompts are rendered from the current prompt.json
+and prompt_judge.json, so an edit is picked up without running
+create_jsonl_dataset.py again.
+
+Every reasoner types the sample, and with --judge the judge rules on
+their opinions as in pipeline.py. Accuracy is the share of terms whose
+first predicted type is a gold type, weighted back to the label mix of
+train, with a Wilson interval on the effective sample size.
+
+    python sample_eval.py OBI --models gpt-4o --size 100 --name before
+    (edit datasets/OBI/prompt.json)
+    python sample_eval.py OBI --models gpt-4o --size 100 --name after --baseline before
+
+With the same --seed both runs score the same terms, and --baseline
+reports the paired difference in accuracy with its interval.
+"""
+
+import argparse
+import asyncio
+import math
+import os
+import random
+from collections import defaultdict
+from pathlib import Path
+from statistics import NormalDist
+
+from tqdm.asyncio import tqdm as tqdm_asyncio
+
+from codec import read_json, write_json
+from create_jsonl_dataset_judge import DEFAULT_TOKEN_BUDGET, DatasetProcessor
+from engine import PRIORITY_CONTESTED
+from providers import PROVIDERS, add_engine_arguments, engine_from_args
+from registry import AVAILABLE_DATASETS, EXAMPLES_IN_PROMPT, load_dataset
+from schemas import build_response_model
+
+RESULT_DIR = Path("results_sample")
+DEFAULT_SIZE = 100
+DEFAULT_MIN_PER_LABEL = 1
+DEFAULT_CONFIDENCE = 0.95
+MAX_CONCURRENT = 4
+JUDGE = "judge"
+
+
+def allocate(counts, size, minimum=None, equal=False):
+    """
+    Split a sample size over labels.
+
+    Args:
+        counts: Train terms available per label
+        size: Terms to draw in total
+        minimum: Terms every label gets first, when it has them; None for
+            DEFAULT_MIN_PER_LABEL, or none when size is too small for that
+        equal: Same share for every label instead of proportional to its count
+
+    Returns:
+        Terms to draw per label, never more than the label has
+
+    Raises:
+        ValueError: If a minimum that was given alone is more than size
+    """
+    explicit = minimum is not None
+    if not explicit:
+        minimum = DEFAULT_MIN_PER_LABEL
+        if sum(min(count, minimum) for count in counts.values()) > size:
+            # Fewer terms than labels: the largest labels are drawn from, the rest not at all
+            minimum = 0
+    allocation = {label: min(count, minimum) for label, count in counts.items()}
+    floor = sum(allocation.values())
+    if explicit and floor > size:
+        raise ValueError(f"size must be at least the number of labels: {minimum} per label needs {floor} terms "
+                         f"for {len(counts)} labels, not {size}; raise the size or lower the minimum (0 for none)")
+    while True:
+        remaining = size - sum(allocation.values())
+        open_labels = [label for label in counts if allocation[label] < counts[label]]
+        if remaining <= 0 or not open_labels:
+            return allocation
+        shares = {label: 1 if equal else counts[label] for label in open_labels}
+        total = sum(shares.values())
+        quotas = {label: remaining * share / total for label, share in shares.items()}
+        added = 0
+        for label in open_labels:
+            take = min(int(quotas[label]), counts[label] - allocation[label])
+            allocation[label] += take
+            added += take
+        if added == 0:
+            # Quotas below one: hand out the rest by largest quota, one each
+            for label in sorted(open_labels, key=lambda label: -quotas[label])[:remaining]:
+                allocation[label] += 1
+
+
+def stratified_sample(dataset_name, size, seed=0, minimum=None, equal=False,
+                      skip=EXAMPLES_IN_PROMPT):
+    """
+    Draw a label-stratified sample of train terms.
+
+    Each term belongs to the stratum of its first gold type.
+
+    Args:
+        dataset_name: Dataset to sample
+        size: Terms to draw
+        seed: Seed of the draw
+        minimum: Terms every label gets first, when it has them; None for the default (see allocate)
+        equal: Same number of terms per label instead of proportional to train
+        skip: Leading train terms left out, the few-shot examples of the prompt
+
+    Returns:
+        Tuple of (sampled items, train terms per label)
+
+    Raises:
+        ValueError: If a minimum that was given alone is more than size
+    """
+    pool = load_dataset(dataset_name).train[skip:]
+    strata = defaultdict(list)
+    for item in pool:
+        strata[item["types"][0]].append(item)
+    counts = {label: len(items) for label, items in sorted(strata.items())}
+    allocation = allocate(counts, min(size, len(pool)), minimum, equal)
+    rng = random.Random(seed)
+    sample = []
+    for label, take in allocation.items():
+        sample.extend(rng.sample(strata[label], take))
+    return sample, counts
+
+
+def item_weights(sample, counts):
+    """Weight of each sampled term: train terms of its label per sampled term of its label."""
+    sampled = defaultdict(int)
+    for item in sample:
+        sampled[item["types"][0]] += 1
+    return {item["id"]: counts[item["types"][0]] / sampled[item["types"][0]] for item in sample}
+
+
+def wilson_interval(p, n, confidence=DEFAULT_CONFIDENCE):
+    """Wilson score interval of a proportion p observed on n (possibly effective) trials."""
+    if n <= 0:
+        return 0.0, 1.0
+    z = NormalDist().inv_cdf(0.5 + confidence / 2)
+    center = (p + z * z / (2 * n)) / (1 + z * z / n)
+    half = z * math.sqrt(p * (1 - p) / n + z * z / (4 * n * n)) / (1 + z * z / n)
+    return max(0.0, center - half), min(1.0, center + half)
+
+
+def weighted_accuracy(correct, weights, confidence=DEFAULT_CONFIDENCE):
+    """
+    Accuracy weighted to the train label mix, with its interval.
+
+    The interval is Wilson's on Kish's effective sample size, which stays
+    inside [0, 1] and is not degenerate for strata that are all right or
+    all wrong.
+
+    Args:
+        correct: Item id -> whether the answer was right
+        weights: Item id -> weight from item_weights
+
+    Returns:
+        Dict with accuracy, low, high, n and effective_n
+    """
+    ids = [item_id for item_id in correct if item_id in weights]
+    total = sum(weights[item_id] for item_id in ids)
+    if not ids or total == 0:
+        return {"accuracy": None, "low": None, "high": None, "n": 0, "effective_n": 0}
+    accuracy = sum(weights[item_id] for item_id in ids if correct[item_id]) / total
+    effective_n = total ** 2 / sum(weights[item_id] ** 2 for item_id in ids)
+    low, high = wilson_interval(accuracy, effective_n, confidence)
+    return {"accuracy": round(accuracy, 4), "low": round(low, 4), "high": round(high, 4),
+            "n": len(ids), "effective_n": round(effective_n, 1)}
+
+
+def paired_difference(correct, baseline, weights, confidence=DEFAULT_CONFIDENCE):
+    """
+    Weighted accuracy difference on the terms scored in both runs, with a normal interval.
+
+    Returns:
+        Dict with difference, low, high and n, or None without shared terms
+    """
+    ids = [item_id for item_id in correct if item_id in baseline and item_id in weights]
+    total = sum(weights[item_id] for item_id in ids)
+    if not ids or total == 0:
+        return None
+    differences = {item_id: int(correct[item_id]) - int(baseline[item_id]) for item_id in ids}
+    mean = sum(weights[item_id] * differences[item_id] for item_id in ids) / total
+    # Linearised variance of a weighted mean
+    variance = sum((weights[item_id] * (differences[item_id] - mean)) ** 2 for item_id in ids) / total ** 2
+    if len(ids) > 1:
+        variance *= len(ids) / (len(ids) - 1)
+    z = NormalDist().inv_cdf(0.5 + confidence / 2)
+    half = z * math.sqrt(variance)
+    return {"difference": round(mean, 4), "low": round(mean - half, 4), "high": round(mean + half, 4), "n": len(ids)}
+
+
+def is_correct(answer, gold_types):
+    return bool(answer["types"]) and answer["types"][0] in gold_types
+
+
+async def type_sample(dataset_name, sample, models, engines):
+    """
+    Type the sample with every reasoner.
+
+    Returns:
+        Model -> item id -> {"types", "reason"}
+    """
+    dataset = load_dataset(dataset_name)
+    response_model = build_response_model(dataset_name)
+
+    async def ask(model, item):
+        messages = [
+            {"role": "system", "content": dataset.prompts["typing"]},
+            # Only the id and term: the gold types stay out of the prompt
+            {"role": "user", "content": str({"id": item["id"], "term": item["term"]})},
+        ]
+        result = await engines[model].submit(messages, response_model)
+        return model, item["id"], {"types": result.types, "reason": result.reason}
+
+    answers = {model: {} for model in models}
+    tasks = [ask(model, item) for model in models for item in sample]
+    for fut in tqdm_asyncio.as_completed(tasks, desc=f"Typing {dataset_name} sample", total=len(tasks)):
+        try:
+            model, item_id, answer = await fut
+        except Exception as e:
+            print(f"Error processing item: {e}")
+            continue
+        answers[model][item_id] = answer
+    return answers
+
+
+async def judge_sample(dataset_name, sample, answers, models, judge, judge_engine, args):
+    """
+    Have the judge rule on the reasoner opinions of every sampled term they all answered.
+
+    Returns:
+        Item id -> {"types", "reason"}
+    """
+    processor = DatasetProcessor(dataset_name, judge, models, skip_consensus=args.skip_consensus,
+                                 token_budget=args.token_budget or None)
+    labels, template, _ = processor.load_inputs()
+    system_prompt = processor.build_system_prompt(labels, template)
+    response_model = build_response_model(dataset_name)
+
+    verdicts = {}
+    pending = []
+    for item in sample:
+        if not all(item["id"] in answers[model] for model in models):
+            continue
+        consensus = []
+        messages = processor.build_item(item, answers, models, system_prompt, consensus)
+        if messages is None:
+            verdicts[item["id"]] = {"types": consensus[0]["types"], "reason": consensus[0]["reason"]}
+        else:
+            pending.append((item["id"], messages))
+
+    async def ask(item_id, messages):
+        result = await judge_engine.submit(messages, response_model, priority=PRIORITY_CONTESTED)
+        return item_id, {"types": result.types, "reason": result.reason}
+
+    tasks = [ask(item_id, messages) for item_id, messages in pending]
+    for fut in tqdm_asyncio.as_completed(tasks, desc=f"Judging {dataset_name} sample", total=len(tasks)):
+        try:
+            item_id, verdict = await fut
+        except Exception as e:
+            print(f"Error processing item: {e}")
+            continue
+        verdicts[item_id] = verdict
+    return verdicts
+
+
+def print_report(dataset_name, scores, comparisons, confidence, baseline_name):
+    print(f"\n{dataset_name}: accuracy on the sample, weighted to the train label mix ({confidence:.0%} interval)")
+    header = f"{'scorer':<28} {'n':>5} {'accuracy':>9} {'interval':>17}"
+    if comparisons:
+        header += f" {'vs ' + baseline_name:>26}"
+    print(header)
+    for scorer, score in scores.items():
+        if score["accuracy"] is None:
+            print(f"{scorer:<28} {0:>5} {'-':>9}")
+            continue
+        interval = f"[{score['low']:.3f}, {score['high']:.3f}]"
+        line = f"{scorer:<28} {score['n']:>5} {score['accuracy']:>9.3f} {interval:>17}"
+        comparison = comparisons.get(scorer)
+        if comparison is not None:
+            difference = f"{comparison['difference']:+.3f} [{comparison['low']:+.3f}, {comparison['high']:+.3f}]"
+            line += f" {difference:>26}"
+        print(line)
+
+
+async def process_dataset(dataset_name, models, engines, judge_engine, args):
+    sample, counts = stratified_sample(dataset_name, args.size, args.seed, args.min_per_label,
+                                       args.allocation == "equal")
+    gold = {item["id"]: item["types"] for item in sample}
+    weights = item_weights(sample, counts)
+    sampled_labels = len({item["types"][0] for item in sample})
+    print(f"{dataset_name}: {len(sample)} train terms from {sampled_labels} of {len(counts)} labels "
+          f"(of {sum(counts.values())} train terms)")
+
+    answers = await type_sample(dataset_name, sample, models, engines)
+    results = dict(answers)
+    if args.judge:
+        results[JUDGE] = await judge_sample(dataset_name, sample, answers, models, args.judge, judge_engine, args)
+
+    correct = {scorer: {item_id: is_correct(answer, gold[item_id]) for item_id, answer in scorer_answers.items()}
+               for scorer, scorer_answers in results.items()}
+    scores = {scorer: weighted_accuracy(scorer_correct, weights, args.confidence)
+              for scorer, scorer_correct in correct.items()}
+
+    comparisons = {}
+    if args.baseline:
+        baseline_file = RESULT_DIR / f"{dataset_name.lower()}_{args.baseline}.json"
+        if baseline_file.exists():
+            baseline = read_json(baseline_file)
+            for scorer, scorer_correct in correct.items():
+                if scorer in baseline["correct"]:
+                    comparisons[scorer] = paired_difference(scorer_correct, baseline["correct"][scorer],
+                                                            weights, args.confidence)
+        else:
+            print(f"No baseline report {baseline_file}; skipping the comparison")
+    print_report(dataset_name, scores, comparisons, args.confidence, args.baseline)
+
+    report_file = RESULT_DIR / f"{dataset_name.lower()}_{args.name}.json"
+    os.makedirs(report_file.parent, exist_ok=True)
+    write_json(report_file, {
+        "dataset": dataset_name,
+        "models": models,
+        "judge": args.judge,
+        "seed": args.seed,
+        "size": len(sample),
+        "allocation": args.allocation,
+        "scores": scores,
+        "comparisons": comparisons,
+        "correct": correct,
+        "answers": results,
+    })
+    print(f"Saved report to {report_file}")
+
+
+async def main_async(datasets_to_process, models, engines, judge_engine, args):
+    for dataset_name in datasets_to_process:
+        await process_dataset(dataset_name, models, engines, judge_engine, args)
+    for engine in engines.values():
+        engine.report()
+    if judge_engine is not None:
+        judge_engine.report()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Score the current prompts on a label-stratified sample of train terms."
+    )
+    parser.add_argument(
+        "dataset",
+        choices=AVAILABLE_DATASETS + ["all"],
+        help="Dataset to process or 'all' to process all datasets",
+    )
+    parser.add_argument(
+        "--models",
+        default="gpt-4o",
+        help="Comma-separated reasoners that type the sample",
+    )
+    parser.add_argument("--judge", choices=list(PROVIDERS), default=None,
+                        help="Also have this model judge the reasoner opinions")
+    parser.add_argument("--size", type=int, default=DEFAULT_SIZE, help="Train terms in the sample")
+    parser.add_argument(
+        "--allocation",
+        choices=["proportional", "equal"],
+        default="proportional",
+        help="Terms per label in proportion to train, or the same for every label",
+    )
+    parser.add_argument(
+        "--min-per-label",
+        type=int,
+        default=None,
+        help=f"Terms every label gets before the rest is allocated; --size must cover them (default: "
+             f"{DEFAULT_MIN_PER_LABEL}, or 0 when --size is below the number of labels)",
+    )
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the sample; keep it to compare runs")
+    parser.add_argument("--confidence", type=float, default=DEFAULT_CONFIDENCE, help="Level of the intervals")
+    parser.add_argument("--name", default="latest", help="Name the report is saved under")
+    parser.add_argument("--baseline", default=None, help="Name of an earlier report to compare with")
+    parser.add_argument(
+        "--skip-consensus",
+        action="store_true",
+        help="Do not send terms to the judge when all reasoners agree",
+    )
+    parser.add_argument(
+        "--token-budget",
+        type=int,
+        default=DEFAULT_TOKEN_BUDGET,
+        help="Estimated tokens allowed for the reasoner opinions of one term, 0 for no limit",
+    )
+    parser.add_argument(
+        "--max-concurrent",
+        type=int,
+        default=MAX_CONCURRENT,
+        help="Requests in flight per model",
+    )
+    add_engine_arguments(parser, None)
+    args = parser.parse_args()
+
+    models = [m.strip() for m in args.models.split(",")]
+    for model in models:
+        if model not in PROVIDERS:
+            parser.error(f"Invalid model: {model}. Available models are: {', '.join(PROVIDERS)}")
+    datasets_to_process = AVAILABLE_DATASETS if args.dataset == "all" else [args.dataset]
+    for dataset_name in datasets_to_process:
+        try:
+            stratified_sample(dataset_name, args.size, args.seed, args.min_per_label, args.allocation == "equal")
+        except ValueError as e:
+            parser.error(f"{dataset_name}: {e} (--size, --min-per-label)")
+    engines = {model: engine_from_args(model, args.max_concurrent, args) for model in models}
+    judge_engine = engine_from_args(args.judge, args.max_concurrent, args) if args.judge else None
+    asyncio.run(main_async(datasets_to_process, models, engines, judge_engine, args))
+
+
+if __name__ == "__main__":
+    main()
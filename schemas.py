@@ -0,0 +1,70 @@
+"""
+Per-dataset response models whose types are restricted to the dataset labels.
+
+The label set comes from the dataset registry, the same sorted list the
+prompts show under [LABELS], so a model can only answer with one of the
+labels it was shown.
+"""
+
+from functools import lru_cache
+from typing import Literal
+
+from registry import load_dataset
+
+
+def load_labels(dataset_name):
+    """Return the sorted label set of a dataset's train file."""
+    return load_dataset(dataset_name).labels
+
+
+@lru_cache(maxsize=None)
+def build_response_model(dataset_name, with_reason=True, with_confidence=False):
+    """
+    Build the response model for a dataset.
+
+    Args:
+        dataset_name: Dataset whose labels are allowed in 'types'
+        with_reason: Include the free-text 'reason' field
+        with_confidence: Include a self-reported 'confidence' between 0 and 1
+
+    Returns:
+        Pydantic model with id, types (a Literal of the labels) and optionally reason and confidence
+    """
+    # pydantic is imported here so that importing a runner stays cheap
+    from pydantic import ConfigDict, create_model
+
+    label_type = Literal[load_labels(dataset_name)]
+    fields = {"id": (str, ...), "types": (list[label_type], ...)}
+    if with_reason:
+        fields["reason"] = (str, ...)
+    if with_confidence:
+        fields["confidence"] = (float, ...)
+    name = f"{dataset_name}TermTyping" if with_reason else f"{dataset_name}TermTypingNoReason"
+    # extra="forbid" gives additionalProperties: false, required by strict schemas
+    return create_model(
+        f"{name}WithConfidence" if with_confidence else name,
+        __config__=ConfigDict(extra="forbid"),
+        **fields,
+    )
+
+
+@lru_cache(maxsize=None)
+def build_batch_response_model(dataset_name, with_reason=True):
+    """
+    Build the response model of one call that types several terms.
+
+    Args:
+        dataset_name: Dataset whose labels are allowed in 'types'
+        with_reason: Include the free-text 'reason' field of each item
+
+    Returns:
+        Pydantic model with 'items', a list of the single-term response model
+    """
+    from pydantic import ConfigDict, create_model
+
+    item_model = build_response_model(dataset_name, with_reason)
+    return create_model(
+        f"{item_model.__name__}Batch",
+        __config__=ConfigDict(extra="forbid"),
+        items=(list[item_model], ...),
+    )
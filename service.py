@@ -0,0 +1,447 @@
+"""
+Local HTTP service that types new terms as curators add them.
+
+    python service.py --model gpt-4o
+    python service.py --mock --mock-latency 0.5
+    curl -X POST localhost:8765/type -d '{"dataset": "OBI", "term": "centrifuge"}'
+    curl localhost:8765/metrics
+
+Requests for the same dataset that arrive within --window-ms of each other
+are packed into one provider call: the dataset's typing system prompt,
+told to answer every listed item, and one {'id': ..., 'term': ...} line per
+term, the item format of the prepared prompts. A batch is sent as soon as
+it holds --max-batch terms. Terms missing from a batch answer are sent
+once more on their own.
+
+Answers are cached by dataset and term, so a term typed before is answered
+without a call, and the same term requested twice within one window takes
+one place in the batch.
+
+--mock answers with a local stand-in provider (the label nearest to the
+term by trigram similarity, after --mock-latency seconds), for trying the
+service without API keys.
+
+The server is plain asyncio with one request per connection, so it needs
+no web framework.
+"""
+
+import argparse
+import ast
+import asyncio
+import time
+from collections import OrderedDict, deque
+from functools import lru_cache
+from typing import Any, Dict, List, Tuple, get_args
+
+from codec import codec as json_codec
+from engine import Engine
+from label_index import LabelIndex
+from providers import PROVIDERS, add_engine_arguments, call_kwargs, engine_from_args
+from registry import AVAILABLE_DATASETS, load_dataset
+from schemas import build_batch_response_model, build_response_model
+
+DEFAULT_MODEL = "gpt-4o"
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8765
+# Time a batch stays open for more terms, and the most terms in one call
+DEFAULT_WINDOW_MS = 20
+DEFAULT_MAX_BATCH = 8
+DEFAULT_CACHE_SIZE = 10000
+MAX_CONCURRENT = 4
+# Request latencies kept for the percentiles, and seconds of the recent throughput
+METRICS_WINDOW = 1000
+THROUGHPUT_WINDOW = 60
+MAX_BODY_BYTES = 64 * 1024
+
+BATCH_INSTRUCTION = (
+    "\n\nThe user message lists several items, one per line. Type every item and "
+    "return one entry per item in 'items', each with the id of its item."
+)
+STATUS_TEXT = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed",
+               413: "Payload Too Large", 502: "Bad Gateway"}
+
+
+def normalize_term(term: str) -> str:
+    """Cache key of a term: case and runs of whitespace are ignored."""
+    return " ".join(term.split()).lower()
+
+
+def item_line(item_id: str, term: str) -> str:
+    """One item as the prepared prompts write it."""
+    return str({"id": item_id, "term": term})
+
+
+def single_messages(system_prompt: str, term: str, item_id: str = "T1") -> List[Dict[str, str]]:
+    """Messages that type one term."""
+    return [
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": item_line(item_id, term)},
+    ]
+
+
+def batch_messages(system_prompt: str, terms: List[str]) -> Tuple[List[Dict[str, str]], List[str]]:
+    """
+    Messages that type several terms in one call.
+
+    Returns:
+        Tuple of (messages, item id of each term)
+    """
+    ids = [f"T{position + 1}" for position in range(len(terms))]
+    messages = [
+        {"role": "system", "content": system_prompt + BATCH_INSTRUCTION},
+        {"role": "user", "content": "\n".join(item_line(item_id, term) for item_id, term in zip(ids, terms))},
+    ]
+    return messages, ids
+
+
+class TermCache:
+    """Least-recently-used answers by (dataset, normalized term)."""
+
+    def __init__(self, size: int):
+        self.size = size
+        self.entries: "OrderedDict[Tuple[str, str], Dict[str, Any]]" = OrderedDict()
+
+    def get(self, key):
+        answer = self.entries.get(key)
+        if answer is not None:
+            self.entries.move_to_end(key)
+        return answer
+
+    def put(self, key, answer: Dict[str, Any]):
+        if self.size <= 0:
+            return
+        self.entries[key] = answer
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+
+class Metrics:
+    """Counters, latency percentiles and throughput of the service."""
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.counts = {"requests": 0, "cache_hits": 0, "coalesced": 0, "batches": 0,
+                       "batched_terms": 0, "single_retries": 0, "errors": 0}
+        self.latencies = deque(maxlen=METRICS_WINDOW)
+        self.finished = deque()
+
+    def record(self, latency: float):
+        now = time.monotonic()
+        self.latencies.append(latency)
+        self.finished.append(now)
+        while self.finished and self.finished[0] < now - THROUGHPUT_WINDOW:
+            self.finished.popleft()
+
+    def report(self) -> Dict[str, Any]:
+        """
+        Summarise the requests served so far.
+
+        Returns:
+            Counters, mean batch size, latency percentiles in ms and requests per second
+        """
+        now = time.monotonic()
+        uptime = now - self.started
+        summary = dict(self.counts)
+        summary["uptime"] = round(uptime, 1)
+        summary["cache_hit_rate"] = round(self.counts["cache_hits"] / max(self.counts["requests"], 1), 3)
+        summary["mean_batch_size"] = round(self.counts["batched_terms"] / max(self.counts["batches"], 1), 2)
+        ordered = sorted(self.latencies)
+        for percentile in (50, 95, 99):
+            if ordered:
+                position = min(len(ordered) - 1, int(len(ordered) * percentile / 100))
+                summary[f"p{percentile}_latency_ms"] = round(ordered[position] * 1000, 1)
+        recent = sum(1 for finished in self.finished if finished >= now - THROUGHPUT_WINDOW)
+        summary["requests_per_second"] = round(self.counts["requests"] / max(uptime, 1e-9), 2)
+        summary[f"requests_per_second_last_{THROUGHPUT_WINDOW}s"] = round(
+            recent / max(min(uptime, THROUGHPUT_WINDOW), 1e-9), 2)
+        return summary
+
+
+class MicroBatcher:
+    """Collect the terms requested within a short window and type them in one call."""
+
+    def __init__(self, engine: Engine, window: float, max_batch: int, cache: TermCache, metrics: Metrics):
+        """
+        Initialize the batcher.
+
+        Args:
+            engine: Engine of the model that types the terms
+            window: Seconds a batch waits for more terms after its first one
+            max_batch: Terms that send a batch before its window ends
+            cache: Answers of terms typed before
+            metrics: Service metrics to update
+        """
+        self.engine = engine
+        self.window = window
+        self.max_batch = max_batch
+        self.cache = cache
+        self.metrics = metrics
+        # Dataset -> normalized term -> (term, future of its answer), in arrival order
+        self.pending: Dict[str, Dict[str, Tuple[str, asyncio.Future]]] = {}
+        self.timers: Dict[str, asyncio.TimerHandle] = {}
+
+    async def type_term(self, dataset_name: str, term: str) -> Dict[str, Any]:
+        """
+        Type one term, from the cache or as part of the next batch.
+
+        Returns:
+            Answer with types, reason (if any), cached and batch_size
+        """
+        key = normalize_term(term)
+        cached = self.cache.get((dataset_name, key))
+        if cached is not None:
+            self.metrics.counts["cache_hits"] += 1
+            return {**cached, "cached": True, "batch_size": 0}
+
+        pending = self.pending.setdefault(dataset_name, {})
+        if key in pending:
+            self.metrics.counts["coalesced"] += 1
+            future = pending[key][1]
+        else:
+            future = asyncio.get_running_loop().create_future()
+            pending[key] = (term, future)
+            if len(pending) >= self.max_batch:
+                self.flush(dataset_name)
+            elif dataset_name not in self.timers:
+                self.timers[dataset_name] = asyncio.get_running_loop().call_later(
+                    self.window, self.flush, dataset_name)
+        # Shielded so one disconnected client does not fail the others waiting on the term
+        return await asyncio.shield(future)
+
+    def flush(self, dataset_name: str):
+        """Send the terms waiting for a dataset as one batch."""
+        timer = self.timers.pop(dataset_name, None)
+        if timer is not None:
+            timer.cancel()
+        batch = self.pending.pop(dataset_name, {})
+        if batch:
+            asyncio.ensure_future(self.run_batch(dataset_name, list(batch.items())))
+
+    async def run_batch(self, dataset_name: str, batch):
+        """Type a batch and hand every waiting request its answer."""
+        terms = [term for _, (term, _) in batch]
+        try:
+            answers = await self.type_terms(dataset_name, terms)
+        except Exception as e:
+            self.metrics.counts["errors"] += 1
+            for _, (_, future) in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (key, (_, future)), answer in zip(batch, answers):
+            self.cache.put((dataset_name, key), answer)
+            if not future.done():
+                future.set_result({**answer, "cached": False, "batch_size": len(batch)})
+
+    async def type_terms(self, dataset_name: str, terms: List[str]) -> List[Dict[str, Any]]:
+        """
+        Type terms with one call, then each term the answer missed on its own.
+
+        Returns:
+            Answer of each term without its item id, in the order of terms
+        """
+        self.metrics.counts["batches"] += 1
+        self.metrics.counts["batched_terms"] += len(terms)
+        system_prompt = load_dataset(dataset_name).prompts["typing"]
+        if len(terms) == 1:
+            return [await self.type_single(dataset_name, system_prompt, terms[0])]
+
+        messages, ids = batch_messages(system_prompt, terms)
+        kwargs = {}
+        if "max_tokens" in self.engine.call_kwargs:
+            # The per-item output budget, once for every item
+            kwargs["max_tokens"] = self.engine.call_kwargs["max_tokens"] * len(terms)
+        # Not coalesced: batches differ in more than the first item id the engine masks
+        result = await self.engine.submit(messages, build_batch_response_model(dataset_name), coalesce=False,
+                                          **kwargs)
+        by_id = {item.id: without_id(item) for item in result.items}
+        missing = [position for position, item_id in enumerate(ids) if item_id not in by_id]
+        self.metrics.counts["single_retries"] += len(missing)
+        retried = await asyncio.gather(*(self.type_single(dataset_name, system_prompt, terms[position])
+                                         for position in missing))
+        answers = [by_id.get(item_id) for item_id in ids]
+        for position, answer in zip(missing, retried):
+            answers[position] = answer
+        return answers
+
+    async def type_single(self, dataset_name: str, system_prompt: str, term: str) -> Dict[str, Any]:
+        """Type one term with its own call."""
+        result = await self.engine.submit(single_messages(system_prompt, term),
+                                          build_response_model(dataset_name))
+        return without_id(result)
+
+
+def without_id(item) -> Dict[str, Any]:
+    """Answer fields of a response item; its id only numbers it within one call."""
+    answer = item.model_dump()
+    answer.pop("id", None)
+    return answer
+
+
+def mock_items(content: str) -> List[Dict[str, str]]:
+    """Items of a user message: {'id', 'term'} lines, or the id: and term: header of a judge item."""
+    if content.startswith("{"):
+        return [ast.literal_eval(line) for line in content.splitlines() if line.strip()]
+    header = dict(line.split(": ", 1) for line in content.splitlines()[:2])
+    return [{"id": header["id"], "term": header["term"]}]
+
+
+@lru_cache(maxsize=None)
+def mock_label_index(labels: Tuple[str, ...]) -> LabelIndex:
+    return LabelIndex(labels)
+
+
+def mock_create(latency: float):
+    """
+    Stand-in for a provider's create call, answering without the network.
+
+    Each item gets the label nearest to its term (the first label when none
+    is close), so the answers are deterministic.
+
+    Args:
+        latency: Seconds every call takes
+
+    Returns:
+        Blocking create(model, response_model, messages, **kwargs)
+    """
+    def create(model, response_model, messages, **kwargs):
+        time.sleep(latency)
+        batched = "items" in response_model.model_fields
+        item_model = get_args(response_model.model_fields["items"].annotation)[0] if batched else response_model
+        labels = get_args(get_args(item_model.model_fields["types"].annotation)[0])
+        index = mock_label_index(labels)
+        items = []
+        for item in mock_items(messages[-1]["content"]):
+            label = index.lookup(item["term"])[0] or labels[0]
+            fields = {"id": item["id"], "types": [label]}
+            if "reason" in item_model.model_fields:
+                fields["reason"] = f"Mock answer: '{label}' is the label closest to '{item['term']}'."
+            items.append(item_model(**fields))
+        return response_model(items=items) if batched else items[0]
+
+    return create
+
+
+class TermTypingService:
+    """HTTP front end of the batcher: POST /type, GET /metrics and GET /health."""
+
+    def __init__(self, batcher: MicroBatcher, metrics: Metrics):
+        self.batcher = batcher
+        self.metrics = metrics
+
+    async def type_request(self, body: bytes) -> Tuple[int, Dict[str, Any]]:
+        """Answer one POST /type body."""
+        started = time.monotonic()
+        try:
+            request = json_codec.loads(body)
+        except Exception:
+            return 400, {"error": "Body must be a JSON object with 'dataset' and 'term'"}
+        if not isinstance(request, dict):
+            return 400, {"error": "Body must be a JSON object with 'dataset' and 'term'"}
+        dataset_name, term = request.get("dataset"), request.get("term")
+        if dataset_name not in AVAILABLE_DATASETS:
+            return 400, {"error": f"Dataset '{dataset_name}' not found. Available datasets: {AVAILABLE_DATASETS}"}
+        if not isinstance(term, str) or not term.strip():
+            return 400, {"error": "'term' must be a non-empty string"}
+
+        self.metrics.counts["requests"] += 1
+        try:
+            answer = await self.batcher.type_term(dataset_name, term.strip())
+        except Exception as e:
+            return 502, {"error": f"Provider call failed: {e}"}
+        latency = time.monotonic() - started
+        self.metrics.record(latency)
+        return 200, {"dataset": dataset_name, "term": term, **answer, "latency_ms": round(latency * 1000, 1)}
+
+    async def route(self, method: str, path: str, body: bytes) -> Tuple[int, Dict[str, Any]]:
+        if path == "/type":
+            if method != "POST":
+                return 405, {"error": "Use POST /type"}
+            return await self.type_request(body)
+        if path == "/metrics":
+            return 200, {**self.metrics.report(), "engine": dict(self.batcher.engine.stats)}
+        if path == "/health":
+            return 200, {"status": "ok", "model": self.batcher.engine.model_name}
+        return 404, {"error": f"Unknown path {path}; use POST /type, GET /metrics or GET /health"}
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """Serve one HTTP/1.1 request and close the connection."""
+        try:
+            request_line = (await reader.readline()).decode("latin-1").split()
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b"\r\n", b"\n", b""):
+                    break
+                name, _, value = line.decode("latin-1").partition(":")
+                headers[name.strip().lower()] = value.strip()
+            if len(request_line) < 2:
+                status, payload = 400, {"error": "Malformed request line"}
+            else:
+                length = int(headers.get("content-length", 0) or 0)
+                if length > MAX_BODY_BYTES:
+                    status, payload = 413, {"error": f"Body over {MAX_BODY_BYTES} bytes"}
+                else:
+                    body = await reader.readexactly(length) if length else b""
+                    status, payload = await self.route(request_line[0].upper(), request_line[1].split("?")[0], body)
+            data = json_codec.dumps(payload) + b"\n"
+            writer.write(
+                f"HTTP/1.1 {status} {STATUS_TEXT.get(status, '')}\r\n"
+                f"Content-Type: application/json\r\nContent-Length: {len(data)}\r\nConnection: close\r\n\r\n"
+                .encode("latin-1") + data
+            )
+            await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+
+async def serve(args, engine):
+    metrics = Metrics()
+    batcher = MicroBatcher(engine, args.window_ms / 1000, args.max_batch, TermCache(args.cache_size), metrics)
+    service = TermTypingService(batcher, metrics)
+    server = await asyncio.start_server(service.handle, args.host, args.port)
+    provider = f"mock provider, {args.mock_latency}s per call" if args.mock else args.model
+    print(f"Typing terms with {provider} on http://{args.host}:{args.port} "
+          f"(window {args.window_ms} ms, batches of up to {args.max_batch})")
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        print(f"Service metrics: {metrics.report()}")
+        engine.report()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve term typing over HTTP with micro-batched provider calls.")
+    parser.add_argument("--model", choices=list(PROVIDERS), default=DEFAULT_MODEL, help="Model that types the terms")
+    parser.add_argument("--host", default=DEFAULT_HOST, help="Address to listen on")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT, help="Port to listen on")
+    parser.add_argument("--window-ms", type=float, default=DEFAULT_WINDOW_MS,
+                        help="Milliseconds a batch waits for more terms after its first one")
+    parser.add_argument("--max-batch", type=int, default=DEFAULT_MAX_BATCH,
+                        help="Terms that send a batch before its window ends")
+    parser.add_argument("--cache-size", type=int, default=DEFAULT_CACHE_SIZE,
+                        help="Answers kept in memory; 0 disables the cache")
+    parser.add_argument("--max-concurrent", type=int, default=MAX_CONCURRENT,
+                        help="Provider calls in flight at once")
+    parser.add_argument("--mock", action="store_true", help="Answer with a local stand-in provider instead of --model")
+    parser.add_argument("--mock-latency", type=float, default=0.2, help="Seconds every mock call takes")
+    add_engine_arguments(parser, DEFAULT_MODEL)
+    args = parser.parse_args()
+
+    if args.mock:
+        engine = Engine(mock_create(args.mock_latency), args.model, args.max_concurrent,
+                        args.hedge_percentile, call_kwargs=call_kwargs(args.model))
+    else:
+        engine = engine_from_args(args.model, args.max_concurrent, args)
+    try:
+        asyncio.run(serve(args, engine))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
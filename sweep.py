@@ -0,0 +1,329 @@
+"""
+Compare prompt variants across models and datasets in one concurrent run.
+
+A sweep file names the grid; every variant x model x dataset cell types
+the same label-stratified sample of train terms (see sample_eval.py), so
+the cells are scored against gold types and directly comparable:
+
+    {
+        "datasets": ["OBI", "SWEET"],
+        "models": ["gpt-4o", "deepseek-chat"],
+        "size": 100,
+        "variants": {
+            "baseline": {},
+            "ten_shot": {"examples": 10},
+            "terse": {"template": "prompts/{dataset}/terse.json"},
+            "no_reason": {"reason": false}
+        }
+    }
+
+The sample is drawn as by sample_eval.py, with "seed", "allocation" and
+"min_per_label" settable next to "size"; a min_per_label that is set must
+fit in the size for every dataset.
+
+A variant may set "template" (a file shaped like prompt.json; {dataset}
+is replaced by the dataset name), "examples" (few-shot train terms shown
+in the prompt, 5 by default) and "reason" (false to ask for types only).
+Leaving datasets out runs every dataset.
+
+All cells run at once and share one engine per model, so the rate limits
+of each provider hold for the sweep as a whole. A request that two cells
+would send identically (same model, prompt and term) is sent once.
+Answers are appended to results_sweep/<sweep>/answers.jsonl as they
+arrive, keyed by request, so an interrupted sweep resumes where it
+stopped, and a sweep extended with a new variant only sends the new
+requests. The comparison table (accuracy with its interval, estimated
+tokens and seconds per term) is printed and saved as table.json.
+
+    python sweep.py sweeps/few_shot.json
+    python sweep.py sweeps/few_shot.json --fresh
+"""
+
+import argparse
+import asyncio
+import os
+import time
+from pathlib import Path
+
+from tqdm.asyncio import tqdm as tqdm_asyncio
+
+from codec import dumps_line, iter_jsonl, read_json, write_json
+from create_jsonl_dataset import strip_reason_instruction
+from engine import item_id_of, request_key
+from providers import PROVIDERS, add_engine_arguments, engine_from_args
+from registry import AVAILABLE_DATASETS, EXAMPLES_IN_PROMPT, load_dataset, render_prompt
+from sample_eval import (DEFAULT_CONFIDENCE, DEFAULT_SIZE, is_correct, item_weights,
+                         stratified_sample, weighted_accuracy)
+from schemas import build_response_model
+from tokens import estimate_messages_tokens, estimate_tokens
+
+RESULT_DIR = Path("results_sweep")
+MAX_CONCURRENT = 4
+VARIANT_KEYS = {"template", "examples", "reason"}
+
+
+def load_sweep(path):
+    """
+    Read and check a sweep file.
+
+    Returns:
+        Sweep with datasets, models, variants, size, seed, allocation and min_per_label filled in
+    """
+    sweep = read_json(path)
+    if not sweep.get("variants"):
+        raise ValueError(f"{path}: 'variants' must name at least one variant")
+    for name, variant in sweep["variants"].items():
+        unknown = set(variant) - VARIANT_KEYS
+        if unknown:
+            raise ValueError(f"{path}: variant '{name}' has unknown keys {sorted(unknown)}; "
+                             f"use {sorted(VARIANT_KEYS)}")
+    sweep.setdefault("datasets", AVAILABLE_DATASETS)
+    sweep.setdefault("models", ["gpt-4o"])
+    for dataset_name in sweep["datasets"]:
+        if dataset_name not in AVAILABLE_DATASETS:
+            raise ValueError(f"Dataset '{dataset_name}' not found. Available datasets: {AVAILABLE_DATASETS}")
+    for model in sweep["models"]:
+        if model not in PROVIDERS:
+            raise ValueError(f"Invalid model: {model}. Available models are: {', '.join(PROVIDERS)}")
+    sweep.setdefault("size", DEFAULT_SIZE)
+    sweep.setdefault("seed", 0)
+    sweep.setdefault("allocation", "proportional")
+    sweep.setdefault("min_per_label", None)
+    for dataset_name in sweep["datasets"]:
+        try:
+            stratified_sample(dataset_name, sweep["size"], sweep["seed"], sweep["min_per_label"],
+                              sweep["allocation"] == "equal", sample_skip(sweep))
+        except ValueError as e:
+            raise ValueError(f"{path}: {dataset_name}: {e} ('size', 'min_per_label')")
+    return sweep
+
+
+def sample_skip(sweep):
+    """Leading train terms left out of the sample: every variant's few-shot examples."""
+    return max([EXAMPLES_IN_PROMPT] + [variant.get("examples", EXAMPLES_IN_PROMPT)
+                                       for variant in sweep["variants"].values()])
+
+
+def variant_prompt(dataset_name, variant):
+    """System prompt of a variant, rendered like the dataset's own prompt."""
+    dataset = load_dataset(dataset_name)
+    template = dataset.templates["typing"]
+    if "template" in variant:
+        template = read_json(variant["template"].replace("{dataset}", dataset_name))["prompt"]
+    if not variant.get("reason", True):
+        # As create_jsonl_dataset.py --no-reason, so the prompt matches the response model
+        template = strip_reason_instruction(template)
+    return render_prompt(template, dataset.labels, dataset.train, variant.get("examples", EXAMPLES_IN_PROMPT))
+
+
+def build_cells(sweep):
+    """
+    Lay out the requests of every cell.
+
+    Returns:
+        Tuple of (cells, requests, samples): cells maps (dataset, model, variant)
+        to [(item id, request key)], requests maps a request key to
+        (model, dataset, messages, response model) and samples maps a dataset
+        to its (sample, train terms per label)
+    """
+    # Every variant scores the same terms, so none of them may be a few-shot example
+    skip = sample_skip(sweep)
+    cells = {}
+    requests = {}
+    samples = {}
+    for dataset_name in sweep["datasets"]:
+        sample, counts = stratified_sample(dataset_name, sweep["size"], sweep["seed"], sweep["min_per_label"],
+                                           sweep["allocation"] == "equal", skip)
+        samples[dataset_name] = (sample, counts)
+        for variant_name, variant in sweep["variants"].items():
+            system_prompt = variant_prompt(dataset_name, variant)
+            response_model = build_response_model(dataset_name, with_reason=variant.get("reason", True))
+            for model in sweep["models"]:
+                cell = cells.setdefault((dataset_name, model, variant_name), [])
+                for item in sample:
+                    messages = [
+                        {"role": "system", "content": system_prompt},
+                        {"role": "user", "content": str({"id": item["id"], "term": item["term"]})},
+                    ]
+                    key = request_key(messages, response_model, {"model": model})
+                    requests.setdefault(key, (model, dataset_name, messages, response_model))
+                    cell.append((item["id"], key))
+    return cells, requests, samples
+
+
+def masked_key(messages, response_model):
+    """Key of a provider call, shared by requests the engine coalesces into it."""
+    return request_key(messages, response_model, {}, item_id_of(messages))
+
+
+def time_calls(engine, call_seconds):
+    """
+    Record how long each provider call of an engine takes.
+
+    Submitting measures queueing behind the other cells as well, and the
+    engine starts longer prompts first, so the table times the calls
+    themselves. The first call of a request to finish, i.e. the one the
+    engine uses when it hedges, sets its time.
+
+    Args:
+        engine: Engine whose API keys are wrapped
+        call_seconds: Dict filled with masked_key -> seconds
+    """
+    def timed(create):
+        def call(model, response_model, messages, **kwargs):
+            started = time.monotonic()
+            result = create(model=model, response_model=response_model, messages=messages, **kwargs)
+            call_seconds.setdefault(masked_key(messages, response_model), time.monotonic() - started)
+            return result
+        return call
+
+    for key in engine.key_pool.keys:
+        key.create = timed(key.create)
+
+
+def load_answers(path):
+    """Answers saved by earlier runs of the sweep, by request key."""
+    if not path.exists():
+        return {}
+    return {answer["key"]: answer for answer in iter_jsonl(path)}
+
+
+async def run_requests(requests, engines, answers_file):
+    """
+    Send the requests and append each answer to the sweep's answers file.
+
+    Returns:
+        Request key -> answer, for the requests that succeeded
+    """
+    answers = {}
+    call_seconds = {}
+    for engine in engines.values():
+        time_calls(engine, call_seconds)
+
+    async def ask(key, model, dataset_name, messages, response_model):
+        result = await engines[model].submit(messages, response_model)
+        answer = result.model_dump()
+        output = " ".join([*answer["types"], answer.get("reason", "")])
+        chars_per_token = PROVIDERS[model]["chars_per_token"]
+        return {
+            "key": key,
+            "model": model,
+            "dataset": dataset_name,
+            "id": answer["id"],
+            "types": answer["types"],
+            "reason": answer.get("reason"),
+            "seconds": round(call_seconds.get(masked_key(messages, response_model), 0.0), 3),
+            "input_tokens": estimate_messages_tokens(messages, chars_per_token),
+            "output_tokens": estimate_tokens(output, chars_per_token),
+        }
+
+    tasks = [ask(key, *request) for key, request in requests.items()]
+    with open(answers_file, "ab") as f:
+        for fut in tqdm_asyncio.as_completed(tasks, desc="Sweep", total=len(tasks)):
+            try:
+                answer = await fut
+            except Exception as e:
+                print(f"Error processing item: {e}")
+                continue
+            f.write(dumps_line(answer))
+            f.flush()
+            answers[answer["key"]] = answer
+    return answers
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def build_table(cells, answers, samples, confidence=DEFAULT_CONFIDENCE):
+    """
+    Score every cell.
+
+    Returns:
+        Rows with dataset, model, variant, answered terms, accuracy and its
+        interval, tokens per term and seconds per term
+    """
+    rows = []
+    for (dataset_name, model, variant_name), requests in cells.items():
+        sample, counts = samples[dataset_name]
+        gold = {item["id"]: item["types"] for item in sample}
+        cell_answers = {item_id: answers[key] for item_id, key in requests if key in answers}
+        correct = {item_id: is_correct(answer, gold[item_id]) for item_id, answer in cell_answers.items()}
+        row = {"dataset": dataset_name, "model": model, "variant": variant_name,
+               "answered": len(cell_answers), "terms": len(requests),
+               **weighted_accuracy(correct, item_weights(sample, counts), confidence)}
+        if cell_answers:
+            answered = list(cell_answers.values())
+            row["input_tokens"] = round(sum(a["input_tokens"] for a in answered) / len(answered), 1)
+            row["output_tokens"] = round(sum(a["output_tokens"] for a in answered) / len(answered), 1)
+            row["p50_seconds"] = round(percentile([a["seconds"] for a in answered], 0.5), 2)
+            row["p95_seconds"] = round(percentile([a["seconds"] for a in answered], 0.95), 2)
+        rows.append(row)
+    return rows
+
+
+def print_table(rows, confidence):
+    print(f"\nAccuracy on the train sample ({confidence:.0%} interval), estimated tokens and seconds per term")
+    print(f"{'dataset':<9} {'model':<26} {'variant':<16} {'terms':>9} {'accuracy':>9} {'interval':>17} "
+          f"{'in tok':>7} {'out tok':>8} {'p50 s':>7} {'p95 s':>7}")
+    for row in sorted(rows, key=lambda r: (r["dataset"], r["model"], -(r["accuracy"] or 0))):
+        terms = f"{row['answered']}/{row['terms']}"
+        if row["accuracy"] is None:
+            print(f"{row['dataset']:<9} {row['model']:<26} {row['variant']:<16} {terms:>9} {'-':>9}")
+            continue
+        interval = f"[{row['low']:.3f}, {row['high']:.3f}]"
+        print(f"{row['dataset']:<9} {row['model']:<26} {row['variant']:<16} {terms:>9} {row['accuracy']:>9.3f} "
+              f"{interval:>17} {row['input_tokens']:>7.0f} {row['output_tokens']:>8.0f} "
+              f"{row['p50_seconds']:>7.2f} {row['p95_seconds']:>7.2f}")
+
+
+async def main_async(sweep, engines, output_dir, args):
+    cells, requests, samples = build_cells(sweep)
+    answers_file = output_dir / "answers.jsonl"
+    if args.fresh and answers_file.exists():
+        answers_file.unlink()
+    answers = load_answers(answers_file)
+
+    cell_requests = sum(len(requests_of_cell) for requests_of_cell in cells.values())
+    to_send = {key: request for key, request in requests.items() if key not in answers}
+    print(f"{len(cells)} cells, {cell_requests} requests: {cell_requests - len(requests)} shared between cells, "
+          f"{len(requests) - len(to_send)} answered by an earlier run, {len(to_send)} to send")
+
+    answers.update(await run_requests(to_send, engines, answers_file))
+    rows = build_table(cells, answers, samples, args.confidence)
+    print_table(rows, args.confidence)
+    write_json(output_dir / "table.json", rows)
+    print(f"\nSaved table to {output_dir / 'table.json'}")
+    for engine in engines.values():
+        engine.report()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Run a grid of prompt variants x models x datasets and compare the cells."
+    )
+    parser.add_argument("sweep", help="Sweep file with datasets, models and variants")
+    parser.add_argument("--fresh", action="store_true", help="Discard the answers of earlier runs of this sweep")
+    parser.add_argument("--confidence", type=float, default=DEFAULT_CONFIDENCE, help="Level of the intervals")
+    parser.add_argument(
+        "--max-concurrent",
+        type=int,
+        default=MAX_CONCURRENT,
+        help="Requests in flight per model, shared by all cells",
+    )
+    add_engine_arguments(parser, None)
+    args = parser.parse_args()
+
+    try:
+        sweep = load_sweep(args.sweep)
+    except ValueError as e:
+        parser.error(str(e))
+    output_dir = RESULT_DIR / Path(args.sweep).stem
+    os.makedirs(output_dir, exist_ok=True)
+    engines = {model: engine_from_args(model, args.max_concurrent, args) for model in sweep["models"]}
+    asyncio.run(main_async(sweep, engines, output_dir, args))
+
+
+if __name__ == "__main__":
+    main()
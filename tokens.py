@@ -0,0 +1,100 @@
+"""
+Offline token estimation.
+
+Counts are approximations of BPE tokenizers that need no network access or
+tokenizer download: text is split into words and punctuation, and each
+piece costs one token per CHARS_PER_TOKEN characters. Providers whose
+tokenizers split text more finely pass their own characters per token
+(see providers.PROVIDERS).
+"""
+
+import math
+import re
+from functools import lru_cache
+
+CHARS_PER_TOKEN = 4.0
+# Role markers and separators the chat format adds around each message
+MESSAGE_OVERHEAD_TOKENS = 4
+# Expected output of one call when max_tokens is not set: id, types and a short reason
+DEFAULT_OUTPUT_TOKENS = 150
+TOKEN_PIECE_PATTERN = re.compile(r"\w+|[^\w\s]")
+SENTENCE_END_PATTERN = re.compile(r"(?<=[.!?])\s+")
+
+
+def estimate_tokens(text: str, chars_per_token: float = CHARS_PER_TOKEN) -> int:
+    """
+    Estimate the number of tokens in a piece of text.
+
+    Args:
+        text: Text to measure
+        chars_per_token: Average characters per token of the target tokenizer
+
+    Returns:
+        Approximate token count
+    """
+    return sum(
+        max(1, math.ceil(len(piece) / chars_per_token))
+        for piece in TOKEN_PIECE_PATTERN.findall(text)
+    )
+
+
+# Items of one file share their system prompt, so it is only measured once
+cached_estimate_tokens = lru_cache(maxsize=1024)(estimate_tokens)
+
+
+def estimate_messages_tokens(messages, chars_per_token: float = CHARS_PER_TOKEN) -> int:
+    """
+    Estimate the prompt tokens of a chat request.
+
+    Args:
+        messages: Chat messages with role and content
+        chars_per_token: Average characters per token of the target tokenizer
+
+    Returns:
+        Approximate token count, including per-message overhead
+    """
+    return sum(
+        MESSAGE_OVERHEAD_TOKENS + cached_estimate_tokens(message["content"], chars_per_token)
+        for message in messages
+    )
+
+
+def trim_to_tokens(text: str, max_tokens: int, chars_per_token: float = CHARS_PER_TOKEN) -> str:
+    """
+    Shorten text to fit a token budget, keeping whole leading sentences where possible.
+
+    Args:
+        text: Text to shorten
+        max_tokens: Maximum number of tokens to keep
+        chars_per_token: Average characters per token of the target tokenizer
+
+    Returns:
+        The text itself if it fits, otherwise its leading part ending in "..."
+    """
+    if estimate_tokens(text, chars_per_token) <= max_tokens:
+        return text
+    if max_tokens <= 0:
+        return ""
+
+    # Leave room for the ellipsis
+    budget = max_tokens - 1
+    kept = []
+    used = 0
+    for sentence in SENTENCE_END_PATTERN.split(text.strip()):
+        cost = estimate_tokens(sentence, chars_per_token)
+        if used + cost > budget:
+            break
+        kept.append(sentence)
+        used += cost
+    if kept:
+        return " ".join(kept) + " ..."
+
+    # First sentence alone is too long: cut it word by word
+    words = []
+    for word in text.split():
+        cost = estimate_tokens(word, chars_per_token)
+        if used + cost > budget:
+            break
+        words.append(word)
+        used += cost
+    return " ".join(words) + " ..."